@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import re
+
+# CSI sequences like "\x1b[1;32m", only SGR (the "m" ones) are rendered
+CSI_REGEX = re.compile(r'\x1b\[([0-9;?]*)([@-~])')
+# an escape sequence that was cut at the end of a chunk
+PARTIAL_ESCAPE_REGEX = re.compile(r'\x1b(\[[0-9;?]*|[()])?$')
+# escape sequences that are not CSI, i.e.: "\x1b(B"
+OTHER_ESCAPE_REGEX = re.compile(r'\x1b([()].|[^\[]?)')
+
+ANSI_ATTRIBUTES = ['1', '2', '3', '4', '5', '6', '8', '9']
+ANSI_RESETS = {
+    '22': ['1', '2'],
+    '23': ['3'],
+    '24': ['4'],
+    '25': ['5', '6'],
+    '28': ['8'],
+    '29': ['9'],
+}
+
+HTML_ESCAPES = {
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+}
+
+
+def escape_html(text):
+    return ''.join(HTML_ESCAPES.get(c, c) for c in text)
+
+
+def split_ansi_boundary(text):
+    """splits the given text in a renderable part and an escape
+    sequence that was cut at the end, if any.
+    """
+    found = PARTIAL_ESCAPE_REGEX.search(text)
+    if not found:
+        return text, ''
+
+    return text[:found.start()], text[found.start():]
+
+
+def strip_ansi(text):
+    """returns the given text without escape sequences"""
+    return OTHER_ESCAPE_REGEX.sub('', CSI_REGEX.sub('', text))
+
+
+class AnsiRenderer(object):
+
+    """converts text with ANSI escape sequences to html using the
+    classes from ``ansi.css``.
+
+    The renderer carries the graphic state across calls of
+    :py:meth:`render`, whose output is always a self-contained html
+    fragment: every ``<span>`` opened is closed before returning. The
+    state can be serialized with :py:meth:`get_state` and given back
+    to the constructor so that rendering can resume anywhere.
+    """
+
+    def __init__(self, state=''):
+        self.reset()
+        self.apply(state)
+
+    def reset(self):
+        self.attributes = set()
+        self.inverse = False
+        self.foreground = None
+        self.background = None
+
+    def get_state(self):
+        """returns the SGR parameters that reproduce the current state"""
+        codes = sorted(self.attributes)
+        if self.inverse:
+            codes.append('7')
+
+        for color in (self.foreground, self.background):
+            if color:
+                codes.append(color.replace('-', ';5;'))
+
+        return ';'.join(codes)
+
+    def get_classes(self):
+        classes = ['ansi{0}'.format(code) for code in sorted(self.attributes)]
+        prefix = self.inverse and 'inv' or 'ansi'
+        if self.foreground:
+            classes.append(prefix + self.foreground)
+        elif self.inverse:
+            classes.append('inv_background')
+
+        if self.background:
+            classes.append(prefix + self.background)
+        elif self.inverse:
+            classes.append('inv_foreground')
+
+        return ' '.join(classes)
+
+    def apply(self, parameters):
+        codes = [code or '0' for code in parameters.split(';')]
+        while codes:
+            code = codes.pop(0)
+            number = int(code) if code.isdigit() else -1
+            if code == '0' or number == 0:
+                self.reset()
+            elif code in ANSI_ATTRIBUTES:
+                self.attributes.add(code)
+            elif code in ANSI_RESETS:
+                self.attributes.difference_update(ANSI_RESETS[code])
+            elif code == '7':
+                self.inverse = True
+            elif code == '27':
+                self.inverse = False
+            elif 30 <= number <= 37:
+                self.foreground = code
+            elif 40 <= number <= 47:
+                self.background = code
+            elif 90 <= number <= 97:
+                self.foreground = '38-{0}'.format(number - 82)
+            elif 100 <= number <= 107:
+                self.background = '48-{0}'.format(number - 92)
+            elif code == '39':
+                self.foreground = None
+            elif code == '49':
+                self.background = None
+            elif code in ('38', '48') and codes:
+                mode = codes.pop(0)
+                if mode == '5' and codes:
+                    color = '{0}-{1}'.format(code, int(codes.pop(0) or 0))
+                    if code == '38':
+                        self.foreground = color
+                    else:
+                        self.background = color
+                elif mode == '2':
+                    # true color is not supported by ansi.css
+                    del codes[:3]
+
+    def wrap(self, text):
+        if not text:
+            return ''
+
+        classes = self.get_classes()
+        html = escape_html(text)
+        if not classes:
+            return html
+
+        return '<span class="{0}">{1}</span>'.format(classes, html)
+
+    def render(self, text):
+        """returns the html of the given text, an escape sequence cut
+        at the end is discarded so callers should hold it back with
+        :py:func:`split_ansi_boundary` until the rest of it arrives.
+        """
+        text, partial = split_ansi_boundary(text)
+        parts = []
+        position = 0
+        for found in CSI_REGEX.finditer(text):
+            parts.append(self.wrap(
+                OTHER_ESCAPE_REGEX.sub('', text[position:found.start()])))
+            parameters, command = found.groups()
+            if command == 'm':
+                self.apply(parameters)
+
+            position = found.end()
+
+        parts.append(self.wrap(OTHER_ESCAPE_REGEX.sub('', text[position:])))
+        return ''.join(parts)
+
+
+def render_ansi(text, state=''):
+    """renders the given text and returns a tuple with the html and
+    the state to be used to render whatever comes after it.
+    """
+    renderer = AnsiRenderer(state)
+    html = renderer.render(text)
+    return html, renderer.get_state()
@@ -17,8 +17,10 @@ from carpentry.models import User
 class TokenAuthority(object):
     regex = re.compile(r'Bearer:?\s+(.*)\s*')
 
-    def __init__(self, headers):
+    def __init__(self, headers, cookies=None):
         self.bearer = headers.get('Authorization')
+        # only given by @authenticated_by_cookie, see below
+        self.cookie_token = (cookies or {}).get('carpentry_token')
 
     def parse_bearer_string(self, bearer):
         found = self.regex.search(bearer)
@@ -26,6 +28,9 @@ class TokenAuthority(object):
             return found.group(1)
 
     def get_token_string(self):
+        if not self.bearer and self.cookie_token:
+            return self.cookie_token
+
         if not self.bearer:
             logging.info("Missing `Authorization` header %s", request.headers)
             return abort(401)
@@ -35,12 +40,21 @@ class TokenAuthority(object):
         string = self.get_token_string()
         return string
 
+    def get_cached_user(self, token):
+        # the server already resolves the user of the carpentry_token
+        # cookie before every request, which is usually the same token
+        user = getattr(g, 'user', None)
+        if user and bytes(user.carpentry_token) == bytes(token):
+            return user
+
+        return User.from_cached_token(token)
+
     def get_user(self):
         token = self.get_token()
         if not token:
             return abort(401)
 
-        g.user = result = User.from_carpentry_token(token)
+        g.user = result = self.get_cached_user(token)
         if not g.user:
             logging.debug(
                 "could not find a User in the database for the token %s, maybe the user was deleted :(", token)
@@ -59,10 +73,11 @@ class TokenAuthority(object):
         return result
 
 
-def authenticated(resource):
+def authenticated(resource, allow_cookie=False):
     @wraps(resource)
     def decorator(*args, **kw):
-        auth = TokenAuthority(request.headers)
+        cookies = allow_cookie and request.cookies or None
+        auth = TokenAuthority(request.headers, cookies)
         user = auth.get_user()
         kw['user'] = user
         return resource(*args, **kw)
@@ -70,6 +85,14 @@ def authenticated(resource):
     return decorator
 
 
+def authenticated_by_cookie(resource):
+    """like :py:func:`authenticated` but falls back to the
+    carpentry_token cookie, only meant for GET endpoints read by
+    EventSource, which cannot send custom headers. Anything else would
+    be open to cross-site requests."""
+    return authenticated(resource, allow_cookie=True)
+
+
 def ensure_json_request(spec, fallback={}):
     data = request.get_json(silent=True) or fallback
     result = {}
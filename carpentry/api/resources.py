@@ -3,39 +3,48 @@
 #
 
 from __future__ import unicode_literals
+import os
+import time
 import types
 import uuid
+import urllib
 import logging
 import inspect
 
-from flask import request
+from flask import request, Response, stream_with_context
+from werkzeug.wsgi import wrap_file
 from tumbler import json_response
 from Crypto.PublicKey import RSA
 from carpentry import conf
 from carpentry.api.core import (
     authenticated,
+    authenticated_by_cookie,
     ensure_json_request
 )
-from carpentry.models import CarpentryBaseActiveRecord
+from carpentry.models import CarpentryBaseActiveRecord, BUILD_VIEWS
+from carpentry.models import parse_page_cursor
 from carpentry.util import get_docker_client
+from carpentry.logs import get_log_store, split_utf8_boundary
+from carpentry.logs import LOG_CHUNK_SIZE
+from carpentry.logs import parse_log_cursor
+from carpentry.ansi import render_ansi
+from carpentry.jobs import BackgroundJob, get_job
+from carpentry.streaming import BuildEventStream
 
 from carpentry import models
 
 from carpentry.api import web
-from ansi2html import Ansi2HTMLConverter
-from repocket import configure
-
-
-pool = configure.connection_pool(
-    hostname='localhost',
-    port=6379
-)
-
-connection = pool.get_connection()
-
-conv = Ansi2HTMLConverter()
 
 TIMEOUT_BEFORE_SIGKILL = 5  # seconds
+LOG_READ_LIMIT = 512 * 1024  # bytes
+LINES_READ_LIMIT = 10000
+SEARCH_RESULTS_LIMIT = 100
+SEARCH_CONTEXT_LIMIT = 20
+BUILDS_PAGE_SIZE = 50
+BUILDERS_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# builders with more builds than this are cleared in the background
+BACKGROUND_DELETE_THRESHOLD = 1000
 
 
 def is_model(v):
@@ -76,6 +85,236 @@ def get_build(user, id):
     return json_response(data)
 
 
+@web.get('/api/build/<id>/metrics')
+@authenticated
+def get_build_metrics(user, id):
+    transitions = models.get_build_transitions(id)
+    if not transitions:
+        return json_response({'error': 'build not found'}, status=404)
+
+    return json_response({
+        'transitions': transitions,
+        'metrics': models.get_build_metrics(transitions),
+    })
+
+
+def parse_line_range(value):
+    """parses ``first:last`` (1-based and inclusive) in a tuple, both
+    are optional and at most ``LINES_READ_LIMIT`` lines are read"""
+    first, _, last = value.partition(':')
+    first = max(int(first or 1), 1)
+    last = int(last) if last else first + LINES_READ_LIMIT - 1
+    if last < first:
+        raise ValueError('invalid line range: {0}'.format(value))
+
+    return first, min(last, first + LINES_READ_LIMIT - 1)
+
+
+def get_build_log_lines(store, lines, as_html):
+    try:
+        first_line, last_line = parse_line_range(lines)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+
+    data, offset, next_offset = store.read_lines(first_line, last_line)
+    text = data.decode('utf-8', 'replace')
+    total = len(text.splitlines())
+    result = {
+        'first_line': first_line,
+        'last_line': total and first_line + total - 1 or None,
+        'total_lines': store.get_metadata()['lines'],
+        'offset': offset,
+        'next_offset': next_offset,
+    }
+    if as_html:
+        # the ansi state of the previous lines is unknown
+        result['html'], result['state'] = render_ansi(text)
+    else:
+        result['data'] = text
+
+    return json_response(result)
+
+
+@web.get('/api/build/<id>/log')
+@authenticated
+def get_build_log(user, id):
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(request.args.get('limit', LOG_READ_LIMIT, type=int),
+                LOG_READ_LIMIT)
+
+    as_html = request.args.get('format') == 'html'
+
+    store = get_log_store(id)
+    lines = request.args.get('lines')
+    if lines:
+        return get_build_log_lines(store, lines, as_html)
+
+    if as_html:
+        html, next_offset, eof, state = store.read_html(
+            offset, limit, request.args.get('state', ''))
+        result = {'html': html, 'state': state}
+    else:
+        data, next_offset, eof = store.read(offset, limit)
+        if not eof:
+            # never send half of a multi-byte character, the rest of it
+            # comes in the next read
+            data, remainder = split_utf8_boundary(data)
+            next_offset -= len(remainder)
+
+        result = {'data': data.decode('utf-8', 'replace')}
+
+    if not next_offset and not eof:
+        legacy_size = models.get_legacy_log_size(id)
+        if legacy_size is None:
+            return json_response({'error': 'build not found'}, status=404)
+
+        # builds created before the chunked log storage
+        build = legacy_size and models.Build.objects.get(id=id)
+        if build and build.stdout and build.status in models.FINISHED_STATUSES:
+            offset, next_offset, eof = 0, len(build.stdout), True
+            if as_html:
+                html, state = render_ansi(build.stdout)
+                result = {'html': html, 'state': state}
+            else:
+                result = {'data': build.stdout}
+
+    result.update({
+        'offset': offset,
+        'next_offset': next_offset,
+        'eof': eof,
+    })
+    return json_response(result)
+
+
+@web.get('/api/build/<id>/log/search')
+@authenticated
+def search_build_log(user, id):
+    query = request.args.get('q', '')
+    if not query:
+        return json_response({'error': 'missing the query parameter "q"'},
+                             status=400)
+
+    context = min(request.args.get('context', 2, type=int),
+                  SEARCH_CONTEXT_LIMIT)
+    limit = min(request.args.get('limit', SEARCH_RESULTS_LIMIT, type=int),
+                SEARCH_RESULTS_LIMIT)
+
+    store = get_log_store(id)
+    return json_response({
+        'query': query,
+        'matches': store.search(query, max(context, 0), limit),
+        'total_lines': store.get_metadata()['lines'],
+    })
+
+
+@web.get('/api/build/<id>/log/markers')
+@authenticated
+def get_build_log_markers(user, id):
+    store = get_log_store(id)
+    return json_response({
+        'markers': store.get_markers(),
+        'total_lines': store.get_metadata()['lines'],
+    })
+
+
+def read_file_range(fd, length):
+    try:
+        while length > 0:
+            data = fd.read(min(LOG_CHUNK_SIZE, length))
+            if not data:
+                break
+
+            length -= len(data)
+            yield data
+    finally:
+        fd.close()
+
+
+def send_log_file(path, headers):
+    """sends a log file using the ``wsgi.file_wrapper`` of the server,
+    which uses ``sendfile``, and supports single range requests."""
+    fd = open(path, 'rb')
+    size = os.fstat(fd.fileno()).st_size
+    headers = dict(headers, **{'Accept-Ranges': 'bytes'})
+
+    byte_range = request.range and request.range.range_for_length(size)
+    if request.range and not byte_range:
+        fd.close()
+        return Response(status=416, headers={
+            'Content-Range': 'bytes */{0}'.format(size),
+        })
+
+    if not byte_range:
+        headers['Content-Length'] = bytes(size)
+        body = wrap_file(request.environ, fd, LOG_CHUNK_SIZE)
+        return Response(body, headers=headers, direct_passthrough=True)
+
+    start, stop = byte_range
+    fd.seek(start)
+    headers['Content-Length'] = bytes(stop - start)
+    headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+        start, stop - 1, size)
+    return Response(read_file_range(fd, stop - start),
+                    status=206, headers=headers, direct_passthrough=True)
+
+
+@web.get('/api/build/<id>/log.txt')
+@authenticated
+def download_build_log(user, id):
+    store = get_log_store(id)
+    metadata = store.get_metadata()
+    headers = {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Vary': 'Accept-Encoding',
+    }
+
+    if not metadata['size']:
+        legacy_size = models.get_legacy_log_size(id)
+        if legacy_size is None:
+            return json_response({'error': 'build not found'}, status=404)
+
+        # builds created before the chunked log storage
+        build = legacy_size and models.Build.objects.get(id=id)
+        return Response(build and build.stdout or '', headers=headers)
+
+    path = store.get_file_path()
+    if path:
+        return send_log_file(path, headers)
+
+    accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if metadata['encoding'] == 'gzip' and accepts_gzip:
+        # the stored chunks are gzip members, sent without recompressing
+        headers['Content-Encoding'] = 'gzip'
+        chunks = store.iter_chunks(decode=False)
+    else:
+        chunks = store.iter_chunks()
+
+    return Response(stream_with_context(chunks), headers=headers)
+
+
+@web.get('/api/build/<id>/events')
+@authenticated_by_cookie
+def stream_build_events(user, id):
+    try:
+        b = models.Build.objects.get(id=id)
+    except Exception as e:
+        return json_response({'error': str(e)}, status=404)
+
+    try:
+        offset, state = parse_log_cursor(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        offset = request.args.get('offset', 0, type=int)
+        state = request.args.get('state', '')
+
+    events = BuildEventStream(b, offset, state)
+    return Response(stream_with_context(events), headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        # tells nginx not to buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @web.post('/api/builder')
 @authenticated
 def create_builder(user):
@@ -87,7 +326,14 @@ def create_builder(user):
         'id_rsa_private': any,
         'generate_ssh_keys': bool,
         'id_rsa_public': any,
+        'retention_max_builds': any,
+        'retention_max_age_in_days': any,
     })
+    for name in ('retention_max_builds', 'retention_max_age_in_days'):
+        # falls back to the defaults from the config
+        if data.get(name) is None:
+            data.pop(name, None)
+
     data['id'] = uuid.uuid1()
     data['creator'] = user
     data['status'] = 'ready'
@@ -122,27 +368,75 @@ def retrieve_builder(user, id):
 @authenticated
 def clear_builds(user, id):
     builder = models.Builder.objects.get(id=id)
-    deleted_builds = builder.clear_builds()
-    if not deleted_builds:
-        return json_response({'total': 0})
-
-    builder.status = 'ready'
-    builder.save()
-    total = len(deleted_builds)
-    logging.info("Deleted {0} builds of commits {2}:\n{1}".format(
-        total,
-        "\n".join(filter(bool, [b.commit for b in deleted_builds if b])),
-        builder.git_uri
-    ))
+    total = builder.count_builds()
+    if total > BACKGROUND_DELETE_THRESHOLD:
+        job = BackgroundJob(
+            'clear_builds', total, lambda progress: reset_builder(
+                builder, builder.clear_builds(progress)))
+        return json_response({
+            'total': total,
+            'job': job.start().to_dictionary(),
+        }, status=202)
+
+    total = reset_builder(builder, builder.clear_builds())
     return json_response({'total': total})
 
 
+def reset_builder(builder, deleted_builds):
+    if deleted_builds:
+        builder.status = 'ready'
+        builder.save()
+        # saving leaves the status of the summary to the transitions,
+        # but there are no builds left to transition
+        builder.write_summary(fields=['status'])
+        logger.info('deleted %s builds of %s', deleted_builds,
+                    builder.git_uri)
+
+    return deleted_builds
+
+
+def get_page_arguments(default_limit):
+    """returns the limit and the cursor of a paginated request, raises
+    ValueError when the cursor is invalid"""
+    limit = request.args.get('limit', default_limit, type=int)
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        parse_page_cursor(cursor)
+
+    return max(1, min(limit, MAX_PAGE_SIZE)), cursor
+
+
+def paginated_json_response(items, limit, next_cursor, **params):
+    """responds with a page of items and links to the next one with
+    the same ``params``"""
+    response = json_response(items)
+    if next_cursor:
+        query = urllib.urlencode(sorted(params.items()) + [
+            ('limit', limit), ('cursor', next_cursor)])
+        response.headers['Link'] = '<{0}?{1}>; rel="next"'.format(
+            request.base_url, query)
+
+    return response
+
+
 @web.get('/api/builder/<id>/builds')
 @authenticated
 def builds_from_builder(user, id):
+    view = request.args.get('view', 'summary')
+    if view not in BUILD_VIEWS:
+        return json_response({
+            'error': 'invalid view, options: {0}'.format(
+                ', '.join(BUILD_VIEWS)),
+        }, status=400)
+
+    try:
+        limit, cursor = get_page_arguments(BUILDS_PAGE_SIZE)
+    except ValueError:
+        return json_response({'error': 'invalid cursor'}, status=400)
+
     builder = models.Builder.objects.get(id=id)
-    items = builder.get_all_builds()
-    return json_response([item.to_dictionary() for item in items])
+    items, next_cursor = builder.get_builds_page(limit, cursor, view)
+    return paginated_json_response(items, limit, next_cursor, view=view)
 
 
 @web.put('/api/builder/<id>')
@@ -155,10 +449,13 @@ def edit_builder(user, id):
         'json_instructions': any,
         'id_rsa_public': any,
         'id_rsa_private': any,
+        'retention_max_builds': any,
+        'retention_max_age_in_days': any,
     })
     item = models.Builder.objects.get(id=id)
     for attr, value in data.items():
-        if value:
+        # 0 disables a retention limit
+        if value or value == 0:
             item.set(attr, value)
 
     item.save()
@@ -174,12 +471,35 @@ def edit_builder(user, id):
 @authenticated
 def remove_builder(user, id):
     item = models.Builder.objects.get(id=id)
-    item.clear_builds()
     item.cleanup_github_hooks(user.github_access_token)
+    result = item.to_list_dictionary(None)
 
-    item.delete()
-    logger.info('deleting builder: %s', item.name)
-    return json_response(item.to_dictionary())
+    total = item.count_builds()
+    if total > BACKGROUND_DELETE_THRESHOLD:
+        # the builder goes last so that a failed job can be retried
+        job = BackgroundJob('remove_builder', total,
+                            lambda progress: delete_builder(item, progress))
+        result['job'] = job.start().to_dictionary()
+        return json_response(result, status=202)
+
+    delete_builder(item)
+    return json_response(result)
+
+
+def delete_builder(builder, progress=None):
+    builder.clear_builds(progress)
+    builder.delete()
+    logger.info('deleting builder: %s', builder.name)
+
+
+@web.get('/api/jobs/<id>')
+@authenticated
+def get_background_job(user, id):
+    job = get_job(id)
+    if not job:
+        return json_response({'error': 'job not found'}, status=404)
+
+    return json_response(job)
 
 
 @web.delete('/api/build/<id>')
@@ -194,8 +514,16 @@ def remove_build(user, id):
 @web.get('/api/builders')
 @authenticated
 def list_builders(user):
-    items = [b.to_dictionary() for b in models.Builder.objects.all()]
-    return json_response(items)
+    try:
+        limit, cursor = get_page_arguments(BUILDERS_PAGE_SIZE)
+    except ValueError:
+        return json_response({'error': 'invalid cursor'}, status=400)
+
+    builders, next_cursor = models.get_builder_summaries_page(limit, cursor)
+    summaries = models.get_last_build_summaries([b.id for b in builders])
+    items = [builder.to_dictionary(summary)
+             for builder, summary in zip(builders, summaries)]
+    return paginated_json_response(items, limit, next_cursor)
 
 
 @web.post('/api/preferences')
@@ -254,7 +582,13 @@ def create_build(user, id):
 @web.get('/api/user')
 @authenticated
 def get_user(user):
-    return json_response(user.get_github_metadata(), status=200)
+    # the authenticated user comes from the principal cache, only the
+    # stored record is updated
+    record = models.User.objects.get(id=user.id)
+    if not record:
+        return json_response({'error': 'user not found'}, status=404)
+
+    return json_response(record.get_github_metadata(), status=200)
 
 
 @web.post('/api/hooks/<id>')
@@ -344,5 +678,12 @@ def remove_image(user, image_id):
 @web.get('/api/github/repos')
 @authenticated
 def get_github_repos(user):
-    results = user.retrieve_and_cache_github_repositories()
-    return json_response(results)
+    repos, refreshed_at = user.get_cached_github_repositories()
+    if repos is None:
+        # nothing to show until the first sync
+        return json_response(user.retrieve_and_cache_github_repositories())
+
+    if time.time() - refreshed_at > conf.github_repos_refresh_interval_in_seconds:
+        user.refresh_github_repositories_in_background()
+
+    return json_response(repos)
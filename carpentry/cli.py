@@ -13,12 +13,14 @@ import warnings
 import coloredlogs
 
 from plant import Node
-from lineup import JSONRedisBackend
 from carpentry.version import version
 from carpentry import routes
 from carpentry import conf
+from carpentry.db import CarpentryRedisBackend
 from carpentry.server import CarpentryHttpServer, setup_logging
 from carpentry.api.resources import get_models
+from carpentry.models import reindex_builds, reindex_users
+from carpentry.reaper import BuildReaper
 from carpentry.workers.pipelines import RunBuilder
 
 this_node = Node(__file__).dir
@@ -138,17 +140,19 @@ def carpentry_run_local_pipeline():
     parser.parse_args(get_remaining_sys_argv())
 
     print LOGO
-    pipeline = RunBuilder(JSONRedisBackend)
+    pipeline = RunBuilder(CarpentryRedisBackend)
 
     coloredlogs.install(level=logging.INFO)
     setup_logging(logging.INFO)
 
     pipeline.run_daemon()
+    reaper = BuildReaper().start()
     try:
         while pipeline.started:
             time.sleep(0.1)
 
     except KeyboardInterrupt:
+        reaper.stop()
         pipeline.stop()
 
 
@@ -160,17 +164,33 @@ def carpentry_setup():
     coloredlogs.install(logging.INFO)
 
     print LOGO
-    pipeline = RunBuilder(JSONRedisBackend)
+    pipeline = RunBuilder(CarpentryRedisBackend)
     backend = pipeline.get_backend()
     backend.redis.flushall()
 
 
+def carpentry_reindex():
+    parser = argparse.ArgumentParser(
+        prog='carpentry reindex',
+        description='rebuilds the indexes of users, builders and builds')
+
+    parser.parse_args(get_remaining_sys_argv())
+    setup_logging(logging.INFO)
+
+    total = reindex_users()
+    print 'indexed {0} users'.format(total)
+
+    total = reindex_builds()
+    print 'indexed {0} builds'.format(total)
+
+
 def main():
     HANDLERS = {
         'static': carpentry_static,
         'version': carpentry_version,
         'run': carpentry_run,
         'setup': carpentry_setup,
+        'reindex': carpentry_reindex,
         'workers': carpentry_run_local_pipeline,
     }
 
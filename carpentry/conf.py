@@ -31,6 +31,10 @@ def set_things(self, env):
     self.redis_host = env.get('redis_host', 'localhost')
     self.redis_port = env.get_int('redis_port', 6379)
     self.redis_db = env.get_int('redis_db', 0)
+    # connections per process, threads wait for one when all are busy
+    self.redis_max_connections = env.get_int('redis_max_connections', 50)
+    self.redis_pool_timeout_in_seconds = env.get_int(
+        'redis_pool_timeout_in_seconds', 20)
 
     self.workdir = env.get('workdir', DEFAULT_WORKDIR)
     self.full_server_url = env.get('full_server_url')
@@ -40,6 +44,9 @@ def set_things(self, env):
     self.workdir_node = Node(self.workdir)
     self.build_node = self.workdir_node.cd('builds')
     self.ssh_keys_node = self.workdir_node.cd('ssh-keys')
+    self.logs_node = self.workdir_node.cd('logs')
+    # where finished build logs are kept: "redis" or "filesystem"
+    self.log_storage = env.get('log_storage', 'redis')
     self.GITHUB_CLIENT_ID = env.get('github_client_id')
     self.GITHUB_CLIENT_SECRET = env.get('github_client_secret')
     self.allowed_github_organizations = env.get(
@@ -49,6 +56,35 @@ def set_things(self, env):
     self.default_subprocess_timeout_in_seconds = env.get(
         'default_subprocess_timeout_in_seconds', 300 * 5)
 
+    # how many builds and for how many days builds are kept by
+    # default, 0 keeps them forever
+    self.default_retention_max_builds = env.get_int(
+        'default_retention_max_builds', 0)
+    self.default_retention_max_age_in_days = env.get_int(
+        'default_retention_max_age_in_days', 0)
+    self.retention_interval_in_seconds = env.get_int(
+        'retention_interval_in_seconds', 15 * 60)
+
+    # every request to the github api times out, the connections to it
+    # are kept alive and the failed ones retried
+    self.github_timeout_in_seconds = env.get_int(
+        'github_timeout_in_seconds', 10)
+    self.github_pool_size = env.get_int('github_pool_size', 10)
+    self.github_max_retries = env.get_int('github_max_retries', 3)
+    # how many pages of repositories are fetched at once and how
+    # often they are synced again
+    self.github_sync_concurrency = env.get_int('github_sync_concurrency', 4)
+    self.github_repos_refresh_interval_in_seconds = env.get_int(
+        'github_repos_refresh_interval_in_seconds', 5 * 60)
+    # how long unused responses are kept to revalidate with their etag
+    self.github_cache_ttl_in_seconds = env.get_int(
+        'github_cache_ttl_in_seconds', 24 * 60 * 60)
+
+    # how long the organizations of a logged in user are trusted
+    # before asking github again
+    self.principal_cache_ttl_in_seconds = env.get_int(
+        'principal_cache_ttl_in_seconds', 5 * 60)
+
     self.git_executable_path = env.get('git_executable_path', '/usr/bin/git')
     self.ssh_executable_path = env.get('ssh_executable_path', '/usr/bin/ssh')
 
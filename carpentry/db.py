@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import threading
+
+from contextlib import contextmanager
+
+from redis import StrictRedis, BlockingConnectionPool
+from repocket import configure
+from lineup import JSONRedisBackend
+from carpentry import conf
+
+
+# used by repocket to load and save the models
+redis_pool = configure.connection_pool(
+    hostname=conf.redis_host,
+    port=conf.redis_port,
+    db=conf.redis_db
+)
+
+POOL = {}
+POOL_LOCK = threading.Lock()
+
+
+def get_connection_pool():
+    """returns the connection pool shared by every thread of this
+    process. A forked process gets a pool of its own instead of the
+    sockets of its parent."""
+    pid = os.getpid()
+    if POOL.get('pid') != pid:
+        with POOL_LOCK:
+            if POOL.get('pid') != pid:
+                POOL['pool'] = BlockingConnectionPool(
+                    host=conf.redis_host,
+                    port=conf.redis_port,
+                    db=conf.redis_db,
+                    max_connections=conf.redis_max_connections,
+                    timeout=conf.redis_pool_timeout_in_seconds,
+                )
+                POOL['pid'] = pid
+
+    return POOL['pool']
+
+
+def get_connection():
+    return StrictRedis(connection_pool=get_connection_pool())
+
+
+@contextmanager
+def redis_pipeline(transaction=False):
+    """yields a pipeline that is executed when the block ends without
+    errors, so that multi-key writes cost a single round trip"""
+    pipeline = get_connection().pipeline(transaction=transaction)
+    yield pipeline
+    pipeline.execute()
+
+
+def run_in_transaction(function, *keys):
+    """calls ``function`` with a pipeline watching the given keys and
+    retries when any of them changes before it is executed, see
+    :py:meth:`redis.StrictRedis.transaction`"""
+    return get_connection().transaction(
+        function, *keys, value_from_callable=True)
+
+
+class CarpentryRedisBackend(JSONRedisBackend):
+
+    """the lineup backend of the build pipelines, using the connection
+    pool of carpentry instead of a connection of its own"""
+
+    def __init__(self, *args, **kw):
+        super(CarpentryRedisBackend, self).__init__(*args, **kw)
+        self.redis = get_connection()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import json
+import time
+import logging
+import threading
+
+from carpentry.db import get_connection
+
+logger = logging.getLogger('carpentry.events')
+
+BUILD_EVENT_TYPES = [
+    'log',            # new bytes appended to the build output
+    'status',         # the build status changed
+    'docker_status',  # progress reported by the docker api
+]
+
+# how long the reader waits for a message before looking for new
+# subscriptions, which is also how long a new subscription can take
+READ_TIMEOUT = 0.1  # seconds
+SUBSCRIBE_TIMEOUT = 5  # seconds
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 30  # seconds
+
+
+def get_build_channel(build_id):
+    return 'carpentry:build:{0}:events'.format(build_id)
+
+
+def parse_build_channel(channel):
+    return channel.split(':')[2]
+
+
+def serialize_build_event(build_id, event, payload):
+    data = dict(payload)
+    data['event'] = event
+    data['build_id'] = bytes(build_id)
+    return json.dumps(data)
+
+
+def publish_build_event(build_id, event, payload, connection=None):
+    """publishes an event about the given build to its redis channel.
+    ``connection`` can be a pipeline, in which case the caller is
+    responsible for executing it.
+    """
+    if event not in BUILD_EVENT_TYPES:
+        raise ValueError('invalid build event: {0}'.format(event))
+
+    connection = connection or get_connection()
+    message = serialize_build_event(build_id, event, payload)
+    return connection.publish(get_build_channel(build_id), message)
+
+
+class BuildEventsHub(object):
+
+    """keeps a single redis subscription per build that has at least
+    one listener in this process and calls every listener of that
+    build with the deserialized events.
+
+    The pubsub connection is only used by the reader thread, which
+    subscribes to the channels of the builds being watched before
+    reading each message and reconnects with a growing delay when
+    redis goes away.
+    """
+
+    def __init__(self):
+        self.listeners = {}
+        self.subscribed = set()
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.pubsub = None
+        self.thread = None
+
+    def watch(self, build_id, listener, timeout=SUBSCRIBE_TIMEOUT):
+        """adds a listener to the events of the build and waits up to
+        ``timeout`` seconds for the subscription, so that callers can
+        rely on getting every event published after it returns"""
+        build_id = bytes(build_id)
+        with self.lock:
+            self.listeners.setdefault(build_id, []).append(listener)
+            self.ensure_running()
+
+            deadline = time.time() + timeout
+            while build_id not in self.subscribed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning('not yet subscribed to build %s', build_id)
+                    break
+
+                self.synced.wait(remaining)
+
+    def unwatch(self, build_id, listener):
+        build_id = bytes(build_id)
+        with self.lock:
+            listeners = self.listeners.get(build_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+
+            if not listeners:
+                self.listeners.pop(build_id, None)
+
+    def get_pubsub(self):
+        if self.pubsub is None:
+            self.pubsub = get_connection().pubsub(
+                ignore_subscribe_messages=True)
+
+        return self.pubsub
+
+    def close_pubsub(self):
+        """drops the pubsub connection, the next one subscribes to
+        every build being watched again"""
+        with self.lock:
+            pubsub, self.pubsub = self.pubsub, None
+            self.subscribed = set()
+
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except Exception:
+                logger.debug('failed to close %s', pubsub)
+
+    def sync_subscriptions(self):
+        """subscribes to the builds being watched and unsubscribes from
+        the ones nobody watches anymore, only called by the reader"""
+        with self.lock:
+            wanted = set(self.listeners)
+            added = wanted.difference(self.subscribed)
+            removed = self.subscribed.difference(wanted)
+
+        pubsub = self.get_pubsub()
+        if added:
+            pubsub.subscribe(*[get_build_channel(b) for b in sorted(added)])
+
+        if removed:
+            pubsub.unsubscribe(*[get_build_channel(b) for b in sorted(removed)])
+
+        with self.lock:
+            self.subscribed = wanted
+            self.synced.notify_all()
+
+    def ensure_running(self):
+        # called with the lock held
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(
+            target=self.relay_forever,
+            name='carpentry-build-events-hub')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def relay_forever(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            with self.lock:
+                if not self.listeners and not self.subscribed:
+                    self.thread = None
+                    pubsub, self.pubsub = self.pubsub, None
+                    break
+
+            try:
+                self.sync_subscriptions()
+                message = self.pubsub.get_message(timeout=READ_TIMEOUT)
+            except Exception:
+                logger.exception(
+                    'failed to read build events from redis, '
+                    'reconnecting in %s seconds', delay)
+                self.close_pubsub()
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+
+            delay = RECONNECT_MIN_DELAY
+            if message and message['type'] == 'message':
+                self.relay(message)
+
+        if pubsub is not None:
+            pubsub.close()
+
+    def relay(self, message):
+        build_id = parse_build_channel(message['channel'])
+        try:
+            event = json.loads(message['data'])
+        except ValueError:
+            logger.warning('ignoring invalid build event %s', message)
+            return
+
+        for listener in list(self.listeners.get(build_id, [])):
+            try:
+                listener(event)
+            except Exception:
+                logger.exception('%s failed to handle %s', listener, event)
+
+
+hub = BuildEventsHub()
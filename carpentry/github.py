@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import os
+import hashlib
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from carpentry import conf
+from carpentry.db import get_connection
+
+# 429 is how github signals secondary rate limits, its Retry-After
+# header is honored by urllib3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# the response headers kept along with the cached bodies
+CACHED_HEADERS = ('ETag', 'Link', 'Content-Type')
+
+SESSION = {}
+SESSION_LOCK = threading.Lock()
+
+
+class GithubRetry(Retry):
+    """also retries the 403 responses of the github abuse rate limit,
+    after the time given in their Retry-After header. Other 403s,
+    which come without that header, are not retried"""
+
+    RETRY_AFTER_STATUS_CODES = frozenset([403, 413, 429, 503])
+
+
+def create_session():
+    """returns a session that keeps connections to github alive, at most
+    ``conf.github_pool_size`` of them, and retries failed idempotent
+    requests with exponential backoff. Once the retries run out the
+    last response is returned, so callers handle its status code as
+    usual rather than a ``RetryError``"""
+    retries = GithubRetry(
+        total=conf.github_max_retries,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=conf.github_pool_size,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """returns the session of this process, a forked process gets a
+    session of its own instead of the sockets of its parent"""
+    pid = os.getpid()
+    if SESSION.get('pid') != pid:
+        with SESSION_LOCK:
+            if SESSION.get('pid') != pid:
+                SESSION['session'] = create_session()
+                SESSION['pid'] = pid
+
+    return SESSION['session']
+
+
+def request(method, url, **kw):
+    kw.setdefault('timeout', conf.github_timeout_in_seconds)
+    return get_session().request(method, url, **kw)
+
+
+def get(url, **kw):
+    return request('GET', url, **kw)
+
+
+def post(url, **kw):
+    return request('POST', url, **kw)
+
+
+def patch(url, **kw):
+    return request('PATCH', url, **kw)
+
+
+def delete(url, **kw):
+    return request('DELETE', url, **kw)
+
+
+def get_cache_key(url, headers):
+    # responses depend on who asks, so the token is part of the key
+    identity = '{0} {1}'.format(headers.get('Authorization', ''), url)
+    digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    return 'carpentry:github:responses:{0}'.format(digest)
+
+
+def get_response_from_cache(url, cached):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = cached['body']
+    for name in CACHED_HEADERS:
+        if cached.get(name):
+            response.headers[name] = cached[name]
+
+    return response
+
+
+def get_cached(url, headers=None, **kw):
+    """like :py:func:`get` but sends the ETag of the last response to
+    the same url and user in ``If-None-Match``. A ``304 Not Modified``
+    does not count against the github rate limit and is answered with
+    the response in the cache, which is kept for
+    ``conf.github_cache_ttl_in_seconds`` since it was last used.
+    """
+    headers = dict(headers or {})
+    key = get_cache_key(url, headers)
+    connection = get_connection()
+    cached = connection.hgetall(key)
+    if cached.get('ETag'):
+        headers['If-None-Match'] = cached['ETag']
+
+    response = get(url, headers=headers, **kw)
+    if response.status_code == 304 and cached:
+        connection.expire(key, conf.github_cache_ttl_in_seconds)
+        return get_response_from_cache(url, cached)
+
+    if response.status_code == 200 and response.headers.get('ETag'):
+        entry = dict(
+            (name, response.headers[name])
+            for name in CACHED_HEADERS if response.headers.get(name))
+        entry['body'] = response.content
+        pipeline = connection.pipeline(transaction=False)
+        pipeline.delete(key)
+        pipeline.hmset(key, entry)
+        pipeline.expire(key, conf.github_cache_ttl_in_seconds)
+        pipeline.execute()
+
+    return response
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import time
+import uuid
+import logging
+import threading
+
+from carpentry.db import get_connection
+
+logger = logging.getLogger('carpentry.jobs')
+
+JOB_TTL = 24 * 60 * 60  # seconds
+
+
+def get_job_key(job_id):
+    return 'carpentry:jobs:{0}'.format(job_id)
+
+
+def get_job(job_id):
+    """returns the progress of a background job or None when it does
+    not exist or expired"""
+    data = get_connection().hgetall(get_job_key(job_id))
+    if not data:
+        return None
+
+    for name in ('total', 'done'):
+        data[name] = int(data.get(name) or 0)
+
+    data['started_at'] = float(data.get('started_at') or 0)
+    data['finished_at'] = float(data.get('finished_at') or 0) or None
+    return data
+
+
+class BackgroundJob(object):
+
+    """runs ``target`` in a daemon thread and keeps its progress in
+    redis under ``carpentry:jobs:<id>`` so that any web process can
+    report it, see :py:func:`get_job`.
+
+    ``target`` is called with a callback that takes how many of the
+    ``total`` items were just processed. Jobs expire a day after
+    they start.
+    """
+
+    def __init__(self, kind, total, target):
+        self.id = bytes(uuid.uuid4())
+        self.key = get_job_key(self.id)
+        self.kind = kind
+        self.total = total
+        self.target = target
+        self.thread = None
+
+    def __repr__(self):
+        return '<BackgroundJob {0} {1}>'.format(self.kind, self.id)
+
+    def start(self):
+        pipeline = get_connection().pipeline(transaction=False)
+        pipeline.hmset(self.key, {
+            'id': self.id,
+            'kind': self.kind,
+            'status': 'running',
+            'total': self.total,
+            'done': 0,
+            'started_at': time.time(),
+        })
+        pipeline.expire(self.key, JOB_TTL)
+        pipeline.execute()
+
+        self.thread = threading.Thread(target=self.run, name=repr(self))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def advance(self, amount):
+        get_connection().hincrby(self.key, 'done', amount)
+
+    def finish(self, status, error=None):
+        values = {'status': status, 'finished_at': time.time()}
+        if error:
+            values['error'] = error
+
+        get_connection().hmset(self.key, values)
+
+    def run(self):
+        try:
+            self.target(self.advance)
+        except Exception as e:
+            logger.exception('%s failed', self)
+            self.finish('failed', '{0}: {1}'.format(type(e).__name__, e))
+        else:
+            self.finish('succeeded')
+
+    def to_dictionary(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'total': self.total,
+            'url': '/api/jobs/{0}'.format(self.id),
+        }
@@ -0,0 +1,991 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import os
+import json
+import shutil
+import time
+import zlib
+import struct
+import logging
+import threading
+
+from carpentry import conf
+from carpentry.util import force_unicode
+from collections import deque
+
+from carpentry.ansi import AnsiRenderer, render_ansi, split_ansi_boundary
+from carpentry.ansi import strip_ansi
+from carpentry.db import get_connection
+from carpentry.events import publish_build_event
+
+logger = logging.getLogger('carpentry.logs')
+
+LOG_STREAMS = ['stdout', 'stderr']
+LOG_CHUNK_SIZE = 64 * 1024  # bytes
+LOG_BATCH_SIZE = 16  # chunks per redis round trip
+LOG_COMPRESSION_LEVEL = 6
+LINE_INDEX_INTERVAL = 1000  # lines
+LINE_INDEX_FORMAT = b'>Q'
+LINE_INDEX_ENTRY_SIZE = struct.calcsize(LINE_INDEX_FORMAT)
+
+DEFAULT_FLUSH_SIZE = 64 * 1024  # bytes
+DEFAULT_FLUSH_INTERVAL = 0.25  # seconds
+
+WRITERS = {}
+WRITERS_LOCK = threading.Lock()
+
+
+def split_utf8_boundary(data):
+    """splits the given bytes in a decodable part and the bytes of a
+    multi-byte utf-8 character that was cut in half, if any.
+    """
+    for position in range(1, min(4, len(data)) + 1):
+        byte = ord(data[-position])
+        if byte & 0xC0 == 0x80:
+            # continuation byte, keep looking for the leading byte
+            continue
+
+        if byte & 0x80 == 0:
+            break
+
+        if byte & 0xE0 == 0xC0:
+            length = 2
+        elif byte & 0xF0 == 0xE0:
+            length = 3
+        else:
+            length = 4
+
+        if position < length:
+            return data[:-position], data[-position:]
+
+        break
+
+    return data, b''
+
+
+def gzip_compress(data):
+    """returns the given bytes as a single gzip member"""
+    compressor = zlib.compressobj(
+        LOG_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def find_line_starts(data, offset, lines, interval=LINE_INDEX_INTERVAL):
+    """counts the lines of the given bytes, written at ``offset`` to a
+    log that had ``lines`` lines so far, and returns a tuple with the
+    new count of lines and the offsets where every ``interval``-th
+    line starts."""
+    total = data.count(b'\n')
+    if (lines + total) // interval == lines // interval:
+        return lines + total, []
+
+    starts = []
+    position = -1
+    for _ in range(total):
+        position = data.index(b'\n', position + 1)
+        lines += 1
+        if lines % interval == 0:
+            starts.append(offset + position + 1)
+
+    return lines, starts
+
+
+def pack_line_index(starts):
+    return b''.join(struct.pack(LINE_INDEX_FORMAT, s) for s in starts)
+
+
+def unpack_line_index(data):
+    size = LINE_INDEX_ENTRY_SIZE
+    return [
+        struct.unpack(LINE_INDEX_FORMAT, data[i:i + size])[0]
+        for i in range(0, len(data or b'') - size + 1, size)
+    ]
+
+
+def format_log_cursor(offset, state=''):
+    """returns a string that identifies a position in a log: the byte
+    offset and the ansi state at that offset, if any."""
+    if not state:
+        return '{0}'.format(offset)
+
+    return '{0}:{1}'.format(offset, state)
+
+
+def parse_log_cursor(cursor):
+    """returns the tuple ``(offset, state)`` of the given cursor and
+    raises ``ValueError`` when it is invalid."""
+    offset, _, state = (cursor or '').partition(':')
+    return int(offset), state
+
+
+class LogStore(object):
+
+    """base class of the storages of build logs"""
+
+    def get_size(self):
+        return self.get_metadata()['size']
+
+    def get_file_path(self):
+        """returns the path of a file with the whole log, if any"""
+        return None
+
+    def compress(self):
+        return False
+
+    def iter_lines(self, first_line=1):
+        """yields a tuple with the number, offset and bytes of every line
+        of the log from ``first_line`` on, line numbers start at 1.
+
+        The reading starts at the closest line in the line index so
+        that only the bytes of at most ``LINE_INDEX_INTERVAL`` lines
+        are skipped."""
+        index = self.get_line_index()
+        entry = min(max(first_line - 1, 0) // LINE_INDEX_INTERVAL, len(index) - 1)
+        number = entry * LINE_INDEX_INTERVAL + 1
+        offset = line_offset = index[entry]
+
+        pending = b''
+        while True:
+            # reads never cross a chunk, so compressed chunks are
+            # decompressed only once
+            limit = self.chunk_size - offset % self.chunk_size
+            data, offset, eof = self.read(offset, limit)
+            if not data:
+                break
+
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if number >= first_line:
+                    yield number, line_offset, line
+
+                line_offset += len(line) + 1
+                number += 1
+
+        if pending and number >= first_line:
+            yield number, line_offset, pending
+
+    def read_lines(self, first_line, last_line):
+        """returns a tuple with the bytes of the lines from
+        ``first_line`` to ``last_line`` (inclusive), the offset where
+        they start and the offset where they end."""
+        start = end = None
+        lines = []
+        for number, offset, line in self.iter_lines(first_line):
+            if number > last_line:
+                break
+
+            if start is None:
+                start = offset
+
+            lines.append(line)
+            end = offset + len(line) + 1
+
+        if start is None:
+            return b'', None, None
+
+        data = b'\n'.join(lines)
+        if end <= self.get_size():
+            data += b'\n'
+        else:
+            end -= 1
+
+        return data, start, end
+
+    def search(self, query, context=0, limit=100):
+        """returns the lines that contain ``query``, without ansi
+        escape sequences, along with ``context`` lines before and
+        after each of them."""
+        matches = []
+        collecting = []
+        before = deque(maxlen=context)
+        for number, offset, line in self.iter_lines():
+            text = strip_ansi(line.decode('utf-8', 'replace'))
+            for match in collecting:
+                match['after'].append(text)
+
+            collecting = [m for m in collecting if len(m['after']) < context]
+            if len(matches) >= limit and not collecting:
+                break
+
+            if query in text and len(matches) < limit:
+                match = {
+                    'line': number,
+                    'offset': offset,
+                    'text': text,
+                    'before': list(before),
+                    'after': [],
+                }
+                matches.append(match)
+                if context:
+                    collecting.append(match)
+
+            before.append(text)
+
+        return matches
+
+    def read_html(self, offset=0, limit=None, state=''):
+        """returns a tuple with the html of the log after ``offset``,
+        the offset to be used in the next read, whether the log is
+        complete and the ansi state to be used in the next read.
+
+        Reads from the beginning use the html cached by the writers,
+        everything else is rendered from the ``state`` given by the
+        previous read, so that only new bytes are ever rendered.
+        """
+        cached = ''
+        if not offset:
+            cached, offset, state = self.read_cached_html(limit)
+            if limit is not None:
+                limit = max(0, limit - offset)
+
+        data, next_offset, eof = self.read(offset, limit)
+        if not eof:
+            data, remainder = split_utf8_boundary(data)
+            next_offset -= len(remainder)
+
+        text = data.decode('utf-8', 'replace')
+        if not eof:
+            text, partial = split_ansi_boundary(text)
+            next_offset -= len(partial.encode('utf-8'))
+
+        html, state = render_ansi(text, state)
+        return cached + html, next_offset, eof, state
+
+
+class RedisLogStore(LogStore):
+
+    """append-only storage of build output as numbered chunks of
+    ``chunk_size`` bytes, so that reading from any byte offset only
+    touches the chunks that contain the requested bytes.
+
+    keys:
+
+    * ``carpentry:logs:<build-id>:<stream>`` hash with the ``size``
+      in bytes, the ``eof`` flag, the ``ansi_state`` at the end and
+      the ``encoding`` of the chunks once the log is compressed
+    * ``carpentry:logs:<build-id>:<stream>:chunk:<n>`` the bytes of
+      the n-th chunk
+    * ``carpentry:logs:<build-id>:<stream>:html:<n>`` the rendered
+      html of the writes that started in the n-th chunk
+    * ``carpentry:logs:<build-id>:<stream>:html`` hash with the
+      cursor where the html of every chunk ends
+    * ``carpentry:logs:<build-id>:<stream>:lines`` the offsets where
+      every ``LINE_INDEX_INTERVAL``-th line starts, packed as 64 bits
+      unsigned integers
+    * ``carpentry:logs:<build-id>:<stream>:markers`` list with the
+      sections of the log, as json
+
+    Complete logs are compressed with :py:meth:`compress`, every
+    chunk becomes a gzip member stored with a ``.gz`` suffix and since
+    concatenated gzip members are a valid gzip stream they can be sent
+    to browsers as they are.
+    """
+
+    def __init__(self, build_id, stream='stdout', chunk_size=LOG_CHUNK_SIZE):
+        self.build_id = bytes(build_id)
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.key = 'carpentry:logs:{0}:{1}'.format(self.build_id, stream)
+        self.html_key = '{0}:html'.format(self.key)
+        self.lines_key = '{0}:lines'.format(self.key)
+        self.markers_key = '{0}:markers'.format(self.key)
+
+    def __repr__(self):
+        return '<RedisLogStore {0}>'.format(self.key)
+
+    def get_chunk_key(self, index, encoding=None):
+        key = '{0}:chunk:{1}'.format(self.key, index)
+        return encoding and '{0}.gz'.format(key) or key
+
+    def get_html_chunk_key(self, index, encoding=None):
+        key = '{0}:{1}'.format(self.html_key, index)
+        return encoding and '{0}.gz'.format(key) or key
+
+    def get_total_chunks(self, size):
+        return (size + self.chunk_size - 1) // self.chunk_size
+
+    def get_metadata(self):
+        metadata = get_connection().hgetall(self.key) or {}
+        return {
+            'size': int(metadata.get('size') or 0),
+            'eof': metadata.get('eof') == '1',
+            'ansi_state': metadata.get('ansi_state'),
+            'encoding': metadata.get('encoding') or None,
+            'lines': int(metadata.get('lines') or 0),
+        }
+
+    def write(self, offset, data, pipeline=None):
+        """appends ``data`` at the given byte offset and returns the
+        new size of the log. When a ``pipeline`` is given the caller
+        is responsible for executing it.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        pipe = pipeline or get_connection().pipeline(transaction=False)
+        position = offset
+        written = 0
+        while written < len(data):
+            index, chunk_offset = divmod(position, self.chunk_size)
+            piece = data[written:written + self.chunk_size - chunk_offset]
+            pipe.append(self.get_chunk_key(index), piece)
+            position += len(piece)
+            written += len(piece)
+
+        pipe.hset(self.key, 'size', position)
+        if pipeline is None:
+            pipe.execute()
+
+        return position
+
+    def read(self, offset=0, limit=None):
+        """returns a tuple with the bytes after ``offset``, the offset
+        to be used in the next read and whether the log is complete.
+        """
+        metadata = self.get_metadata()
+        size = metadata['size']
+        offset = max(0, min(int(offset), size))
+        end = size if limit is None else min(size, offset + int(limit))
+
+        if end <= offset:
+            return b'', offset, metadata['eof'] and offset >= size
+
+        first = offset // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        ranges = []
+        for index in range(first, last + 1):
+            base = index * self.chunk_size
+            start = offset - base if index == first else 0
+            stop = end - base - 1 if index == last else self.chunk_size - 1
+            ranges.append((index, start, stop))
+
+        encoding = metadata['encoding']
+        pipe = get_connection().pipeline(transaction=False)
+        for index, start, stop in ranges:
+            if encoding:
+                pipe.get(self.get_chunk_key(index, encoding))
+            else:
+                pipe.getrange(self.get_chunk_key(index), start, stop)
+
+        pieces = pipe.execute()
+        if encoding:
+            pieces = [
+                gzip_decompress(piece)[start:stop + 1] if piece else b''
+                for piece, (index, start, stop) in zip(pieces, ranges)
+            ]
+
+        data = b''.join(pieces)
+        next_offset = offset + len(data)
+        return data, next_offset, metadata['eof'] and next_offset >= size
+
+    def write_line_index(self, lines, starts, pipeline=None):
+        """stores the count of ``lines`` and appends the offsets where
+        the next indexed lines start"""
+        pipe = pipeline or get_connection().pipeline(transaction=False)
+        if starts:
+            pipe.append(self.lines_key, pack_line_index(starts))
+
+        pipe.hset(self.key, 'lines', lines)
+        if pipeline is None:
+            pipe.execute()
+
+    def get_line_index(self):
+        return [0] + unpack_line_index(get_connection().get(self.lines_key))
+
+    def add_marker(self, marker):
+        get_connection().rpush(self.markers_key, json.dumps(marker))
+
+    def get_markers(self):
+        return [json.loads(m) for m in
+                get_connection().lrange(self.markers_key, 0, -1)]
+
+    def write_html(self, offset, next_offset, html, state, pipeline=None):
+        """caches the rendered ``html`` of the bytes between ``offset``
+        and ``next_offset`` along with the ansi ``state`` after them.
+        """
+        index = offset // self.chunk_size
+        pipe = pipeline or get_connection().pipeline(transaction=False)
+        pipe.append(self.get_html_chunk_key(index), html.encode('utf-8'))
+        pipe.hset(self.html_key, index, format_log_cursor(next_offset, state))
+        pipe.hset(self.key, 'ansi_state', state)
+        if pipeline is None:
+            pipe.execute()
+
+    def read_cached_html(self, limit=None):
+        """returns a tuple with the cached html from the beginning of
+        the log, the offset and the ansi state where it ends."""
+        pipe = get_connection().pipeline(transaction=False)
+        pipe.hgetall(self.html_key)
+        pipe.hget(self.key, 'encoding')
+        cursors, encoding = pipe.execute()
+
+        cursors = cursors or {}
+        indexes = []
+        next_offset, state = 0, ''
+        for index in sorted(int(i) for i in cursors):
+            indexes.append(index)
+            next_offset, state = parse_log_cursor(cursors[bytes(index)])
+            if limit is not None and next_offset >= limit:
+                break
+
+        if not indexes:
+            return '', 0, ''
+
+        pipe = get_connection().pipeline(transaction=False)
+        for index in indexes:
+            pipe.get(self.get_html_chunk_key(index, encoding))
+
+        parts = [part or b'' for part in pipe.execute()]
+        if encoding:
+            parts = [part and gzip_decompress(part) for part in parts]
+
+        html = b''.join(parts)
+        return html.decode('utf-8'), next_offset, state
+
+    def iter_chunks(self, decode=True):
+        """yields the chunks of the log in order, fetching
+        ``LOG_BATCH_SIZE`` chunks per round trip. Compressed chunks are
+        yielded as gzip members when ``decode`` is false."""
+        metadata = self.get_metadata()
+        encoding = metadata['encoding']
+        total_chunks = self.get_total_chunks(metadata['size'])
+        for first in range(0, total_chunks, LOG_BATCH_SIZE):
+            pipe = get_connection().pipeline(transaction=False)
+            for index in range(first, min(first + LOG_BATCH_SIZE, total_chunks)):
+                pipe.get(self.get_chunk_key(index, encoding))
+
+            for chunk in pipe.execute():
+                if chunk and encoding and decode:
+                    chunk = gzip_decompress(chunk)
+
+                if chunk:
+                    yield chunk
+
+    def iter_html_chunks(self):
+        """yields a tuple with the index of every chunk, its cached
+        html and the cursor where the html ends"""
+        pipe = get_connection().pipeline(transaction=False)
+        pipe.hgetall(self.html_key)
+        pipe.hget(self.key, 'encoding')
+        cursors, encoding = pipe.execute()
+
+        indexes = sorted(int(i) for i in (cursors or {}))
+        for first in range(0, len(indexes), LOG_BATCH_SIZE):
+            batch = indexes[first:first + LOG_BATCH_SIZE]
+            pipe = get_connection().pipeline(transaction=False)
+            for index in batch:
+                pipe.get(self.get_html_chunk_key(index, encoding))
+
+            for index, html in zip(batch, pipe.execute()):
+                if html and encoding:
+                    html = gzip_decompress(html)
+
+                yield index, html or b'', cursors[bytes(index)]
+
+    def recode(self, encoding, convert):
+        """stores every chunk of the log and of its html cache with the
+        given ``encoding`` and then switches the log to it atomically,
+        so that readers never see a mix of both."""
+        metadata = self.get_metadata()
+        current = metadata['encoding']
+        total_chunks = self.get_total_chunks(metadata['size'])
+        connection = get_connection()
+        obsolete_keys = []
+        for first in range(0, total_chunks, LOG_BATCH_SIZE):
+            keys = []
+            for index in range(first, min(first + LOG_BATCH_SIZE, total_chunks)):
+                keys.append((
+                    self.get_chunk_key(index, current),
+                    self.get_chunk_key(index, encoding)))
+                keys.append((
+                    self.get_html_chunk_key(index, current),
+                    self.get_html_chunk_key(index, encoding)))
+
+            pipe = connection.pipeline(transaction=False)
+            for source, destination in keys:
+                pipe.get(source)
+
+            values = pipe.execute()
+            pipe = connection.pipeline(transaction=False)
+            for (source, destination), value in zip(keys, values):
+                if value:
+                    pipe.set(destination, convert(value))
+                    obsolete_keys.append(source)
+
+            pipe.execute()
+
+        pipe = connection.pipeline(transaction=True)
+        if encoding:
+            pipe.hset(self.key, 'encoding', encoding)
+        else:
+            pipe.hdel(self.key, 'encoding')
+
+        if obsolete_keys:
+            pipe.delete(*obsolete_keys)
+
+        pipe.execute()
+
+    def compress(self):
+        """compresses every chunk of a complete log, returns ``False``
+        when the log is still being written or already compressed."""
+        metadata = self.get_metadata()
+        if not metadata['eof'] or metadata['encoding'] or not metadata['size']:
+            return False
+
+        self.recode('gzip', gzip_compress)
+        logger.info('%s compressed %s bytes', self, metadata['size'])
+        return True
+
+    def decompress(self):
+        """reverts :py:meth:`compress` so that more bytes can be
+        appended to the log"""
+        if self.get_metadata()['encoding']:
+            self.recode(None, gzip_decompress)
+
+    def close(self):
+        get_connection().hset(self.key, 'eof', '1')
+
+    def get_keys(self, size):
+        """returns every key that a log of the given size may use"""
+        keys = [self.key, self.html_key, self.lines_key, self.markers_key]
+        for index in range(self.get_total_chunks(size)):
+            for encoding in (None, 'gzip'):
+                keys.append(self.get_chunk_key(index, encoding))
+                keys.append(self.get_html_chunk_key(index, encoding))
+
+        return keys
+
+    def delete(self):
+        get_connection().delete(*self.get_keys(self.get_size()))
+
+
+class FileSystemLogStore(LogStore):
+
+    """storage of finished build logs in plain files, so that they do
+    not take space in redis and can be sent with ``sendfile``.
+
+    files under ``<workdir>/logs/<build-id>/``:
+
+    * ``<stream>.log`` the bytes of the log
+    * ``<stream>.html`` the rendered html of the log
+    * ``<stream>.json`` the metadata of the log, the cursors where
+      the html of every chunk ends, the line index and the markers,
+      written last so that a log only exists once all of its files
+      are complete
+    """
+
+    def __init__(self, build_id, stream='stdout', chunk_size=LOG_CHUNK_SIZE):
+        self.build_id = bytes(build_id)
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.directory = conf.logs_node.join(self.build_id)
+        self.path = self.get_path('log')
+        self.html_path = self.get_path('html')
+        self.metadata_path = self.get_path('json')
+
+    def __repr__(self):
+        return '<FileSystemLogStore {0}>'.format(self.path)
+
+    def get_path(self, extension):
+        return os.path.join(
+            self.directory, '{0}.{1}'.format(self.stream, extension))
+
+    def get_file_path(self):
+        return self.path
+
+    def exists(self):
+        return os.path.exists(self.metadata_path)
+
+    def load_metadata(self):
+        metadata = {
+            'size': 0,
+            'eof': False,
+            'ansi_state': None,
+            'encoding': None,
+            'lines': 0,
+            'html': [],
+            'line_index': [],
+            'markers': [],
+        }
+        if self.exists():
+            with open(self.metadata_path) as fd:
+                metadata.update(json.load(fd))
+
+        return metadata
+
+    def save_metadata(self, metadata):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        path = '{0}.tmp'.format(self.metadata_path)
+        with open(path, 'w') as fd:
+            json.dump(metadata, fd)
+
+        os.rename(path, self.metadata_path)
+
+    def get_metadata(self):
+        metadata = self.load_metadata()
+        for key in ('html', 'line_index', 'markers'):
+            metadata.pop(key)
+
+        return metadata
+
+    def write_line_index(self, lines, starts, pipeline=None):
+        metadata = self.load_metadata()
+        metadata['lines'] = lines
+        metadata['line_index'].extend(starts)
+        self.save_metadata(metadata)
+
+    def get_line_index(self):
+        return [0] + self.load_metadata()['line_index']
+
+    def add_marker(self, marker):
+        metadata = self.load_metadata()
+        metadata['markers'].append(marker)
+        self.save_metadata(metadata)
+
+    def get_markers(self):
+        return self.load_metadata()['markers']
+
+    def write(self, offset, data, pipeline=None):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        metadata = self.load_metadata()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with open(self.path, 'ab') as fd:
+            fd.write(data)
+
+        metadata['size'] = offset + len(data)
+        self.save_metadata(metadata)
+        return metadata['size']
+
+    def read(self, offset=0, limit=None):
+        metadata = self.get_metadata()
+        size = metadata['size']
+        offset = max(0, min(int(offset), size))
+        end = size if limit is None else min(size, offset + int(limit))
+
+        data = b''
+        if end > offset:
+            with open(self.path, 'rb') as fd:
+                fd.seek(offset)
+                data = fd.read(end - offset)
+
+        next_offset = offset + len(data)
+        return data, next_offset, metadata['eof'] and next_offset >= size
+
+    def write_html(self, offset, next_offset, html, state, pipeline=None):
+        metadata = self.load_metadata()
+        with open(self.html_path, 'ab') as fd:
+            fd.write(html.encode('utf-8'))
+            html_size = fd.tell()
+
+        index = offset // self.chunk_size
+        cursors = metadata['html']
+        if cursors and cursors[-1][0] == index:
+            cursors.pop()
+
+        cursors.append([index, format_log_cursor(next_offset, state), html_size])
+        metadata['ansi_state'] = state
+        self.save_metadata(metadata)
+
+    def read_cached_html(self, limit=None):
+        html_size, next_offset, state = 0, 0, ''
+        for index, cursor, html_size in self.load_metadata()['html']:
+            next_offset, state = parse_log_cursor(cursor)
+            if limit is not None and next_offset >= limit:
+                break
+
+        if not html_size:
+            return '', 0, ''
+
+        with open(self.html_path, 'rb') as fd:
+            html = fd.read(html_size)
+
+        return html.decode('utf-8'), next_offset, state
+
+    def iter_chunks(self, decode=True):
+        if not self.exists():
+            return
+
+        with open(self.path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(self.chunk_size), b''):
+                yield chunk
+
+    def copy_from(self, store):
+        """writes the log of the given store and its html cache to the
+        filesystem"""
+        metadata = store.get_metadata()
+        metadata['encoding'] = None
+        metadata['html'] = []
+        metadata['line_index'] = store.get_line_index()[1:]
+        metadata['markers'] = store.get_markers()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with open(self.path, 'wb') as fd:
+            for chunk in store.iter_chunks():
+                fd.write(chunk)
+
+        with open(self.html_path, 'wb') as fd:
+            for index, html, cursor in store.iter_html_chunks():
+                fd.write(html)
+                metadata['html'].append([index, cursor, fd.tell()])
+
+        self.save_metadata(metadata)
+
+    def close(self):
+        metadata = self.load_metadata()
+        metadata['eof'] = True
+        self.save_metadata(metadata)
+
+    def delete(self):
+        for path in (self.metadata_path, self.path, self.html_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        if os.path.isdir(self.directory) and not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+
+def get_log_store(build_id, stream='stdout'):
+    store = FileSystemLogStore(build_id, stream)
+    if store.exists():
+        return store
+
+    return RedisLogStore(build_id, stream)
+
+
+def delete_log_stores(build_id):
+    for stream in LOG_STREAMS:
+        RedisLogStore(build_id, stream).delete()
+        FileSystemLogStore(build_id, stream).delete()
+
+
+def delete_many_log_stores(build_ids):
+    """deletes the logs of many builds at once: one round trip to
+    redis finds out the size of every log and another deletes them"""
+    stores = [RedisLogStore(build_id, stream)
+              for build_id in build_ids for stream in LOG_STREAMS]
+
+    pipeline = get_connection().pipeline(transaction=False)
+    for store in stores:
+        pipeline.hget(store.key, 'size')
+
+    for store, size in zip(stores, pipeline.execute()):
+        pipeline.delete(*store.get_keys(int(size or 0)))
+
+    pipeline.execute()
+    for build_id in build_ids:
+        shutil.rmtree(conf.logs_node.join(build_id), ignore_errors=True)
+
+
+def spill_log_store(store):
+    """moves a complete log from redis to the filesystem and returns
+    the new store, or ``None`` when the log is still being written"""
+    metadata = store.get_metadata()
+    if not metadata['eof'] or not metadata['size']:
+        return None
+
+    destination = FileSystemLogStore(
+        store.build_id, store.stream, store.chunk_size)
+    destination.copy_from(store)
+    store.delete()
+    logger.info('%s spilled to %s', store, destination)
+    return destination
+
+
+def archive_log_store(store):
+    """keeps a complete log as configured by ``conf.log_storage``"""
+    if not isinstance(store, RedisLogStore):
+        return
+
+    if conf.log_storage == 'filesystem':
+        spill_log_store(store)
+    else:
+        store.compress()
+
+
+class BuildLogWriter(object):
+
+    """buffers the output of a build in memory and flushes it to the
+    log store in a single pipelined call once ``flush_size`` bytes
+    were buffered or ``flush_interval`` seconds went by since the last
+    flush. Every flush is also published as a ``log`` build event.
+
+    The output is rendered to html once, as it is flushed, and cached
+    in the log store. The ansi state is carried across flushes and an
+    escape sequence cut in half stays in the buffer until the rest of
+    it is written.
+    """
+
+    def __init__(self, build, stream='stdout',
+                 flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.build = build
+        self.stream = stream
+        self.store = get_log_store(build.id, stream)
+        self.offset = None
+        self.lines = 0
+        self.renderer = None
+        self.cache_html = False
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return '<BuildLogWriter {0}:{1} buffered={2}>'.format(
+            self.build.id, self.stream, self.buffered_bytes)
+
+    def write(self, string):
+        value = force_unicode(string)
+        if not value:
+            return
+
+        with self.lock:
+            self.buffer.append(value)
+            self.buffered_bytes += len(value.encode('utf-8'))
+            if self.should_flush():
+                self.flush()
+
+    def should_flush(self):
+        if self.buffered_bytes >= self.flush_size:
+            return True
+
+        elapsed = time.time() - self.last_flush
+        return elapsed >= self.flush_interval
+
+    def flush_if_due(self):
+        with self.lock:
+            if self.buffer and self.should_flush():
+                self.flush()
+
+    def load_metadata(self):
+        metadata = self.store.get_metadata()
+        if metadata.get('encoding'):
+            # output written after the build finished
+            self.store.decompress()
+
+        self.offset = metadata['size']
+        self.lines = metadata['lines']
+        self.renderer = AnsiRenderer(metadata['ansi_state'] or '')
+        # logs that were not rendered from the start cannot be cached
+        self.cache_html = (
+            not self.offset or metadata['ansi_state'] is not None)
+
+    def flush(self, final=False):
+        with self.lock:
+            self.last_flush = time.time()
+            if not self.buffer:
+                return 0
+
+            data, partial = split_ansi_boundary(''.join(self.buffer))
+            if final:
+                data, partial = data + partial, ''
+
+            self.buffer = partial and [partial] or []
+            self.buffered_bytes = len(partial.encode('utf-8'))
+            if not data:
+                return 0
+
+            if self.offset is None:
+                self.load_metadata()
+
+            html = self.renderer.render(data)
+            state = self.renderer.get_state()
+            raw = data.encode('utf-8')
+
+            offset = self.offset
+            self.lines, starts = find_line_starts(raw, offset, self.lines)
+
+            pipeline = get_connection().pipeline(transaction=False)
+            self.offset = self.store.write(offset, raw, pipeline=pipeline)
+            self.store.write_line_index(self.lines, starts, pipeline=pipeline)
+            if self.cache_html:
+                self.store.write_html(
+                    offset, self.offset, html, state, pipeline=pipeline)
+
+            publish_build_event(self.build.id, 'log', {
+                'stream': self.stream,
+                'offset': offset,
+                'next_offset': self.offset,
+                'data': data,
+                'html': html,
+                'state': state,
+            }, pipeline)
+            pipeline.execute()
+            logger.debug('%s flushed %s bytes', self, len(data))
+            return len(data)
+
+    def mark(self, label):
+        """flushes the buffer and marks the beginning of a section of
+        the log, so that it can be found without reading the log"""
+        with self.lock:
+            self.flush()
+            if self.offset is None:
+                self.load_metadata()
+
+            self.store.add_marker({
+                'label': label,
+                'line': self.lines + 1,
+                'offset': self.offset,
+            })
+
+    def close(self):
+        with self.lock:
+            self.flush(final=True)
+            self.store.close()
+
+
+def get_log_writer(build, stream='stdout'):
+    key = (bytes(build.id), stream)
+    with WRITERS_LOCK:
+        writer = WRITERS.get(key)
+        if writer is None:
+            writer = WRITERS[key] = BuildLogWriter(build, stream)
+
+    return writer
+
+
+def flush_log_writers(build):
+    build_id = bytes(build.id)
+    with WRITERS_LOCK:
+        writers = [w for (i, s), w in WRITERS.items() if i == build_id]
+
+    for writer in writers:
+        writer.flush()
+
+
+def close_log_writers(build, eof=False):
+    build_id = bytes(build.id)
+    with WRITERS_LOCK:
+        keys = [k for k in WRITERS.keys() if k[0] == build_id]
+        writers = [WRITERS.pop(k) for k in keys]
+
+    for writer in writers:
+        if eof:
+            writer.close()
+        else:
+            writer.flush()
+
+    if eof:
+        streams = set(w.stream for w in writers)
+        for stream in set(LOG_STREAMS).difference(streams):
+            get_log_store(build_id, stream).close()
+
+        for stream in LOG_STREAMS:
+            archive_log_store(get_log_store(build_id, stream))
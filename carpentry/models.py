@@ -2,21 +2,38 @@
 #
 import re
 import json
+import time
 
 import uuid
-import requests
+import calendar
 import hashlib
 import logging
+import urlparse
 import datetime
 
+from multiprocessing.pool import ThreadPool
+
 # from dateutil.parser import parse as parse_datetime
-from lineup import JSONRedisBackend
 
 from repocket import attributes
 from repocket import ActiveRecord
-from repocket import configure
 from repocket.util import is_null
 from carpentry.util import render_string, force_unicode, response_did_succeed
+from carpentry.logs import get_log_writer, flush_log_writers, close_log_writers
+from carpentry.logs import get_log_store, delete_log_stores
+from carpentry.logs import delete_many_log_stores
+from carpentry import github
+from carpentry.db import (  # noqa
+    redis_pool,
+    get_connection,
+    redis_pipeline,
+    run_in_transaction,
+    CarpentryRedisBackend,
+)
+from carpentry.events import publish_build_event
+from carpentry.jobs import BackgroundJob
+from carpentry.principals import get_principal, cache_principal
+from carpentry.principals import forget_principal, get_token_digest
 from carpentry import conf
 
 logger = logging.getLogger('carpentry.models')
@@ -32,6 +49,58 @@ BUILD_STATUSES = [
     'failed',     # finished with an error, subprocess returned status != 0
 ]
 
+FINISHED_STATUSES = [
+    'succeeded',
+    'failed',
+]
+
+# builds only move forward in BUILD_STATUSES, both finished statuses
+# are final so a build never goes from one to the other
+BUILD_STATUS_RANKS = dict(
+    (status, min(rank, BUILD_STATUSES.index(FINISHED_STATUSES[0])))
+    for rank, status in enumerate(BUILD_STATUSES))
+
+# moves a build to a new status and records the transition unless the
+# build already reached that status or a later one, see
+# transition_build_status() for the keys and arguments
+BUILD_TRANSITION_SCRIPT = '''
+local ranks = cjson.decode(ARGV[1])
+local status = ARGV[2]
+local last = redis.call('LINDEX', KEYS[1], -1)
+if last then
+    local current = cjson.decode(last)['status']
+    if (ranks[current] or -1) >= ranks[status] then
+        return {0, current}
+    end
+end
+
+redis.call('RPUSH', KEYS[1], ARGV[3])
+redis.call('HSET', KEYS[2], 'status', ARGV[4])
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('HSET', KEYS[3], 'status', status)
+end
+
+for index = 9, #KEYS do
+    redis.call('SREM', KEYS[index], ARGV[6])
+end
+redis.call('SADD', KEYS[8], ARGV[6])
+
+if ARGV[7] == '1' then
+    if ARGV[8] == '1' then
+        redis.call('SET', KEYS[7], ARGV[6])
+    end
+    -- the builder follows its last build only
+    if redis.call('GET', KEYS[6]) == ARGV[6] then
+        redis.call('HSET', KEYS[4], 'status', ARGV[5])
+        if redis.call('EXISTS', KEYS[5]) == 1 then
+            redis.call('HSET', KEYS[5], 'status', status)
+        end
+    end
+end
+
+return {1, status}
+'''
+
 
 STATUS_MAP = {
     'ready': 'success',
@@ -51,20 +120,597 @@ GITHUB_STATUS_MAP = {
 }
 
 
-GITHUB_URI_REGEX = re.compile(
-    r'github.com[:/](?P<owner>[\w_-]+)[/](?P<name>[\w_-]+)([.]git)?')
+# the fields of a build that are listed along with its builder
+BUILD_SUMMARY_FIELDS = [
+    'id',
+    'status',
+    'branch',
+    'commit',
+    'commit_message',
+    'author_name',
+    'author_email',
+    'code',
+    'date_created',
+    'date_finished',
+]
 
+# the maximum allowed by the github api
+GITHUB_PAGE_SIZE = 100
+
+# the fields of a builder sent in listings, without its keys
+BUILDER_SUMMARY_FIELDS = [
+    'id',
+    'name',
+    'git_uri',
+    'shell_script',
+    'json_instructions',
+    'status',
+    'branch',
+    'creator',
+    'github_hook_data',
+    'git_clone_timeout_in_seconds',
+    'build_timeout_in_seconds',
+    'retention_max_builds',
+    'retention_max_age_in_days',
+]
 
-redis_pool = configure.connection_pool(
-    hostname=conf.redis_host,
-    port=conf.redis_port,
-    db=conf.redis_db
-)
+BUILD_VIEWS = [
+    'summary',
+    'detail',
+]
+
+GITHUB_URI_REGEX = re.compile(
+    r'github.com[:/](?P<owner>[\w_-]+)[/](?P<name>[\w_-]+)([.]git)?')
 
 
 def get_pipeline():
     from carpentry.workers import RunBuilder
-    return RunBuilder(JSONRedisBackend)
+    return RunBuilder(CarpentryRedisBackend)
+
+
+BUILDERS_KEY = 'carpentry:builders'
+BULK_DELETE_BATCH_SIZE = 500
+# the offset between the uuid1 epoch (1582-10-15) and the unix epoch
+UUID1_EPOCH_OFFSET = 0x01b21dd213814000
+
+
+def get_builder_builds_key(builder_id):
+    return 'carpentry:builder:{0}:builds'.format(builder_id)
+
+
+def get_build_status_key(status):
+    return 'carpentry:builds:status:{0}'.format(status)
+
+
+def get_last_build_key(builder_id):
+    return 'carpentry:builder:{0}:last-build'.format(builder_id)
+
+
+def get_last_finished_build_key(builder_id, status):
+    return 'carpentry:builder:{0}:last-{1}'.format(builder_id, status)
+
+
+def get_build_summary_key(build_id):
+    return 'carpentry:build:{0}:summary'.format(build_id)
+
+
+def get_builder_summary_key(builder_id):
+    return 'carpentry:builder:{0}:summary'.format(builder_id)
+
+
+def get_user_by_token_key(carpentry_token):
+    return 'carpentry:users:by-token:{0}'.format(
+        get_token_digest(carpentry_token))
+
+
+def get_user_by_github_token_key(github_access_token):
+    return 'carpentry:users:by-github-token:{0}'.format(
+        get_token_digest(github_access_token))
+
+
+def get_github_repos_key(user_id):
+    return 'carpentry:users:{0}:github-repos'.format(user_id)
+
+
+def get_github_repos_refresh_key(user_id):
+    return 'carpentry:users:{0}:github-repos:refresh'.format(user_id)
+
+
+def get_build_transitions_key(build_id):
+    return 'carpentry:build:{0}:transitions'.format(build_id)
+
+
+def get_gravatar_url(email):
+    email_md5 = hashlib.md5(email or '').hexdigest()
+    return 'https://s.gravatar.com/avatar/{0}'.format(email_md5)
+
+
+def get_last_page_number(response, page):
+    """returns the number of the last page of a github listing from
+    the ``Link`` header of one of its pages"""
+    last = response.links.get('last')
+    if not last:
+        return page
+
+    query = urlparse.parse_qs(urlparse.urlparse(last['url']).query)
+    return int(query.get('page', [page])[0])
+
+
+def get_timestamp(date):
+    if not isinstance(date, datetime.datetime):
+        return 0
+
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def get_uuid_timestamp(value):
+    """returns the creation time of an uuid1 in seconds, 0 for any
+    other kind of uuid"""
+    try:
+        value = uuid.UUID(bytes(value))
+    except ValueError:
+        return 0
+
+    if value.version != 1:
+        return 0
+
+    return (value.time - UUID1_EPOCH_OFFSET) / 1e7
+
+
+def format_page_cursor(score, member):
+    return '{0!r}:{1}'.format(float(score), member)
+
+
+def parse_page_cursor(cursor):
+    """returns the score and the member of the last item of the
+    previous page, raises ValueError when the cursor is invalid"""
+    score, member = bytes(cursor).split(':', 1)
+    return float(score), member
+
+
+def get_page_of_ids(key, limit, cursor=None):
+    """returns up to ``limit`` members of a sorted set, highest score
+    first, after the given cursor and the cursor of the next page,
+    which is None on the last page.
+
+    Pages are ranges by score rather than by rank so that they do not
+    shift when new members are added while the client goes through
+    them, and cost the same no matter how deep the cursor is.
+    """
+    connection = get_connection()
+    if not cursor:
+        items = connection.zrevrange(key, 0, limit, withscores=True)
+    else:
+        score, member = parse_page_cursor(cursor)
+        # members with the same score come in reverse lexicographical
+        # order, the ones up to the cursor were in the previous page
+        ties = connection.zcount(key, score, score)
+        items = connection.zrevrangebyscore(
+            key, score, '-inf', start=0, num=limit + ties + 1,
+            withscores=True)
+        items = [(m, s) for m, s in items if s < score or m < member]
+
+    page = items[:limit]
+    next_cursor = None
+    if len(items) > limit:
+        next_cursor = format_page_cursor(page[-1][1], page[-1][0])
+
+    return [m for m, s in page], next_cursor
+
+
+def index_builder(builder_id, pipeline=None):
+    """adds the builder to the sorted set of builders, latest first"""
+    # not using zadd() because its signature changed in redis-py 3
+    (pipeline or get_connection()).execute_command(
+        'ZADD', BUILDERS_KEY, get_uuid_timestamp(builder_id),
+        bytes(builder_id))
+
+
+def get_last_finished_build_keys(builder_id):
+    return [get_last_finished_build_key(builder_id, status)
+            for status in FINISHED_STATUSES]
+
+
+def unindex_builder(builder_id):
+    with redis_pipeline() as pipeline:
+        pipeline.zrem(BUILDERS_KEY, bytes(builder_id))
+        pipeline.delete(get_last_build_key(builder_id),
+                        get_builder_summary_key(builder_id),
+                        *get_last_finished_build_keys(builder_id))
+
+
+def get_builders_page(limit, cursor=None):
+    """returns a page of builders, latest first, and the cursor of
+    the next page"""
+    builder_ids, next_cursor = get_page_of_ids(BUILDERS_KEY, limit, cursor)
+    builders = filter(None, [
+        Builder.objects.get(id=builder_id) for builder_id in builder_ids])
+    return builders, next_cursor
+
+
+def get_builder_summaries(builder_ids):
+    """returns the :py:class:`BuilderSummary` of the given builders in
+    a single round trip, skipping the ones that no longer exist"""
+    pipeline = get_connection().pipeline(transaction=False)
+    for builder_id in builder_ids:
+        pipeline.hgetall(get_builder_summary_key(builder_id))
+
+    records = []
+    for builder_id, data in zip(builder_ids, pipeline.execute()):
+        if not data or 'id' not in data:
+            # created before the summaries existed, the ones saved
+            # since then only have the fields that changed
+            builder = Builder.objects.get(id=builder_id)
+            data = builder and builder.write_summary()
+
+        records.append(BuilderSummary.from_hash(data))
+
+    return filter(None, records)
+
+
+def get_builder_summaries_page(limit, cursor=None):
+    """like :py:func:`get_builders_page` but returns compact records,
+    for listings"""
+    builder_ids, next_cursor = get_page_of_ids(BUILDERS_KEY, limit, cursor)
+    return get_builder_summaries(builder_ids), next_cursor
+
+
+def index_build(build_id, builder_id, date_created, status, pipeline=None):
+    """adds the given build to the sorted set of builds of its
+    builder, scored by creation date, and to the set of its status"""
+    build_id = bytes(build_id)
+    pipe = pipeline or get_connection().pipeline(transaction=False)
+    if builder_id:
+        # not using zadd() because its signature changed in redis-py 3
+        pipe.execute_command(
+            'ZADD', get_builder_builds_key(builder_id),
+            get_timestamp(date_created), build_id)
+
+    if builder_id and status in FINISHED_STATUSES:
+        # kept from expiring, see Builder.get_expired_build_ids()
+        pipe.set(get_last_finished_build_key(builder_id, status), build_id)
+
+    for other in BUILD_STATUSES:
+        if other != status:
+            pipe.srem(get_build_status_key(other), build_id)
+
+    if status:
+        pipe.sadd(get_build_status_key(status), build_id)
+
+    if not pipeline:
+        pipe.execute()
+
+
+def unindex_build(build_id, builder_id):
+    build_id = bytes(build_id)
+    connection = get_connection()
+    pipeline = connection.pipeline(transaction=False)
+    pipeline.delete(get_build_summary_key(build_id),
+                    get_build_transitions_key(build_id))
+    for status in BUILD_STATUSES:
+        pipeline.srem(get_build_status_key(status), build_id)
+
+    if builder_id:
+        pipeline.zrem(get_builder_builds_key(builder_id), build_id)
+
+    pipeline.execute()
+    if not builder_id:
+        return
+
+    last_build_key = get_last_build_key(builder_id)
+
+    def replace_last_build(pipe):
+        if pipe.get(last_build_key) != build_id:
+            return
+
+        # the previous build becomes the last one, unless a new build
+        # is triggered in the meantime
+        previous = pipe.zrevrange(get_builder_builds_key(builder_id), 0, 0)
+        pipe.multi()
+        set_last_build(builder_id, previous and previous[0] or None, pipe)
+
+    run_in_transaction(replace_last_build, last_build_key)
+
+
+def set_last_build(builder_id, build_id, pipeline=None):
+    connection = pipeline or get_connection()
+    if build_id:
+        connection.set(get_last_build_key(builder_id), bytes(build_id))
+    else:
+        connection.delete(get_last_build_key(builder_id))
+
+
+def decode_build_summary(data):
+    """turns a build summary hash into the dictionary sent to the
+    clients"""
+    record = BuildSummary.from_hash(data)
+    return record and record.to_dictionary()
+
+
+def get_build_summaries(build_ids, pipeline=None):
+    """returns the summaries of the given builds in a single round
+    trip, without loading the builds, None for the missing ones"""
+    pipeline = pipeline or get_connection().pipeline(transaction=False)
+    for build_id in filter(None, build_ids):
+        pipeline.hgetall(get_build_summary_key(build_id))
+
+    found = dict(zip(filter(None, build_ids), pipeline.execute()))
+    summaries = []
+    for build_id in build_ids:
+        data = found.get(build_id)
+        if build_id and not data:
+            # built before the summaries existed
+            build = Build.objects.get(id=build_id)
+            data = build and build.write_summary()
+
+        summaries.append(decode_build_summary(data))
+
+    return summaries
+
+
+def get_last_build_summaries(builder_ids):
+    """returns the summary of the last build of each of the given
+    builders, or None for the ones without builds, in two round trips
+    to redis regardless of how many builders there are"""
+    pipeline = get_connection().pipeline(transaction=False)
+    for builder_id in builder_ids:
+        pipeline.get(get_last_build_key(builder_id))
+
+    return get_build_summaries(pipeline.execute(), pipeline=pipeline)
+
+
+def get_builder_build_ids(builder_id, start=0, stop=-1):
+    """returns the ids of the builds of a builder, latest first"""
+    return get_connection().zrevrange(
+        get_builder_builds_key(builder_id), start, stop)
+
+
+def count_builder_builds(builder_id):
+    return get_connection().zcard(get_builder_builds_key(builder_id))
+
+
+def get_build_ids_by_status(status):
+    return get_connection().smembers(get_build_status_key(status))
+
+
+def delete_builds(builder_id, build_ids, progress=None):
+    """deletes the given builds of a builder without loading them: their
+    records, logs, summaries and index entries go away in pipelined
+    batches. ``progress`` is called with the size of every batch
+    deleted. Returns how many builds were deleted."""
+    connection = get_connection()
+    last_finished_keys = get_last_finished_build_keys(builder_id)
+    last_finished = dict(zip(
+        last_finished_keys, connection.mget(last_finished_keys)))
+
+    for start in range(0, len(build_ids), BULK_DELETE_BATCH_SIZE):
+        batch = build_ids[start:start + BULK_DELETE_BATCH_SIZE]
+        delete_many_log_stores(batch)
+
+        pipeline = connection.pipeline(transaction=False)
+        for key, build_id in last_finished.items():
+            if build_id in batch:
+                pipeline.delete(key)
+
+        for build_id in batch:
+            pipeline.delete(get_build_summary_key(build_id),
+                            get_build_transitions_key(build_id),
+                            *Build(id=build_id).get_redis_keys())
+            for status in BUILD_STATUSES:
+                pipeline.srem(get_build_status_key(status), build_id)
+
+        pipeline.zrem(get_builder_builds_key(builder_id), *batch)
+        pipeline.execute()
+        if progress:
+            progress(len(batch))
+
+    return len(build_ids)
+
+
+def get_serialized_status(record, status):
+    """returns the status as repocket stores it in the hash of the
+    given kind of record"""
+    return type(record)(id=record.id, status=status).serialize()['status']
+
+
+def transition_build_status(build, status, now=None):
+    """atomically moves the build to the given status, as well as its
+    summary, status index and builder, unless it already reached that
+    status or a later one. Every transition is recorded with its
+    timestamp, see :py:func:`get_build_metrics`.
+
+    Returns a tuple with whether the build moved and its status.
+    """
+    if status not in BUILD_STATUS_RANKS:
+        raise ValueError('invalid build status: {0}'.format(status))
+
+    build_id = bytes(build.id)
+    builder = build.builder
+    builder_id = builder and bytes(builder.id) or ''
+    keys = [
+        get_build_transitions_key(build_id),
+        build._calculate_hash_key(),
+        get_build_summary_key(build_id),
+        # the builder keys are not touched when there is no builder
+        builder and builder._calculate_hash_key() or '',
+        get_builder_summary_key(builder_id),
+        get_last_build_key(builder_id),
+        get_last_finished_build_key(builder_id, status),
+        get_build_status_key(status),
+    ]
+    keys.extend(get_build_status_key(other)
+                for other in BUILD_STATUSES if other != status)
+    args = [
+        json.dumps(BUILD_STATUS_RANKS),
+        status,
+        json.dumps({'status': status, 'timestamp': now or time.time()}),
+        get_serialized_status(build, status),
+        builder and get_serialized_status(builder, status) or '',
+        build_id,
+        builder and '1' or '0',
+        status in FINISHED_STATUSES and '1' or '0',
+    ]
+    script = get_connection().register_script(BUILD_TRANSITION_SCRIPT)
+    moved, current = script(keys=keys, args=args)
+    return bool(moved), force_unicode(current)
+
+
+def get_build_transitions(build_id):
+    """returns the status transitions of a build, oldest first"""
+    entries = get_connection().lrange(get_build_transitions_key(build_id), 0, -1)
+    return [json.loads(entry) for entry in entries]
+
+
+def get_build_metrics(transitions, now=None):
+    """returns how many seconds a build spent in each status until it
+    finished, or until ``now`` when it is still going. ``queue_time``
+    is the time it waited for a worker after being scheduled and
+    ``total_time`` the time between its first and last transitions,
+    both are ``None`` when unknown."""
+    now = now or time.time()
+    durations = {}
+    for index, transition in enumerate(transitions):
+        if transition['status'] in FINISHED_STATUSES:
+            break
+
+        following = transitions[index + 1:index + 2]
+        end = following and following[0]['timestamp'] or now
+        durations[transition['status']] = end - transition['timestamp']
+
+    finished = transitions and transitions[-1]['status'] in FINISHED_STATUSES
+    total_time = None
+    if transitions:
+        end = finished and transitions[-1]['timestamp'] or now
+        total_time = end - transitions[0]['timestamp']
+
+    return {
+        'durations': durations,
+        'queue_time': durations.get('scheduled'),
+        'total_time': total_time,
+        'finished': bool(finished),
+    }
+
+
+def get_builds_by_ids(build_ids):
+    """returns the builds with the given ids in the same order,
+    skipping the ones that no longer exist"""
+    builds = []
+    for build_id in build_ids:
+        build = Build.objects.get(id=build_id)
+        if build:
+            builds.append(build)
+
+    return builds
+
+
+def get_legacy_log_size(build_id):
+    """returns the size of the output kept in the ``stdout`` field of
+    the build, where builds created before the chunked log storage
+    have it, or None when the build does not exist. Neither the record
+    nor its output are loaded."""
+    build = Build(id=build_id)
+    pipeline = get_connection().pipeline(transaction=False)
+    pipeline.exists(build._calculate_hash_key())
+    pipeline.strlen(build._calculate_key_for_field('stdout'))
+    exists, size = pipeline.execute()
+    if not exists:
+        return None
+
+    return int(size or 0)
+
+
+def reindex_builds():
+    """rebuilds the builder and build indexes and summaries from
+    scratch by scanning every record, returns how many builds were indexed"""
+    connection = get_connection()
+    keys = [BUILDERS_KEY]
+    keys.extend(connection.scan_iter(get_builder_builds_key('*')))
+    keys.extend(connection.scan_iter(get_last_build_key('*')))
+    keys.extend(connection.scan_iter(get_builder_summary_key('*')))
+    for status in FINISHED_STATUSES:
+        keys.extend(connection.scan_iter(
+            get_last_finished_build_key('*', status)))
+    keys.extend(get_build_status_key(status) for status in BUILD_STATUSES)
+    connection.delete(*keys)
+
+    total = 0
+    last_builds = {}
+    pipeline = connection.pipeline(transaction=False)
+    for builder in Builder.objects.all():
+        index_builder(builder.id, pipeline=pipeline)
+        builder.write_summary(pipeline=pipeline)
+
+    for build in Build.objects.all():
+        build.update_indexes(pipeline=pipeline)
+        build.write_summary(pipeline=pipeline)
+        total += 1
+
+        builder_id = build.get_builder_id()
+        if not builder_id:
+            continue
+
+        # the latest build of each builder and its latest build in
+        # each finished status
+        timestamp = get_timestamp(build.date_created)
+        keys = [get_last_build_key(builder_id)]
+        if build.status in FINISHED_STATUSES:
+            keys.append(get_last_finished_build_key(builder_id, build.status))
+
+        for key in keys:
+            if timestamp >= last_builds.get(key, (0, ))[0]:
+                last_builds[key] = (timestamp, build.id)
+
+    for key, (timestamp, build_id) in last_builds.items():
+        pipeline.set(key, bytes(build_id))
+
+    pipeline.execute()
+    return total
+
+
+def index_user(user, pipeline=None):
+    """points the tokens of the given user to its id, see
+    :py:func:`get_user_by_index`"""
+    pipe = pipeline or get_connection().pipeline(transaction=False)
+    user_id = bytes(user.id)
+    if user.carpentry_token:
+        pipe.set(get_user_by_token_key(user.carpentry_token), user_id)
+
+    if user.github_access_token:
+        pipe.set(get_user_by_github_token_key(user.github_access_token),
+                 user_id)
+
+    if not pipeline:
+        pipe.execute()
+
+
+def get_user_by_index(key, field, value):
+    """returns the user that the given index key points to as long as
+    its ``field`` still holds ``value``, so index entries left behind by
+    old tokens never authenticate anybody"""
+    user_id = get_connection().get(key)
+    user = user_id and User.objects.get(id=user_id)
+    if not user or bytes(getattr(user, field)) != bytes(value):
+        return None
+
+    return user
+
+
+def reindex_users():
+    """rebuilds the token indexes of the users, returns how many users
+    were indexed"""
+    connection = get_connection()
+    keys = list(connection.scan_iter('carpentry:users:by-*'))
+    if keys:
+        connection.delete(*keys)
+
+    total = 0
+    pipeline = connection.pipeline(transaction=False)
+    for user in User.objects.all():
+        index_user(user, pipeline=pipeline)
+        total += 1
+
+    pipeline.execute()
+    return total
 
 
 def slugify(string):
@@ -93,8 +739,194 @@ def model_to_dictionary(instance, extra={}):
     return data
 
 
+class CompactRecord(object):
+
+    """a read-only record decoded straight from a summary hash, used by
+    listings instead of loading whole ActiveRecords. The fields are
+    the ``__slots__``, the ones in ``integer_fields`` are decoded as
+    integers and the empty ones in ``nullable_fields`` as None.
+    """
+
+    __slots__ = ()
+    integer_fields = frozenset()
+    nullable_fields = frozenset()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{0} is read-only'.format(type(self).__name__))
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, self.id)
+
+    @classmethod
+    def decode(cls, name, value):
+        if isinstance(value, bytes):
+            value = force_unicode(value)
+
+        if name in cls.integer_fields:
+            return int(value or 0)
+
+        if not value and name in cls.nullable_fields:
+            return None
+
+        return '' if value is None else value
+
+    @classmethod
+    def from_hash(cls, data):
+        """returns a record with the result of ``HGETALL``, or None when
+        the hash does not exist"""
+        if not data:
+            return None
+
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            object.__setattr__(record, name, cls.decode(name, data.get(name)))
+
+        return record
+
+    def to_dictionary(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class BuildSummary(CompactRecord):
+    __slots__ = tuple(BUILD_SUMMARY_FIELDS)
+    integer_fields = frozenset(['code'])
+
+    def to_dictionary(self):
+        result = super(BuildSummary, self).to_dictionary()
+        result['css_status'] = STATUS_MAP.get(self.status, 'warning')
+        result['author_gravatar_url'] = get_gravatar_url(self.author_email)
+        return result
+
+
+class BuilderSummary(CompactRecord):
+    __slots__ = tuple(BUILDER_SUMMARY_FIELDS)
+    integer_fields = frozenset([
+        'git_clone_timeout_in_seconds',
+        'build_timeout_in_seconds',
+        'retention_max_builds',
+        'retention_max_age_in_days',
+    ])
+    nullable_fields = frozenset(['creator'])
+
+    def to_dictionary(self, last_build=None):
+        """returns the same as :py:meth:`Builder.to_list_dictionary`"""
+        result = super(BuilderSummary, self).to_dictionary()
+        result['slug'] = slugify(self.name).lower()
+        result['css_status'] = STATUS_MAP.get(self.status, 'success')
+        result['last_build'] = last_build
+        result['github_hook_url'] = conf.get_full_url(
+            '/api/hooks/{0}'.format(self.id))
+        return result
+
+
+def mark_as_loaded(record):
+    if record is not None:
+        record.mark_as_saved()
+
+    return record
+
+
+class LoadedRecordManager(object):
+
+    """wraps the manager that repocket gives to every model so that
+    the records it loads from redis are marked as saved"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+    def get(self, *args, **kw):
+        return mark_as_loaded(self.manager.get(*args, **kw))
+
+    def filter(self, *args, **kw):
+        return map(mark_as_loaded, self.manager.filter(*args, **kw))
+
+    def all(self):
+        return map(mark_as_loaded, self.manager.all())
+
+
+def track_loaded_records(model):
+    """class decorator of the models that extend
+    :py:class:`CarpentryBaseActiveRecord`"""
+    model.objects = LoadedRecordManager(model.objects)
+    return model
+
+
 class CarpentryBaseActiveRecord(ActiveRecord):
 
+    """keeps track of the fields assigned since the record was last
+    saved so that :py:meth:`save` only writes what changed.
+
+    Records loaded through ``objects`` are marked as saved, see
+    :py:func:`track_loaded_records`, so they only ``HSET`` the changed
+    fields or do nothing at all when no field changed. New instances
+    write the whole record the first time they are saved.
+    """
+
+    def __init__(self, *args, **kw):
+        super(CarpentryBaseActiveRecord, self).__init__(*args, **kw)
+        self.__dict__['_persisted'] = False
+        self.__dict__['_dirty_fields'] = set()
+
+    def __setattr__(self, name, value):
+        dirty_fields = self.__dict__.get('_dirty_fields')
+        field = self.__fields__.get(name)
+        if dirty_fields is not None and field and name not in dirty_fields:
+            # comparing a pointer would fetch the record it points to
+            if isinstance(field, attributes.Pointer):
+                dirty_fields.add(name)
+            elif getattr(self, name, None) != value:
+                dirty_fields.add(name)
+
+        super(CarpentryBaseActiveRecord, self).__setattr__(name, value)
+
+    @property
+    def is_persisted(self):
+        return self.__dict__.get('_persisted', False)
+
+    def get_changed_fields(self):
+        return set(self.__dict__.get('_dirty_fields', ()))
+
+    def mark_as_saved(self):
+        self.__dict__['_persisted'] = True
+        self.__dict__['_dirty_fields'] = set()
+
+    # write_fields() and get_redis_keys() are the only places that
+    # rely on how repocket lays a record out in redis: a hash with
+    # every field but the byte streams, which have a key each
+
+    def write_fields(self, names):
+        """writes the given fields in the hash of the record"""
+        serialized = self.serialize()
+        values = dict((name, serialized[name]) for name in names)
+        get_connection().hmset(self._calculate_hash_key(), values)
+
+    def get_redis_keys(self):
+        """returns every key where the record is stored"""
+        keys = [self._calculate_hash_key()]
+        for name, field in self.__fields__.items():
+            if isinstance(field, attributes.ByteStream):
+                keys.append(self._calculate_key_for_field(name))
+
+        return keys
+
+    def save(self):
+        changed = self.get_changed_fields()
+        byte_streams = [
+            name for name in changed
+            if isinstance(self.__fields__[name], attributes.ByteStream)]
+
+        if not self.is_persisted or byte_streams:
+            result = super(CarpentryBaseActiveRecord, self).save()
+            self.mark_as_saved()
+            return result
+
+        if changed:
+            self.write_fields(changed)
+            self.mark_as_saved()
+
     def prepare_github_request_headers(self, github_access_token=None):
         github_access_token = github_access_token or getattr(
             self, 'github_access_token', None)
@@ -104,12 +936,14 @@ class CarpentryBaseActiveRecord(ActiveRecord):
         return headers
 
 
+@track_loaded_records
 class CarpentryPreference(CarpentryBaseActiveRecord):
     id = attributes.AutoUUID()
     key = attributes.Unicode()
     value = attributes.Unicode()
 
 
+@track_loaded_records
 class User(CarpentryBaseActiveRecord):
     id = attributes.AutoUUID()
     github_access_token = attributes.Unicode()
@@ -121,7 +955,7 @@ class User(CarpentryBaseActiveRecord):
     @property
     def organization_names(self):
         self._organization_names = getattr(self, '_organization_names', None)
-        if not self._organization_names:
+        if self._organization_names is None:
             self._organization_names = [o['login'] for o in self.organizations]
 
         return self._organization_names
@@ -137,17 +971,80 @@ class User(CarpentryBaseActiveRecord):
 
     def get_github_metadata(self):
         headers = self.prepare_github_request_headers()
-        response = requests.get('https://api.github.com/user', headers=headers)
+        response = github.get_cached('https://api.github.com/user', headers=headers)
         if response.status_code == 200:
             self.github_metadata = response.json()
             self.save()
 
         return self.github_metadata
 
+    def save(self):
+        changed = self.get_changed_fields()
+        is_new = not self.is_persisted
+        result = super(User, self).save()
+        if is_new or changed & set(['carpentry_token', 'github_access_token']):
+            index_user(self)
+
+        if changed and not is_new:
+            # the cached principal is a snapshot of the old record
+            forget_principal(self.carpentry_token)
+
+        return result
+
     def reset_token(self):
+        if self.carpentry_token:
+            forget_principal(self.carpentry_token)
+            get_connection().delete(
+                get_user_by_token_key(self.carpentry_token))
+
         self.carpentry_token = uuid.uuid4()
         self.save()
 
+    def to_principal(self):
+        """returns what is cached about an authenticated user, see
+        :py:meth:`from_cached_token`"""
+        return {
+            'user': model_to_dictionary(self),
+            'organization_names': self.organization_names,
+        }
+
+    @classmethod
+    def from_principal(cls, principal):
+        data = principal['user']
+        user = cls(
+            id=uuid.UUID(data['id']),
+            github_access_token=data.get('github_access_token'),
+            name=data.get('name'),
+            email=data.get('email'),
+            carpentry_token=uuid.UUID(data['carpentry_token']),
+            github_metadata=data.get('github_metadata'),
+        )
+        user._organization_names = principal['organization_names']
+        # a snapshot that can be out of date, load the record with
+        # User.objects.get() before changing it. If it is saved anyway
+        # only the fields assigned since are written
+        user.mark_as_saved()
+        return user
+
+    @classmethod
+    def from_cached_token(cls, carpentry_token):
+        """like :py:meth:`from_carpentry_token` but served from the
+        principal cache, so that it costs a single redis read and no
+        requests to github until the cache expires or the token is
+        reset"""
+        if not carpentry_token:
+            return
+
+        principal = get_principal(carpentry_token)
+        if principal:
+            return cls.from_principal(principal)
+
+        user = cls.from_carpentry_token(carpentry_token)
+        if user:
+            cache_principal(carpentry_token, user.to_principal())
+
+        return user
+
     @classmethod
     def from_carpentry_token(cls, carpentry_token):
         if not carpentry_token:
@@ -155,65 +1052,137 @@ class User(CarpentryBaseActiveRecord):
 
         try:
             token = uuid.UUID(bytes(carpentry_token))
-        except TypeError:
+        except (TypeError, ValueError):
             logger.exception("Failed to query user by the carpentry_token: %s", carpentry_token)
+            return
 
-        users = cls.objects.filter(carpentry_token=token)
-        if len(users) > 0:
-            return users[0]
+        return get_user_by_index(
+            get_user_by_token_key(token), 'carpentry_token', token)
 
-    def retrieve_organization_repos(self, name):
-        headers = self.prepare_github_request_headers()
-        url = 'https://api.github.com/orgs/{0}/repos'.format(name)
-        response = requests.get(url, headers=headers)
-        if not response_did_succeed(response):
-            logger.info('[{0} repos] failed to retrieve {1}'.format(name, url))
-            return []
+    @classmethod
+    def from_github_access_token(cls, github_access_token):
+        if not github_access_token:
+            return
 
-        metadata = response.json()
-        return metadata
+        return get_user_by_index(
+            get_user_by_github_token_key(github_access_token),
+            'github_access_token', github_access_token)
 
-    def retrieve_user_repos(self):
+    def retrieve_github_page(self, url, page=1):
+        """returns the items in a page of a github listing and the
+        number of its last page"""
         headers = self.prepare_github_request_headers()
-        url = 'https://api.github.com/user/repos'
-        response = requests.get(url, headers=headers)
+        page_url = '{0}?per_page={1}&page={2}'.format(
+            url, GITHUB_PAGE_SIZE, page)
+        response = github.get_cached(page_url, headers=headers)
         if not response_did_succeed(response):
-            logger.info('[user repos] failed to retrieve {0}'.format(url))
-            return []
+            logger.info('failed to retrieve {0}'.format(page_url))
+            return [], page
 
-        metadata = response.json()
-        return metadata
+        return response.json(), get_last_page_number(response, page)
+
+    def retrieve_github_listings(self, urls):
+        """returns the items of every page of the given github listings,
+        in order. At most ``conf.github_sync_concurrency`` pages are
+        fetched at once: the first page of every listing and then the
+        remaining pages that they link to."""
+        pool = ThreadPool(max(1, min(conf.github_sync_concurrency, len(urls))))
+        try:
+            first_pages = pool.map(self.retrieve_github_page, urls)
+            remaining = [
+                (url, page)
+                for url, (items, last_page) in zip(urls, first_pages)
+                for page in range(2, last_page + 1)]
+            other_pages = pool.map(
+                lambda args: self.retrieve_github_page(*args)[0], remaining)
+        finally:
+            pool.close()
+            pool.join()
+
+        pages = dict((url, [items]) for url, (items, _) in zip(urls, first_pages))
+        for (url, page), items in zip(remaining, other_pages):
+            pages[url].append(items)
+
+        return [item for url in urls for items in pages[url] for item in items]
+
+    def retrieve_organization_repos(self, name):
+        return self.retrieve_github_listings([
+            'https://api.github.com/orgs/{0}/repos'.format(name)])
+
+    def retrieve_user_repos(self):
+        return self.retrieve_github_listings([
+            'https://api.github.com/user/repos'])
 
     def retrieve_and_cache_github_repositories(self):
-        personal_repos = self.retrieve_user_repos()
-        organization_repos = []
-        for organization_name in conf.allowed_github_organizations:
-            repos = self.retrieve_organization_repos(organization_name)
-            organization_repos.extend(repos)
-
-        all_repos = organization_repos + personal_repos
-        GithubRepository.store_many_from_list(all_repos)
+        """fetches the repositories of the allowed organizations and of
+        the user and keeps them for :py:meth:`get_cached_github_repositories`"""
+        urls = [
+            'https://api.github.com/orgs/{0}/repos'.format(name)
+            for name in conf.allowed_github_organizations]
+        urls.append('https://api.github.com/user/repos')
+        all_repos = self.retrieve_github_listings(urls)
+
+        serialized = json.dumps(all_repos)
+        key = get_github_repos_key(self.id)
+        pipeline = get_connection().pipeline(transaction=False)
+        pipeline.hget(key, 'repos')
+        pipeline.hmset(key, {'repos': serialized, 'refreshed_at': time.time()})
+        previous = pipeline.execute()[0]
+        if serialized != previous:
+            GithubRepository.store_many_from_list(all_repos)
+
         return all_repos
 
+    def get_cached_github_repositories(self):
+        """returns the repositories of the last sync and when it
+        happened, or ``(None, None)`` when they were never synced"""
+        data = get_connection().hgetall(get_github_repos_key(self.id))
+        if not data:
+            return None, None
+
+        return json.loads(data['repos']), float(data['refreshed_at'])
+
+    def refresh_github_repositories_in_background(self):
+        """syncs the repositories in a :py:class:`BackgroundJob` unless
+        another process is already doing it or the last attempt failed
+        less than ``conf.github_repos_refresh_interval_in_seconds`` ago,
+        returns the job or None"""
+        lock_key = get_github_repos_refresh_key(self.id)
+        locked = get_connection().set(
+            lock_key, b'1', nx=True,
+            ex=conf.github_repos_refresh_interval_in_seconds)
+        if not locked:
+            return None
+
+        def refresh(progress):
+            # when the sync fails the lock is left to expire, otherwise
+            # every request would start another one while github fails
+            self.retrieve_and_cache_github_repositories()
+            get_connection().delete(lock_key)
+            progress(1)
+
+        return BackgroundJob('sync_github_repos', 1, refresh).start()
+
     def retrieve_github_organizations(self):
-        github = self.get_github_metadata()
-        organizations = github.get('organizations', None)
+        metadata = self.get_github_metadata()
+        organizations = metadata.get('organizations', None)
         if organizations:
             return organizations
 
         headers = {
             'Authorization': 'token {0}'.format(self.github_access_token)
         }
-        url = render_string('https://api.github.com/user/orgs', github)
-        response = requests.get(url, headers=headers)
+        url = render_string('https://api.github.com/user/orgs', metadata)
+        response = github.get_cached(url, headers=headers)
         organizations = response.json()
 
-        github['organizations'] = organizations
-        self.github_metadata = github
+        metadata['organizations'] = organizations
+        self.github_metadata = metadata
         self.save()
         return organizations
 
 
+@track_loaded_records
 class GithubRepository(CarpentryBaseActiveRecord):
 
     """holds an individual repo coming as json from the github api
@@ -256,6 +1225,7 @@ class GithubRepository(CarpentryBaseActiveRecord):
         return model
 
 
+@track_loaded_records
 class GithubOrganization(CarpentryBaseActiveRecord):
     id = attributes.AutoUUID()
     login = attributes.Unicode()
@@ -287,6 +1257,7 @@ class GithubOrganization(CarpentryBaseActiveRecord):
         return model
 
 
+@track_loaded_records
 class Builder(CarpentryBaseActiveRecord):
     id = attributes.AutoUUID()
     name = attributes.Unicode()
@@ -304,12 +1275,150 @@ class Builder(CarpentryBaseActiveRecord):
         default=conf.default_subprocess_timeout_in_seconds)
     build_timeout_in_seconds = attributes.Integer(
         default=conf.default_subprocess_timeout_in_seconds)
+    # 0 means no limit, see get_expired_build_ids()
+    retention_max_builds = attributes.Integer(
+        default=conf.default_retention_max_builds)
+    retention_max_age_in_days = attributes.Integer(
+        default=conf.default_retention_max_age_in_days)
 
     def get_fallback_github_access_token(self):
         return self.creator.github_access_token
 
+    def save(self):
+        changed = self.get_changed_fields()
+        is_new = not self.is_persisted
+        result = super(Builder, self).save()
+        if is_new:
+            index_builder(self.id)
+
+        if is_new:
+            self.write_summary()
+            return result
+
+        # the status is only written by transition_build_status(), the
+        # one in memory may be older than the one in redis
+        fields = changed & set(BUILDER_SUMMARY_FIELDS) - set(['status'])
+        if fields:
+            self.write_summary(fields=fields)
+
+        return result
+
+    def get_summary(self, fields=BUILDER_SUMMARY_FIELDS):
+        summary = {}
+        for name in fields:
+            value = getattr(self, name)
+            if name == 'creator':
+                value = value and value.id
+
+            value = prepare_value_for_serialization(value)
+            summary[name] = '' if value is None else value
+
+        return summary
+
+    def write_summary(self, pipeline=None, fields=BUILDER_SUMMARY_FIELDS):
+        summary = self.get_summary(fields)
+        (pipeline or get_connection()).hmset(
+            get_builder_summary_key(self.id), summary)
+        return summary
+
+    def delete(self):
+        unindex_builder(self.id)
+        return super(Builder, self).delete()
+
+    def get_builds(self, start=0, stop=-1):
+        """returns the builds of this builder, latest first"""
+        return get_builds_by_ids(get_builder_build_ids(self.id, start, stop))
+
+    def get_expired_build_ids(self, limit, now=None):
+        """returns up to ``limit`` ids of the oldest builds that are past
+        the retention settings of this builder: beyond the latest
+        ``retention_max_builds`` or older than
+        ``retention_max_age_in_days``.
+
+        Builds that did not finish, the last build and the last ones
+        that succeeded and failed are always kept, the newer builds
+        after them are expired in their place.
+        """
+        max_builds = self.retention_max_builds or 0
+        max_age_in_days = self.retention_max_age_in_days or 0
+        if not max_builds and not max_age_in_days:
+            return []
+
+        key = get_builder_builds_key(self.id)
+        cutoff = (now or time.time()) - max_age_in_days * 24 * 60 * 60
+        pipeline = get_connection().pipeline(transaction=False)
+        pipeline.zcard(key)
+        pipeline.zcount(key, '-inf', '({0!r}'.format(cutoff))
+        pipeline.get(get_last_build_key(self.id))
+        for status in FINISHED_STATUSES:
+            pipeline.get(get_last_finished_build_key(self.id, status))
+
+        results = pipeline.execute()
+        total, old = results[:2]
+        protected = set(results[2:])
+
+        by_count = 0
+        if max_builds:
+            by_count = total - max_builds
+
+        if not max_age_in_days:
+            old = 0
+
+        build_ids = []
+        position = 0
+        width = len(FINISHED_STATUSES)
+        while len(build_ids) < limit:
+            expired = max(by_count, old)
+            if position >= expired:
+                break
+
+            # the oldest come first
+            candidates = get_connection().zrange(
+                key, position, min(expired, position + limit) - 1)
+            if not candidates:
+                break
+
+            for build_id in candidates:
+                for status in FINISHED_STATUSES:
+                    pipeline.sismember(get_build_status_key(status), build_id)
+
+            finished = pipeline.execute()
+            for index, build_id in enumerate(candidates):
+                position += 1
+                if build_id in protected or not any(
+                        finished[index * width:(index + 1) * width]):
+                    # the kept builds still count towards the maximum,
+                    # so that many more are expired after them
+                    if position <= by_count:
+                        by_count += 1
+
+                    continue
+
+                build_ids.append(build_id)
+                if len(build_ids) == limit:
+                    break
+
+        return build_ids
+
+    def get_builds_page(self, limit, cursor=None, view='summary'):
+        """returns a page of builds serialized in the given view, latest
+        first, and the cursor of the next page. The summary view is
+        read without loading the builds."""
+        build_ids, next_cursor = get_page_of_ids(
+            get_builder_builds_key(self.id), limit, cursor)
+        if view == 'summary':
+            items = filter(None, get_build_summaries(build_ids))
+        else:
+            items = [build.to_dictionary(view)
+                     for build in get_builds_by_ids(build_ids)]
+
+        return items, next_cursor
+
     def get_all_builds(self):
-        return Build.objects.filter(builder=self)
+        return self.get_builds()
+
+    def count_builds(self):
+        return count_builder_builds(self.id)
 
     @property
     def github_access_token(self):
@@ -319,7 +1428,7 @@ class Builder(CarpentryBaseActiveRecord):
         headers = self.prepare_github_request_headers(github_access_token)
         url = render_string(
             'https://api.github.com/repos/{{owner}}/{{name}}/hooks/{0}'.format(hook_id), self.github_repo_info)
-        response = requests.delete(url, headers=headers)
+        response = github.delete(url, headers=headers)
         return response
 
     def list_github_hooks(self, github_access_token=None):
@@ -331,7 +1440,7 @@ class Builder(CarpentryBaseActiveRecord):
             'https://api.github.com/repos/{owner}/{name}/hooks',
             self.github_repo_info
         )
-        response = requests.get(url, headers=headers)
+        response = github.get_cached(url, headers=headers)
 
         try:
             all_hooks = response.json()
@@ -423,7 +1532,7 @@ class Builder(CarpentryBaseActiveRecord):
             'https://api.github.com/repos/{owner}/{name}/hooks',
             self.github_repo_info
         )
-        response = requests.post(
+        response = github.post(
             url,
             data=request_payload,
             headers=headers
@@ -453,8 +1562,10 @@ class Builder(CarpentryBaseActiveRecord):
             commit=commit,
             status='ready',
         )
+        set_last_build(self.id, build.id)
+        build.set_status('scheduled')
         pipeline = get_pipeline()
-        payload = self.to_dictionary()
+        payload = self.to_list_dictionary(None)
         payload['id_rsa_public'] = self.id_rsa_public
         payload['id_rsa_private'] = self.id_rsa_private
         payload.pop('last_build', None)
@@ -465,32 +1576,43 @@ class Builder(CarpentryBaseActiveRecord):
         logger.info("Scheduling builder: %s %s", self.name, self.git_uri)
         return build
 
-    def clear_builds(self):
-        deleted_builds = []
-        for build in Build.objects.filter(builder=self):
-            deleted_builds.append(build)
-            build.delete()
-
-        return deleted_builds
+    def clear_builds(self, progress=None):
+        """deletes every build of this builder in batches and returns
+        how many were deleted, see :py:func:`delete_builds`"""
+        total = delete_builds(
+            self.id, get_builder_build_ids(self.id), progress)
+        set_last_build(self.id, None)
+        return total
 
     def get_last_build(self):
-        results = Build.objects.filter(builder=self)
+        results = self.get_builds(0, 0)
         if not results:
             return None
 
         return results[0]
 
-    def to_dictionary(self):
+    def to_dictionary(self, view='detail'):
+        """serializes the builder with its last build in the given view,
+        see :py:meth:`Build.to_dictionary`"""
+        if view == 'summary':
+            return self.to_list_dictionary(
+                get_last_build_summaries([self.id])[0])
+
         last_build = self.get_last_build()
 
         serialized_build = None
         if last_build:
             serialized_build = last_build.to_dictionary()
 
+        return self.to_list_dictionary(serialized_build)
+
+    def to_list_dictionary(self, last_build):
+        """serializes the builder with the given representation of its
+        last build, see :py:func:`get_last_build_summaries`"""
         result = model_to_dictionary(self, {
             'slug': slugify(self.name).lower(),
             'css_status': STATUS_MAP.get(self.status, 'success'),
-            'last_build': serialized_build,
+            'last_build': last_build,
             'github_hook_url': self.determine_github_hook_url()
         })
         result.pop('id_rsa_private', None)
@@ -498,6 +1620,7 @@ class Builder(CarpentryBaseActiveRecord):
         return result
 
 
+@track_loaded_records
 class Build(CarpentryBaseActiveRecord):
     id = attributes.AutoUUID()
     builder = attributes.Pointer(Builder)
@@ -519,11 +1642,7 @@ class Build(CarpentryBaseActiveRecord):
 
     @property
     def author_gravatar_url(self):
-        email_md5 = hashlib.md5(self.author_email or '').hexdigest()
-        gravatar_url = 'https://s.gravatar.com/avatar/{0}'.format(
-            email_md5,
-        )
-        return gravatar_url
+        return get_gravatar_url(self.author_email)
 
     @property
     def url(self):
@@ -568,7 +1687,7 @@ class Build(CarpentryBaseActiveRecord):
         })
 
         logger.info("setting github hook %s:\n%s", url, request_payload)
-        response = requests.post(url, data=request_payload, headers=headers)
+        response = github.post(url, data=request_payload, headers=headers)
         self.github_status_data = response.text
         self.save()
 
@@ -576,13 +1695,56 @@ class Build(CarpentryBaseActiveRecord):
 
     def append_to_stdout(self, string):
         value = force_unicode(string)
-        self.append_to_bytestream('stdout', value)
-        msg = '{0} {1}'.format(self.github_repo_info, value).strip()
-        logger.info(msg)
+        get_log_writer(self, 'stdout').write(value)
+
+    def mark_log_section(self, label):
+        get_log_writer(self, 'stdout').mark(label)
+
+    def flush_logs(self):
+        flush_log_writers(self)
+
+    def close_logs(self):
+        close_log_writers(self, eof=True)
+
+    def get_log_store(self, stream='stdout'):
+        return get_log_store(self.id, stream)
+
+    def read_log(self, offset=0, limit=None, stream='stdout'):
+        return self.get_log_store(stream).read(offset, limit)
+
+    def transition_to(self, status):
+        """moves the build to the given status, see
+        :py:func:`transition_build_status`"""
+        moved, current = transition_build_status(self, status)
+        self.status = current
+        # already written by the transition
+        self.__dict__.get('_dirty_fields', set()).discard('status')
+        return moved
+
+    def get_transitions(self):
+        return get_build_transitions(self.id)
+
+    def get_metrics(self):
+        return get_build_metrics(self.get_transitions())
 
     def set_status(self, status, description=None, github_access_token=None):
-        self.status = status
+        if status in FINISHED_STATUSES:
+            self.close_logs()
+        else:
+            self.flush_logs()
+
+        moved = self.transition_to(status)
+        # saves whatever else changed, like the exit code
         self.save()
+        if not moved:
+            logger.info('build %s is already %s, ignoring %s',
+                        self.id, self.status, status)
+            return
+
+        publish_build_event(self.id, 'status', {
+            'status': status,
+            'css_status': STATUS_MAP.get(status, 'warning'),
+        })
 
         if not github_access_token:
             msg = "[github] {0} skipping set github build status to {1}"
@@ -596,13 +1758,72 @@ class Build(CarpentryBaseActiveRecord):
             description
         )
 
-    def save(self):
+    @classmethod
+    def get_by_status(cls, status):
+        return get_builds_by_ids(get_build_ids_by_status(status))
+
+    def get_builder_id(self):
         builder = self.builder
-        builder.status = self.status
-        builder.save()
-        return super(Build, self).save()
+        return builder and builder.id or None
+
+    def update_indexes(self, pipeline=None):
+        index_build(self.id, self.get_builder_id(), self.date_created,
+                    self.status, pipeline=pipeline)
+
+    def get_summary(self):
+        summary = {}
+        for name in BUILD_SUMMARY_FIELDS:
+            value = prepare_value_for_serialization(getattr(self, name))
+            summary[name] = '' if value is None else value
+
+        return summary
+
+    def write_summary(self, pipeline=None):
+        summary = self.get_summary()
+        (pipeline or get_connection()).hmset(
+            get_build_summary_key(self.id), summary)
+        return summary
+
+    def save(self):
+        # the status of the builder is only written by
+        # transition_build_status(), which knows its last build
+        changed = self.get_changed_fields()
+        is_new = not self.is_persisted
+        result = super(Build, self).save()
+
+        indexed = is_new or changed & set(['builder', 'date_created', 'status'])
+        summarized = is_new or changed & set(BUILD_SUMMARY_FIELDS)
+        if indexed or summarized:
+            with redis_pipeline() as pipeline:
+                if indexed:
+                    self.update_indexes(pipeline=pipeline)
+
+                if summarized:
+                    self.write_summary(pipeline=pipeline)
+
+        return result
+
+    def delete(self):
+        delete_log_stores(self.id)
+        unindex_build(self.id, self.get_builder_id())
+
+        return super(Build, self).delete()
+
+    def to_dictionary(self, view='detail'):
+        """serializes the build in one of the views below:
+
+        * ``summary``: the :py:data:`BUILD_SUMMARY_FIELDS`, which is
+          what is stored in the summary hash of the build and used to
+          list builds without loading them.
+        * ``detail``: every field, including the webhook payload and
+          the parsed docker status.
+        """
+        if view == 'summary':
+            return decode_build_summary(self.get_summary())
+
+        if view != 'detail':
+            raise ValueError('invalid build view: {0}'.format(view))
 
-    def to_dictionary(self):
         result = model_to_dictionary(self, {
             'github_repo_info': self.github_repo_info,
             'css_status': STATUS_MAP.get(self.status, 'warning'),
@@ -619,9 +1840,12 @@ class Build(CarpentryBaseActiveRecord):
 
     def register_docker_status(self, line):
         try:
-            json.loads(line)
+            docker_status = json.loads(line)
             self.docker_status = line
             self.save()
+            publish_build_event(self.id, 'docker_status', {
+                'docker_status': docker_status,
+            })
             msg = 'registered docker status: {0}'.format(line)
             logger.info(msg)
         except ValueError:
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import json
+import hashlib
+
+from carpentry import conf
+from carpentry.db import get_connection
+
+
+def get_token_digest(token):
+    # tokens are credentials, only their digest is used in key names
+    return hashlib.sha1(bytes(token)).hexdigest()
+
+
+def get_principal_key(token):
+    return 'carpentry:principals:{0}'.format(get_token_digest(token))
+
+
+def get_principal(token):
+    """returns what was cached about the user of the given token, or
+    None when it was never cached, expired or was forgotten"""
+    data = get_connection().get(get_principal_key(token))
+    if not data:
+        return None
+
+    return json.loads(data)
+
+
+def cache_principal(token, principal, ttl=None):
+    """keeps the given principal for ``conf.principal_cache_ttl_in_seconds``
+    so that authenticated requests do not need to ask github about the
+    organizations of the user"""
+    get_connection().set(
+        get_principal_key(token), json.dumps(principal),
+        ex=ttl or conf.principal_cache_ttl_in_seconds)
+
+
+def forget_principal(token):
+    if token:
+        get_connection().delete(get_principal_key(token))
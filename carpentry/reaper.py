@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import uuid
+import logging
+import threading
+
+from carpentry import conf
+from carpentry.db import get_connection
+from carpentry.models import delete_builds, get_builders_page
+
+logger = logging.getLogger('carpentry.reaper')
+
+REAPER_LOCK_KEY = 'carpentry:reaper:lock'
+REAPER_BATCH_SIZE = 100
+REAPER_PAUSE = 0.1  # seconds between batches
+BUILDERS_PAGE_SIZE = 100
+
+
+class BuildReaper(object):
+
+    """deletes the builds that are past the retention settings of
+    their builders, see :py:meth:`Builder.get_expired_build_ids`.
+
+    Every ``interval`` seconds it goes through the builders deleting
+    their expired builds in small batches with a pause in between, so
+    that it never holds redis for long. Only one process reaps per
+    interval, the others skip it.
+    """
+
+    def __init__(self, interval=None, batch_size=REAPER_BATCH_SIZE,
+                 pause=REAPER_PAUSE):
+        self.id = bytes(uuid.uuid4())
+        self.interval = interval or conf.retention_interval_in_seconds
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='build-reaper')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.acquire():
+                    self.reap()
+            except Exception:
+                logger.exception('failed to reap expired builds')
+
+            self.stopped.wait(self.interval)
+
+    def acquire(self):
+        # expires a little before the next round of every process
+        return get_connection().set(
+            REAPER_LOCK_KEY, self.id, nx=True,
+            ex=max(1, int(self.interval * 0.9)))
+
+    def reap(self):
+        """deletes the expired builds of every builder and returns how
+        many were deleted"""
+        total = 0
+        cursor = None
+        while not self.stopped.is_set():
+            builders, cursor = get_builders_page(BUILDERS_PAGE_SIZE, cursor)
+            for builder in builders:
+                total += self.reap_builder(builder)
+
+            if not cursor:
+                break
+
+        if total:
+            logger.info('deleted %s expired builds', total)
+
+        return total
+
+    def reap_builder(self, builder):
+        total = 0
+        while not self.stopped.is_set():
+            build_ids = builder.get_expired_build_ids(self.batch_size)
+            if not build_ids:
+                break
+
+            total += delete_builds(builder.id, build_ids)
+            self.stopped.wait(self.pause)
+
+        return total
@@ -16,7 +16,7 @@ from flask import Response, render_template, request
 from carpentry import conf
 from carpentry.api.resources import web
 from carpentry.version import version as carpentry_version
-# from carpentry.websockets import *
+from carpentry.websockets import *  # noqa
 
 this_node = Node(__file__).dir
 mimedb = mimetypes.MimeTypes()
@@ -9,6 +9,7 @@ from flask import g, redirect, request
 from carpentry import conf
 from flask.ext.github import GitHub
 from carpentry.models import User
+from carpentry.principals import forget_principal
 from uuid import UUID
 from flask_socketio import SocketIO
 from carpentry.registry import WEBSOCKET_HANDLERS
@@ -29,11 +30,13 @@ class CarpentryHttpServer(Web):
     def prepare_services_integration(self):
         self.setup_github_authentication()
         MODULES.clear()
-        # self.collect_websocket_modules()
+        self.collect_websocket_modules()
         self.collect_modules()
 
     def collect_websocket_modules(self):
         self.socket_io = SocketIO(self.flask_app)
+        # Flask-SocketIO 0.x does not register itself in the app
+        self.flask_app.extensions['socketio'] = self.socket_io
         self.websockets = []
         for event, handler in WEBSOCKET_HANDLERS.items():
             register = self.socket_io.on(event)
@@ -41,11 +44,14 @@ class CarpentryHttpServer(Web):
 
         return self.websockets
 
+    def run(self, host=None, port=None, **kw):
+        return self.socket_io.run(self.flask_app, host=host, port=port, **kw)
+
     def setup_github_authentication(self):
         @self.flask_app.before_request
         def prepare_user():
             carpentry_token = request.cookies.get('carpentry_token')
-            g.user = User.from_carpentry_token(carpentry_token)
+            g.user = User.from_cached_token(carpentry_token)
 
         @self.github.access_token_getter
         def token_getter():
@@ -67,10 +73,8 @@ class CarpentryHttpServer(Web):
                     "and secret", access_token)
                 return redirect(next_url)
 
-            users = User.objects.filter(github_access_token=access_token)
-            user_exists = len(users) > 0
-
-            if not user_exists:
+            user = User.from_github_access_token(access_token)
+            if not user:
                 g.user = User(
                     id=uuid.uuid1(),
                     carpentry_token=uuid.uuid4(),
@@ -80,9 +84,9 @@ class CarpentryHttpServer(Web):
             else:
                 logger.info(
                     "User already exists with github_access_token %s %s", access_token, g.user)
-                g.user = users[0]
-                g.user.carpentry_token = uuid.uuid4()
+                g.user = user
                 g.user.github_access_token = access_token
+                g.user.reset_token()
 
             g.user.save()
 
@@ -104,8 +108,12 @@ class CarpentryHttpServer(Web):
         @self.flask_app.route('/logout', methods=["GET"])
         def logout():
             response = redirect('/')
-            if g.user:
-                g.user.reset_token()
+            forget_principal(request.cookies.get('carpentry_token'))
+            # g.user comes from the principal cache, the stored record
+            # is the one to change
+            user = g.user and User.objects.get(id=g.user.id)
+            if user:
+                user.reset_token()
 
             response.set_cookie('carpentry_token', '', expires=0)
             return response
@@ -18,6 +18,14 @@ Builder.prototype.triggerBuild = function(branch){
 };
 
 
+// returns the url of the next page from the Link header of a
+// paginated response, or null on the last page
+function getNextPageUrl(headers) {
+    var link = headers('Link') || '';
+    var found = /<([^>]+)>;\s*rel="next"/.exec(link);
+    return found ? found[1] : null;
+}
+
 Builder.fromList = function(listOfBuilderData) {
     var results = {};
     for (var x in listOfBuilderData) {
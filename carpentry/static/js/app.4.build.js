@@ -16,6 +16,30 @@ angular.module('CarpentryApp.Build', [
     };
 
     $scope.html_output = null;
+    $scope.rendered_output = '';
+    $scope.log_offset = 0;
+    $scope.log_state = '';
+
+    function get_log() {
+        if ($scope.eof) {
+            return;
+        }
+        var url = '/api/build/'+$stateParams.build_id+'/log';
+        var params = {offset: $scope.log_offset, state: $scope.log_state, format: 'html'};
+        $http.get(url, {params: params}).success(function (data, status, headers, config) {
+            if (data.offset !== $scope.log_offset) {
+                // a response to an outdated offset
+                return;
+            }
+            $scope.rendered_output += data.html;
+            $scope.html_output = $sce.trustAsHtml($scope.rendered_output);
+            $scope.log_offset = data.next_offset;
+            $scope.log_state = data.state;
+            $scope.eof = data.eof;
+        }).error(function (data, status, headers, config) {
+            console.log('failed ' + url, status);
+        });
+    }
     function get_build() {
         if (!$stateParams.build_id) {
             console.log("Invalid build id:", $stateParams);
@@ -24,8 +48,7 @@ angular.module('CarpentryApp.Build', [
         var url = '/api/build/'+$stateParams.build_id;
         $http.get(url).success(function (data, status, headers, config) {
             $scope.build = data;
-            $scope.html_output = $sce.trustAsHtml(data.stdout);
-            console.log(data);
+            get_log();
         }).error(function (data, status, headers, config) {
             if (!status) {
                 console.log("server did not respond to" + url);
@@ -44,18 +67,100 @@ angular.module('CarpentryApp.Build', [
         });
 
     }
+    function append_log_event(event) {
+        if (event.offset !== $scope.log_offset) {
+            // missed some bytes, catch up through the api
+            get_log();
+            return;
+        }
+        $scope.rendered_output += event.html;
+        $scope.html_output = $sce.trustAsHtml($scope.rendered_output);
+        $scope.log_offset = event.next_offset;
+        if (typeof event.state !== 'undefined') {
+            $scope.log_state = event.state;
+        }
+    }
+    function subscribe_to_build_events() {
+        if (typeof io === 'undefined') {
+            return false;
+        }
+        var socket = io.connect();
+        var subscription = {build_id: $stateParams.build_id};
+        socket.on('connect', function(){
+            socket.emit('build:subscribe', subscription);
+            get_log();
+        });
+        socket.on('build:event', function(event){
+            $scope.$apply(function(){
+                if (event.event === 'log') {
+                    append_log_event(event);
+                } else if (event.event === 'status') {
+                    get_build();
+                }
+            });
+        });
+        $scope.$on('$destroy', function(){
+            socket.emit('build:unsubscribe', subscription);
+            socket.disconnect();
+        });
+        return true;
+    }
+    function stream_build_events() {
+        if (typeof EventSource === 'undefined') {
+            return false;
+        }
+        var url = '/api/build/'+$stateParams.build_id+'/events?offset='+$scope.log_offset+'&state='+encodeURIComponent($scope.log_state);
+        var source = new EventSource(url);
+        function listen(name, callback) {
+            source.addEventListener(name, function(message){
+                var event = JSON.parse(message.data);
+                $scope.$apply(function(){
+                    callback(event);
+                });
+            });
+        }
+        listen('log', append_log_event);
+        listen('status', function(event){
+            if ($scope.build) {
+                $scope.build.status = event.status;
+                $scope.build.css_status = event.css_status;
+            }
+        });
+        listen('docker_status', function(event){
+            if ($scope.build) {
+                $scope.build.docker_status = event.docker_status;
+            }
+        });
+        listen('eof', function(event){
+            $scope.eof = true;
+            source.close();
+            get_build();
+        });
+        $scope.$on('$destroy', function(){
+            source.close();
+        });
+        return true;
+    }
     var limit = 720;
     var counter = 0;
 
     $rootScope.resetPollers();
-    $rootScope.buildPoller = setInterval(function(){
-        counter++;
-        if (counter > 720) {
-            clearInterval($rootScope.buildPoller);
-        }
+    if (stream_build_events()) {
+        $http.get('/api/build/'+$stateParams.build_id).success(function (data) {
+            $scope.build = data;
+        });
+    } else if (!subscribe_to_build_events()) {
+        $rootScope.buildPoller = setInterval(function(){
+            counter++;
+            if (counter > 720 || $scope.eof) {
+                clearInterval($rootScope.buildPoller);
+            }
+            get_build();
+        }, 500);
         get_build();
-    }, 500);
-    get_build();
+    } else {
+        get_build();
+    }
     $scope.deleteBuild = function(build){
         $http
             .delete('/api/build/' + build.id)
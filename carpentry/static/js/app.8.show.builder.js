@@ -1,24 +1,53 @@
 angular.module('CarpentryApp.ShowBuilder', ['CarpentryApp.Common']).controller('ShowBuilderController', function ($rootScope, $scope, $state, $http, $location, hotkeys, notify, $stateParams) {
 
     var builderId = $stateParams.builder_id;
-    $rootScope.builder = $rootScope.builders[builderId];
+    $rootScope.builder = ($rootScope.builders || {})[builderId];
     if ($rootScope.buildCache[builderId] === undefined) {
         $rootScope.buildCache[builderId] = {};
     }
+    // the first page is polled, older pages are only loaded on demand
+    var firstPage = [];
+    var olderBuilds = [];
+    $scope.nextPageUrl = null;
 
+    function showBuilds() {
+        var seen = {};
+        var builds = [];
+        firstPage.concat(olderBuilds).forEach(function(build){
+            if (!seen[build.id]) {
+                seen[build.id] = true;
+                builds.push(build);
+            }
+        });
+        $rootScope.buildCache[builderId] = builds;
+        $scope.builds = builds;
+    }
+
+    function loadBuilder() {
+        // builders that the dashboard did not load yet
+        $http.get('/api/builder/' + builderId)
+            .success(function(data, status, headers, config) {
+                $rootScope.builder = data;
+            })
+            .error(function(data, status, headers, config) {
+                $rootScope.go('/');
+            });
+    }
 
     function refresh() {
-        if ($rootScope.builder.id === undefined) {
-            $rootScope.go('/');
-            return
+        if (!$rootScope.builder) {
+            return loadBuilder();
         }
-        var url = '/api/builder/' + $rootScope.builder.id + '/builds';
+        var url = '/api/builder/' + builderId + '/builds';
         $http
             .get(url)
 
             .success(function(data, status, headers, config) {
-                $rootScope.buildCache[builderId] = data;
-                $scope.builds = data;
+                firstPage = data;
+                if (!olderBuilds.length) {
+                    $scope.nextPageUrl = getNextPageUrl(headers);
+                }
+                showBuilds();
             })
 
             .error(function(data, status, headers, config) {
@@ -34,6 +63,16 @@ angular.module('CarpentryApp.ShowBuilder', ['CarpentryApp.Common']).controller('
             });
     }
     $scope.refresh = refresh;
+    $scope.loadMoreBuilds = function(){
+        $http
+            .get($scope.nextPageUrl)
+            .success(function(data, status, headers, config) {
+                olderBuilds = olderBuilds.concat(data);
+                $scope.nextPageUrl = getNextPageUrl(headers);
+                showBuilds();
+            })
+            .error($rootScope.defaultErrorHandler);
+    };
     $scope.clearBuilds = function(builder){
         $http
             .delete('/api/builder/' + $rootScope.builder.id + '/builds')
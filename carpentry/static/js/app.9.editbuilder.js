@@ -47,7 +47,11 @@ angular.module('CarpentryApp.EditBuilder', ['CarpentryApp.Common']).controller('
         $scope.saveInProcess = true;
         $http.delete('/api/builder/' + $scope.builder.id)
             .success(function(data, status, headers, config) {
-                notify($scope.builder.name +' deleted successfully');
+                if (status === 202) {
+                    notify($scope.builder.name +' is being deleted');
+                } else {
+                    notify($scope.builder.name +' deleted successfully');
+                }
                 $scope.builder = data;
                 $rootScope.go('/');
                 $scope.saveInProcess = false;
@@ -250,11 +250,23 @@ angular.module('CarpentryApp', [
     }
 
     $rootScope.refresh = function(ok){
-        $http.get("/api/builders").
-            success(function(data, status, headers, config) {
-                $rootScope.builders = Builder.fromList(data);
-                ok(data, status, headers, config);
-            }).error($rootScope.defaultErrorHandler);
+        var builders = [];
+        // the dashboard lists every builder, page after page
+        function fetchPage(url) {
+            $http.get(url).
+                success(function(data, status, headers, config) {
+                    builders = builders.concat(data);
+                    var next = getNextPageUrl(headers);
+                    if (next) {
+                        return fetchPage(next);
+                    }
+                    $rootScope.builders = Builder.fromList(builders);
+                    if (ok) {
+                        ok(builders, status, headers, config);
+                    }
+                }).error($rootScope.defaultErrorHandler);
+        }
+        fetchPage("/api/builders?limit=1000");
     };
 
     $rootScope.refresh();
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import json
+import time
+import logging
+
+from Queue import Queue, Empty
+
+from carpentry.ansi import render_ansi
+from carpentry.events import hub
+from carpentry.logs import format_log_cursor
+from carpentry.models import FINISHED_STATUSES, STATUS_MAP
+
+logger = logging.getLogger('carpentry.streaming')
+
+SSE_KEEPALIVE_INTERVAL = 15  # seconds
+SSE_READ_LIMIT = 512 * 1024  # bytes
+
+
+def format_server_sent_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append('id: {0}'.format(event_id))
+
+    lines.append('event: {0}'.format(event))
+    lines.append('data: {0}'.format(json.dumps(data)))
+    return '\n'.join(lines) + '\n\n'
+
+
+class BuildEventStream(object):
+
+    """iterates over the server-sent events of a build: the log bytes
+    after ``offset``, the current status and docker status and then
+    every new event published by the workers until the build
+    finishes, which is signaled by a final ``eof`` event.
+
+    The log is sent as html and the id of every event is the cursor
+    of the build log (offset and ansi state), so browsers resume from
+    where they stopped by sending it back as ``Last-Event-ID``.
+    """
+
+    def __init__(self, build, offset=0, state='',
+                 keepalive_interval=SSE_KEEPALIVE_INTERVAL):
+        self.build = build
+        self.store = build.get_log_store()
+        self.offset = offset
+        self.state = state
+        self.eof = False
+        self.keepalive_interval = keepalive_interval
+        self.queue = Queue()
+        self.listener = self.queue.put
+
+    def __iter__(self):
+        # subscribing before reading the log guarantees that nothing
+        # published in the meantime is lost
+        hub.watch(self.build.id, self.listener)
+        try:
+            for message in self.stream():
+                yield message
+        finally:
+            hub.unwatch(self.build.id, self.listener)
+
+    def format(self, event, data):
+        return format_server_sent_event(
+            event, data, format_log_cursor(self.offset, self.state))
+
+    def read_new_output(self):
+        moved = False
+        while True:
+            # finished logs can move from redis to the filesystem at
+            # any time, so the store is looked up before every read
+            self.store = self.build.get_log_store()
+            html, next_offset, eof, state = self.store.read_html(
+                self.offset, SSE_READ_LIMIT, self.state)
+
+            if next_offset < self.offset and not moved:
+                # the log was moved while being read
+                moved = True
+                continue
+
+            self.eof = eof
+            if next_offset <= self.offset:
+                return
+
+            offset = self.offset
+            self.offset = next_offset
+            self.state = state
+            yield self.format('log', {
+                'offset': offset,
+                'next_offset': next_offset,
+                'html': html,
+                'state': state,
+            })
+
+    def read_legacy_output(self):
+        # builds created before the chunked log storage keep their
+        # whole output in the stdout field
+        stdout = self.build.stdout or ''
+        self.eof = True
+        if self.offset >= len(stdout):
+            return
+
+        offset = self.offset
+        html, state = render_ansi(stdout[offset:], self.state)
+        self.offset = len(stdout)
+        self.state = state
+        yield self.format('log', {
+            'offset': offset,
+            'next_offset': self.offset,
+            'html': html,
+            'state': state,
+        })
+
+    def get_status_event(self, status):
+        return self.format('status', {
+            'status': status,
+            'css_status': STATUS_MAP.get(status, 'warning'),
+        })
+
+    def get_eof_event(self):
+        # tells the browser not to reconnect
+        return self.format('eof', {'next_offset': self.offset})
+
+    def stream(self):
+        for message in self.read_new_output():
+            yield message
+
+        finished = self.build.status in FINISHED_STATUSES
+        if finished and not self.eof and not self.store.get_metadata()['size']:
+            for message in self.read_legacy_output():
+                yield message
+
+        yield self.get_status_event(self.build.status)
+        if self.build.docker_status:
+            try:
+                docker_status = json.loads(self.build.docker_status)
+                yield self.format('docker_status', {
+                    'docker_status': docker_status,
+                })
+            except ValueError:
+                pass
+
+        if self.build.status in FINISHED_STATUSES and self.eof:
+            yield self.get_eof_event()
+            return
+
+        last_sent = time.time()
+        while True:
+            try:
+                event = self.queue.get(timeout=1.0)
+            except Empty:
+                if time.time() - last_sent >= self.keepalive_interval:
+                    last_sent = time.time()
+                    yield ': keepalive\n\n'
+                continue
+
+            last_sent = time.time()
+            kind = event.get('event')
+            if kind == 'log':
+                for message in self.handle_log_event(event):
+                    yield message
+
+            elif kind == 'status':
+                yield self.get_status_event(event['status'])
+                if event['status'] in FINISHED_STATUSES:
+                    for message in self.read_new_output():
+                        yield message
+
+                    yield self.get_eof_event()
+                    return
+
+            elif kind == 'docker_status':
+                yield self.format('docker_status', {
+                    'docker_status': event['docker_status'],
+                })
+
+    def handle_log_event(self, event):
+        if event.get('stream') != self.store.stream:
+            return []
+
+        if event['next_offset'] <= self.offset:
+            # already sent while catching up
+            return []
+
+        if event['offset'] != self.offset or 'html' not in event:
+            return self.read_new_output()
+
+        self.offset = event['next_offset']
+        self.state = event['state']
+        return [self.format('log', {
+            'offset': event['offset'],
+            'next_offset': event['next_offset'],
+            'html': event['html'],
+            'state': event['state'],
+        })]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from flask import current_app, request
+from flask_socketio import join_room, leave_room, emit
+
+from carpentry.events import hub
+from carpentry.models import User
+from carpentry.registry import websocket_handler
+
+__all__ = [
+    'subscribe_to_build',
+    'unsubscribe_from_build',
+    'disconnect',
+]
+
+logger = logging.getLogger('carpentry.websockets')
+
+
+def get_build_room(build_id):
+    return 'build:{0}'.format(build_id)
+
+
+class BuildRoomRelay(object):
+
+    """registers a single listener in the build events hub for every
+    build room that has at least one socketio client and emits the
+    events of that build to its room. Clients are tracked by session
+    id, so subscribing twice from the same socket counts once.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.watchers = {}
+        self.listeners = {}
+        self.lock = threading.Lock()
+
+    def watch(self, socket_io, build_id, sid):
+        with self.lock:
+            watchers = self.watchers.setdefault(build_id, set())
+            is_first = not watchers
+            watchers.add(sid)
+            if not is_first:
+                return
+
+            room = get_build_room(build_id)
+            listener = self.listeners[build_id] = (
+                lambda event: socket_io.emit('build:event', event, room=room))
+            self.hub.watch(build_id, listener)
+
+    def unwatch(self, build_id, sid):
+        with self.lock:
+            watchers = self.watchers.get(build_id, set())
+            watchers.discard(sid)
+            if watchers:
+                return
+
+            self.watchers.pop(build_id, None)
+            listener = self.listeners.pop(build_id, None)
+            if listener:
+                self.hub.unwatch(build_id, listener)
+
+    def unwatch_all(self, sid):
+        with self.lock:
+            build_ids = [build_id for build_id, watchers
+                         in self.watchers.items() if sid in watchers]
+
+        for build_id in build_ids:
+            self.unwatch(build_id, sid)
+
+
+relay = BuildRoomRelay(hub)
+
+
+def get_websocket_user():
+    return User.from_cached_token(request.cookies.get('carpentry_token'))
+
+
+def get_session_id():
+    # gevent-socketio keeps the session in the namespace of the request
+    return request.namespace.socket.sessid
+
+
+@websocket_handler('build:subscribe')
+def subscribe_to_build(message):
+    build_id = (message or {}).get('build_id')
+    if not build_id or not get_websocket_user():
+        emit('build:error', {'error': 'unauthorized', 'build_id': build_id})
+        return
+
+    join_room(get_build_room(build_id))
+    relay.watch(current_app.extensions['socketio'], build_id,
+                get_session_id())
+
+
+@websocket_handler('build:unsubscribe')
+def unsubscribe_from_build(message):
+    build_id = (message or {}).get('build_id')
+    room = get_build_room(build_id)
+    if room not in request.namespace.rooms:
+        return
+
+    leave_room(room)
+    relay.unwatch(build_id, get_session_id())
+
+
+@websocket_handler('disconnect')
+def disconnect():
+    relay.unwatch_all(get_session_id())
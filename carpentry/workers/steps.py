@@ -8,14 +8,17 @@ import os
 import re
 import json
 import time
+import select
+import signal
 import logging
 import traceback
 import io
-import requests
 import shutil
 import codecs
 import yaml
 from carpentry import conf
+from carpentry import github
+from collections import deque
 from datetime import datetime
 from subprocess import Popen, PIPE, STDOUT, check_output, CalledProcessError
 from lineup import Step
@@ -28,6 +31,11 @@ from carpentry.models import Build
 
 logger = logging.getLogger("carpentry.workers.steps")
 
+PUMP_CHUNK_SIZE = 4096  # bytes
+PUMP_POLL_INTERVAL = 0.25  # seconds
+TIMEOUT_BEFORE_SIGKILL = 5  # seconds
+OUTPUT_TAIL_SIZE = 64 * 1024  # characters
+
 
 AUTHOR_REGEX = re.compile(
     r'.*Author: (?P<name>[^<]+\s*)[<](?P<email>[^>]+)[>]', re.DOTALL | re.M)
@@ -50,46 +58,98 @@ def extract_container_name(docker, container):
 
 def run_command(command, chdir=None, environment={}):
     try:
-        return Popen(command, stdout=PIPE, stderr=STDOUT, shell=True, cwd=chdir, env=environment)
+        # the process leads its own process group so that a timeout
+        # can kill every process started by the command
+        return Popen(command, stdout=PIPE, stderr=STDOUT, shell=True, cwd=chdir, env=environment, preexec_fn=os.setsid)
     except Exception:
         logging.exception("Failed to run {0}".format(command))
 
 
-def stream_output(step, process, build, stdout_chunk_size=1024, timeout_in_seconds=None):
-    stdout = []
-    current_transfered_bytes = 0
-    started_time = time.time()
-    difference = time.time() - started_time
+def kill_process_group(process, timeout_before_sigkill=TIMEOUT_BEFORE_SIGKILL):
+    """sends SIGTERM to the process group of the given process and
+    SIGKILL to whatever is left of it after ``timeout_before_sigkill``
+    seconds"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        logger.warning('process group %s is already gone', process.pid)
+        return process.wait()
+
+    deadline = time.time() + timeout_before_sigkill
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # every process exited after SIGTERM
+        pass
+
+    return process.wait()
+
+
+def stream_output(step, process, build, timeout_in_seconds=None):
+    """streams the output of the process to the build log and returns
+    a tuple with the last ``OUTPUT_TAIL_SIZE`` characters of it and
+    the exit code, the whole output is never kept in memory."""
+    tail = deque()
+    tail_size = 0
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    fd = process.stdout.fileno()
 
     timeout_in_seconds = int(
         timeout_in_seconds or conf.default_subprocess_timeout_in_seconds)
 
-    while difference < timeout_in_seconds:
-        difference = (time.time() - started_time)
-        raw = process.stdout.readline()
-        if not raw:
+    started_time = time.time()
+    deadline = started_time + timeout_in_seconds
+    timed_out = False
+    eof = False
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            timed_out = True
             break
 
-        out = force_unicode(raw)
-        current_transfered_bytes += len(out)
-        build.append_to_stdout(out)
-        stdout.append(out)
-        if current_transfered_bytes >= stdout_chunk_size:
-            build.save()
-            current_transfered_bytes = 0
+        if eof:
+            # the output was closed but the process may still be running
+            if process.poll() is not None:
+                break
+
+            time.sleep(min(remaining, PUMP_POLL_INTERVAL))
+            continue
+
+        readable, _, _ = select.select(
+            [fd], [], [], min(remaining, PUMP_POLL_INTERVAL))
+        if not readable:
+            # no output: do not leave the last bytes buffered
+            build.flush_logs()
+            continue
+
+        raw = os.read(fd, PUMP_CHUNK_SIZE)
+        out = decoder.decode(raw, final=not raw)
+        if out:
+            build.append_to_stdout(out)
+            tail.append(out)
+            tail_size += len(out)
+            while tail_size - len(tail[0]) >= OUTPUT_TAIL_SIZE:
+                tail_size -= len(tail.popleft())
+
+        if not raw:
+            eof = True
 
-    timed_out = difference > timeout_in_seconds
     if timed_out:
+        difference = int(time.time() - started_time)
         out = "\nBuild timed out by {0} seconds".format(difference)
         build.append_to_stdout(out)
 
-        process.terminate()
+        kill_process_group(process)
         exit_code = 420
     else:
         exit_code = process.wait()
 
-    build.save()
-    return ''.join(stdout), exit_code
+    build.flush_logs()
+    return ''.join(tail)[-OUTPUT_TAIL_SIZE:], exit_code
 
 
 def get_build_from_instructions(instructions):
@@ -107,6 +167,11 @@ def set_build_status(build, instructions, status, description=None):
 
 class CarpentryPipelineStep(Step):
 
+    def produce(self, instructions):
+        build = get_build_from_instructions(instructions)
+        build.flush_logs()
+        return super(CarpentryPipelineStep, self).produce(instructions)
+
     def handle_exception(self, e, instructions):
         build = get_build_from_instructions(instructions)
         error = traceback.format_exc(e)
@@ -123,6 +188,8 @@ class CarpentryPipelineStep(Step):
             error = traceback.format_exc(dependency_exception)
             build.append_to_stdout(error)
 
+        build.close_logs()
+
 
 class PrepareSSHKey(CarpentryPipelineStep):
 
@@ -141,11 +208,12 @@ class PrepareSSHKey(CarpentryPipelineStep):
 
     def consume(self, instructions):
         b = get_build_from_instructions(instructions)
+        b.mark_log_section('preparing ssh key')
         b.append_to_stdout('preparing ssh key...\n')
 
         now = datetime.utcnow()
 
-        set_build_status(b, instructions, 'running', 'carpentry build started at {0} UTC'.format(
+        set_build_status(b, instructions, 'retrieving', 'carpentry build started at {0} UTC'.format(
             now.strftime('%Y/%m/%d %H:%M:%S')))
         slug = instructions['slug']
 
@@ -230,7 +298,7 @@ class PushKeyToGithub(CarpentryPipelineStep):
         self.log("Pushing deploy keys to github {0}".format(url))
         self.log("Pushing deploy keys to github {0}".format(payload))
 
-        response = requests.post(url, data=payload, headers=headers)
+        response = github.post(url, data=payload, headers=headers)
         return response
 
     def dump_error_into_build_output(self, build, response):
@@ -327,8 +395,6 @@ class LocalRetrieve(CarpentryPipelineStep):
             set_build_status(build, instructions, 'failed', msg)
             build.set_status('failed')
             build.append_to_stdout(msg)
-            build.append_to_stdout(force_unicode(stdout))
-            build.append_to_stdout("\n")
 
         return stdout, exit_code, instructions
 
@@ -346,6 +412,7 @@ class LocalRetrieve(CarpentryPipelineStep):
     def consume(self, instructions):
         build = get_build_from_instructions(instructions)
         set_build_status(build, instructions, 'retrieving')
+        build.mark_log_section('retrieving repo')
         build.append_to_stdout('\nretrieving repo...\n')
         build_dir, instructions = self.ensure_build_dir(build, instructions)
 
@@ -410,8 +477,8 @@ class CheckAndLoadBuildFile(CarpentryPipelineStep):
     def consume(self, instructions):
         b = get_build_from_instructions(instructions)
         set_build_status(b, instructions, 'checking')
-        b.stdout += 'checking .carpentry.yml...\n'
-        b.save()
+        b.mark_log_section('checking .carpentry.yml')
+        b.append_to_stdout('checking .carpentry.yml...\n')
 
         build_dir = instructions['build_dir']
         yml_path = os.path.join(build_dir, '.carpentry.yml')
@@ -684,6 +751,7 @@ class PrepareShellScript(CarpentryPipelineStep):
             self.write_script_to_fd(fd, "set -e", instructions)
             self.write_script_to_fd(fd, shell_script, instructions)
 
+        build.mark_log_section(shell_script_filename)
         build.append_to_stdout('---------------------------\n')
         build.append_to_stdout(
             render_string('{shell_script_filename}:\n', instructions))
@@ -732,6 +800,7 @@ class RunBuild(CarpentryPipelineStep):
             build.append_to_stdout('.')
             logging.info("docker pull {0}: {1}".format(image, line))
 
+        build.mark_log_section('running tests inside of {0}'.format(image))
         build.append_to_stdout('\nrunning tests inside of {0}\n'.format(image))
 
         binds = {
@@ -807,12 +876,12 @@ class RunBuild(CarpentryPipelineStep):
         process = run_command(cmd, chdir=instructions['build_dir'])
 
         b = Build.objects.get(id=instructions['id'])
+        b.mark_log_section('running {0}'.format(cmd))
         b.append_to_stdout('\nrunning {0}...\n'.format(cmd))
 
         timeout_in_seconds = instructions.get('build_timeout_in_seconds')
         stdout, exit_code = stream_output(
             self, process, b, timeout_in_seconds=timeout_in_seconds)
-        b.append_to_stdout(force_unicode(stdout))
         b.code = int(exit_code)
         b.date_finished = datetime.utcnow()
         b.save()
@@ -30,7 +30,6 @@ def read_version():
 
 
 requirements = [
-    'ansi2html>=1.1.0',
     'ansiconv>=1.0.0',
     'bcrypt>=1.1.1',
     'blist>=1.3.6',
@@ -49,7 +48,8 @@ requirements = [
     'redis>=2.10.3',
     'requests>=2.7.0',
     'tumbler>=0.0.20',
-    'Flask-SocketIO>=0.6.0',
+    'Flask-SocketIO==0.6.0',
+    'gevent-socketio==0.3.6',
 ]
 
 
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from carpentry.ansi import AnsiRenderer
+from carpentry.ansi import render_ansi
+from carpentry.ansi import split_ansi_boundary
+
+
+def test_render_ansi_colors():
+    ('render_ansi() should convert SGR sequences to the classes of ansi.css')
+
+    html, state = render_ansi(
+        '\x1b[1;32mok\x1b[0m plain \x1b[91mred\x1b[39m')
+
+    html.should.equal(
+        '<span class="ansi1 ansi32">ok</span> plain '
+        '<span class="ansi38-9">red</span>')
+    state.should.equal('')
+
+
+def test_render_ansi_escapes_html():
+    ('render_ansi() should escape html and drop other escape sequences')
+
+    html, state = render_ansi('<b>&\x1b(B\x1b[2K</b>')
+
+    html.should.equal('&lt;b&gt;&amp;&lt;/b&gt;')
+
+
+def test_renderer_carries_state():
+    ('AnsiRenderer.render() should return self-contained html and '
+     'carry the state to the next call')
+
+    # Given a renderer
+    renderer = AnsiRenderer()
+
+    # When I render a chunk that leaves the color open
+    first = renderer.render('\x1b[4;38;5;208mwarning: ')
+
+    # And then the next chunk
+    second = renderer.render('disk almost full')
+
+    # Then both chunks are wrapped in the same classes
+    first.should.equal('<span class="ansi4 ansi38-208">warning: </span>')
+    second.should.equal(
+        '<span class="ansi4 ansi38-208">disk almost full</span>')
+
+    # And the state can be used to resume elsewhere
+    renderer.get_state().should.equal('4;38;5;208')
+    AnsiRenderer('4;38;5;208').render('x').should.equal(
+        '<span class="ansi4 ansi38-208">x</span>')
+
+
+def test_split_ansi_boundary():
+    ('split_ansi_boundary() should hold back an escape sequence cut in half')
+
+    split_ansi_boundary('done\x1b[1;3').should.equal(('done', '\x1b[1;3'))
+    split_ansi_boundary('done\x1b[0m').should.equal(('done\x1b[0m', ''))
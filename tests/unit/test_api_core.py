@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 from mock import patch
 from collections import OrderedDict
 from carpentry.api.core import TokenAuthority, authenticated, ensure_json_request
+from carpentry.api.core import authenticated_by_cookie
 
 
 def test_authenticator_get_token():
@@ -45,6 +46,21 @@ def test_get_token_string_missing_header(abort, request):
     abort.assert_called_once_with(401)
 
 
+def test_authenticator_get_token_from_cookie():
+    ('TokenAuthority.get_token() should fallback to the '
+     'carpentry_token cookie when there is no Authorization header')
+
+    # Given an instance of TokenAuthority without headers but with
+    # the carpentry_token cookie
+    authority = TokenAuthority({}, {'carpentry_token': 'cookietoken'})
+
+    # When I call get_token()
+    result = authority.get_token()
+
+    # Then it should be the token from the cookie
+    result.should.equal('cookietoken')
+
+
 @patch('carpentry.api.core.request')
 @patch('carpentry.api.core.abort')
 def test_get_user_none(abort, request):
@@ -73,7 +89,7 @@ def test_get_user_bad_token(User, abort, request, g):
     ('TokenAuthority.get_user() should abort immediately if the token is None')
 
     # Given that no user can be found with the given token
-    User.from_carpentry_token.return_value = None
+    User.from_cached_token.return_value = None
 
     # Given a headers dict with a valid token
     headers = {
@@ -99,7 +115,7 @@ def test_get_user_ok(User, abort, request, conf, g):
     ('TokenAuthority.get_user() should succeed if the user organization is in the allowed ones')
     conf.allowed_github_organizations = ['cnry']
     # Given that no user can be found with the given token
-    user = User.from_carpentry_token.return_value
+    user = User.from_cached_token.return_value
     user.organization_names = ['cnry']
 
     # Given a headers dict with a valid token
@@ -117,6 +133,32 @@ def test_get_user_ok(User, abort, request, conf, g):
     result.should.equal(user)
 
 
+@patch('carpentry.api.core.g')
+@patch('carpentry.api.core.conf')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.abort')
+@patch('carpentry.api.core.User')
+def test_get_user_reuses_request_user(User, abort, request, conf, g):
+    ('TokenAuthority.get_user() should not resolve the user again when '
+     'the server already did it for the same token')
+    conf.allowed_github_organizations = ['cnry']
+
+    # Given that the server found the user of the cookie
+    g.user.carpentry_token = 'thetoken'
+    g.user.organization_names = ['cnry']
+    user = g.user
+
+    # And an instance of TokenAuthority with the same token
+    authority = TokenAuthority({'Authorization': 'Bearer: thetoken'})
+
+    # When I call get_user
+    result = authority.get_user()
+
+    # Then it returned the same user
+    result.should.equal(user)
+    User.from_cached_token.called.should.be.false
+
+
 @patch('carpentry.api.core.g')
 @patch('carpentry.api.core.conf')
 @patch('carpentry.api.core.request')
@@ -127,7 +169,7 @@ def test_get_user_bad_organization(User, abort, request, conf, g):
     conf.allowed_github_organizations = ['cnry']
 
     # Given that no user can be found with the given token
-    user = User.from_carpentry_token.return_value
+    user = User.from_cached_token.return_value
     user.organization_names = ['dropcam']
 
     # Given a headers dict with a valid token
@@ -170,6 +212,45 @@ def test_authenticated_ok(TokenAuthority, request, json_response):
     result.should.equal('na-na-na-na-na-na-na-na batman')
 
 
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+def test_authenticated_ignores_cookies(TokenAuthority, request):
+    ('@authenticated should not authenticate requests by cookie')
+
+    # Given a request with the carpentry_token cookie
+    request.cookies = {'carpentry_token': 'cookietoken'}
+
+    @authenticated
+    def resource(user):
+        return user
+
+    # When I call it
+    resource()
+
+    # Then the cookies were not given to the TokenAuthority
+    TokenAuthority.assert_called_once_with(request.headers, None)
+
+
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+def test_authenticated_by_cookie(TokenAuthority, request):
+    ('@authenticated_by_cookie should fallback to the carpentry_token cookie')
+
+    # Given a request with the carpentry_token cookie
+    request.cookies = {'carpentry_token': 'cookietoken'}
+
+    @authenticated_by_cookie
+    def resource(user):
+        return user
+
+    # When I call it
+    result = resource()
+
+    # Then the cookies were given to the TokenAuthority
+    TokenAuthority.assert_called_once_with(request.headers, request.cookies)
+    result.should.equal(TokenAuthority.return_value.get_user.return_value)
+
+
 @patch('carpentry.api.core.request')
 def test_ensure_json_request(request):
         ('ensure_json_request()')
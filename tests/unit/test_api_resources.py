@@ -27,8 +27,13 @@ from carpentry.api.resources import remove_builder
 from carpentry.api.resources import list_builders
 from carpentry.api.resources import builds_from_builder
 from carpentry.api.resources import clear_builds
+from carpentry.api.resources import get_background_job
+from carpentry.api.resources import get_build_metrics
 from carpentry.api.resources import retrieve_builder
 from carpentry.api.resources import get_build
+from carpentry.api.resources import get_build_log
+from carpentry.api.resources import search_build_log
+from carpentry.api.resources import download_build_log
 from carpentry.api.resources import get_conf
 from carpentry.api.resources import get_user
 from carpentry.api.resources import generate_ssh_key_pair
@@ -88,11 +93,15 @@ def test_remove_builder(json_response, models, TokenAuthority, request):
 
     # Given that Builder.objects.get returns a mocked builder
     builder = models.Builder.objects.get.return_value
+    builder.count_builds.return_value = 3
 
     # When I call remove_builder
     response = remove_builder(id='someid')
 
-    # Then delete() was called
+    # Then its builds were cleared
+    builder.clear_builds.assert_called_once_with(None)
+
+    # And delete() was called
     builder.delete.assert_called_once_with()
 
     # And the query was done appropriately
@@ -105,26 +114,72 @@ def test_remove_builder(json_response, models, TokenAuthority, request):
 
     # And the json response was called appropriately
     json_response.assert_called_once_with(
-        builder.to_dictionary.return_value
+        builder.to_list_dictionary.return_value
     )
 
 
+@patch('carpentry.api.resources.BackgroundJob')
 @patch('carpentry.api.core.request')
 @patch('carpentry.api.core.TokenAuthority')
 @patch('carpentry.api.resources.models')
 @patch('carpentry.api.resources.json_response')
-def test_builds_from_builder(json_response, models, TokenAuthority, request):
-    ('GET /api/builder/<id>/builds should retrieve list of builds')
+def test_remove_builder_in_background(json_response, models, TokenAuthority, request, BackgroundJob):
+    ('DELETE /api/builder/<id> should delete the builds and then the '
+     'builder in a background job when there are too many builds')
 
-    build1 = Mock(name='build1')
-    build1.to_dictionary.return_value = {'build': 1}
+    # Given a builder with 5000 builds
+    builder = models.Builder.objects.get.return_value
+    builder.count_builds.return_value = 5000
+    builder.to_list_dictionary.return_value = {'id': 'someid'}
+    job = BackgroundJob.return_value.start.return_value
+    job.to_dictionary.return_value = {'id': 'job-1'}
 
-    build2 = Mock(name='build2')
-    build2.to_dictionary.return_value = {'build': 2}
+    # When I call remove_builder
+    response = remove_builder(id='someid')
 
-    models.Builds.objects.filter.return_value = [build1, build2]
+    # Then a job was started
+    kind, total, target = BackgroundJob.call_args[0]
+    kind.should.equal('remove_builder')
+    total.should.equal(5000)
 
-    # When I call remove_builder
+    # And nothing was deleted yet
+    builder.clear_builds.called.should.be.false
+    builder.delete.called.should.be.false
+
+    # And the response points to the job
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with({
+        'id': 'someid',
+        'job': {'id': 'job-1'},
+    }, status=202)
+
+    # When the job runs
+    progress = Mock(name='progress')
+    target(progress)
+
+    # Then it cleared the builds reporting the progress
+    builder.clear_builds.assert_called_once_with(progress)
+
+    # And deleted the builder
+    builder.delete.assert_called_once_with()
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_builds_from_builder(json_response, models, TokenAuthority, core_request, request):
+    ('GET /api/builder/<id>/builds should list the first page of '
+     'build summaries')
+
+    # Given that the client does not ask for a view nor a page
+    request.args.get.side_effect = lambda key, default=None, type=None: default
+
+    builder = models.Builder.objects.get.return_value
+    builder.get_builds_page.return_value = ([{'build': 1}], None)
+
+    # When I call builds_from_builder
     response = builds_from_builder(id='someid')
 
     # Then the query was done appropriately
@@ -132,8 +187,68 @@ def test_builds_from_builder(json_response, models, TokenAuthority, request):
         id='someid'
     )
 
-    # And the response should be a json_response
+    # And the first page of summaries was read
+    builder.get_builds_page.assert_called_once_with(50, None, 'summary')
+
+    # And the response should be a json_response with the summaries
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with([{'build': 1}])
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_builds_from_builder_next_page(json_response, models, TokenAuthority, core_request, request):
+    ('GET /api/builder/<id>/builds?cursor= should link to the next page')
+
+    # Given that the client asks for the detail of 2 builds after a cursor
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'view': 'detail',
+        'limit': 2,
+        'cursor': '1441065600.0:build-3',
+    }.get(key, default)
+    request.base_url = 'http://localhost:5000/api/builder/someid/builds'
+
+    builder = models.Builder.objects.get.return_value
+    builder.get_builds_page.return_value = (
+        [{'build': 2}, {'build': 1}], '1441065500.0:build-1')
+
+    # When I call builds_from_builder
+    response = builds_from_builder(id='someid')
+
+    # Then the page after the cursor was read
+    builder.get_builds_page.assert_called_once_with(
+        2, '1441065600.0:build-3', 'detail')
+
+    # And the response links to the next page
     response.should.equal(json_response.return_value)
+    response.headers.__setitem__.assert_called_once_with(
+        'Link',
+        '<http://localhost:5000/api/builder/someid/builds?'
+        'view=detail&limit=2&cursor=1441065500.0%3Abuild-1>; rel="next"')
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_builds_from_builder_invalid_cursor(json_response, models, TokenAuthority, core_request, request):
+    ('GET /api/builder/<id>/builds should refuse invalid cursors')
+
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'cursor': 'garbage',
+    }.get(key, default)
+
+    # When I call builds_from_builder
+    builds_from_builder(id='someid')
+
+    # Then it responds with 400
+    json_response.assert_called_once_with(
+        {'error': 'invalid cursor'}, status=400)
+    models.Builder.objects.get.called.should.be.false
 
 
 def test_is_model():
@@ -229,6 +344,221 @@ def test_get_build_ok(json_response, models, TokenAuthority, request):
     )
 
 
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_get_build_log(json_response, models, TokenAuthority, core_request, get_log_store, request):
+    ('GET /api/build/<id>/log should return the bytes after the given offset')
+
+    # Given that the client asks for the bytes after the offset 10
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'offset': 10,
+    }.get(key, default)
+
+    # And that the log store has 5 new bytes, the last being half
+    # of a multi-byte character
+    store = get_log_store.return_value
+    store.read.return_value = (b'done\xc3', 15, False)
+
+    # When I call get_build_log
+    response = get_build_log(id='someid')
+
+    # Then it read from the log store of the build
+    get_log_store.assert_called_once_with('someid')
+    store.read.assert_called_once_with(10, 512 * 1024)
+
+    # And the response should be a json_response
+    response.should.equal(json_response.return_value)
+
+    # And the incomplete character is left for the next read
+    json_response.assert_called_once_with({
+        'offset': 10,
+        'next_offset': 14,
+        'eof': False,
+        'data': 'done',
+    })
+
+    # And the build itself was not loaded
+    models.Build.objects.get.called.should.be.false
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_get_build_log_as_html(json_response, models, TokenAuthority, core_request, get_log_store, request):
+    ('GET /api/build/<id>/log?format=html should render the log '
+     'from the given ansi state')
+
+    # Given that the client asks for the html after the offset 10
+    # with the ansi state it got from the previous read
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'offset': 10,
+        'format': 'html',
+        'state': '1;32',
+    }.get(key, default)
+
+    # And that the log store renders the new bytes
+    store = get_log_store.return_value
+    store.read_html.return_value = (
+        '<span class="ansi1 ansi32">ok</span>', 12, False, '1;32')
+
+    # When I call get_build_log
+    response = get_build_log(id='someid')
+
+    # Then it rendered from the given offset and state
+    store.read_html.assert_called_once_with(10, 512 * 1024, '1;32')
+
+    # And the response has the html and the state for the next read
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with({
+        'offset': 10,
+        'next_offset': 12,
+        'eof': False,
+        'html': '<span class="ansi1 ansi32">ok</span>',
+        'state': '1;32',
+    })
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_get_build_log_empty(json_response, models, TokenAuthority, core_request, get_log_store, request):
+    ('GET /api/build/<id>/log should not load a build that has no '
+     'output yet')
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'offset': 0,
+    }.get(key, default)
+
+    # Given a build that did not write anything yet
+    store = get_log_store.return_value
+    store.read.return_value = (b'', 0, False)
+    models.get_legacy_log_size.return_value = 0
+
+    # When I call get_build_log
+    get_build_log(id='someid')
+
+    # Then the build was not loaded
+    models.get_legacy_log_size.assert_called_once_with('someid')
+    models.Build.objects.get.called.should.be.false
+
+    # And the response is empty
+    json_response.assert_called_once_with({
+        'offset': 0,
+        'next_offset': 0,
+        'eof': False,
+        'data': '',
+    })
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_get_build_log_not_found(json_response, models, TokenAuthority, core_request, get_log_store, request):
+    ('GET /api/build/<id>/log should return 404 for builds that do '
+     'not exist')
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'offset': 0,
+    }.get(key, default)
+
+    # Given that neither the log nor the build exist
+    get_log_store.return_value.read.return_value = (b'', 0, False)
+    models.get_legacy_log_size.return_value = None
+
+    # When I call get_build_log
+    response = get_build_log(id='nope')
+
+    # Then it returned 404
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with(
+        {'error': 'build not found'}, status=404)
+    models.Build.objects.get.called.should.be.false
+
+
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.json_response')
+def test_search_build_log(json_response, TokenAuthority, core_request, get_log_store, request):
+    ('GET /api/build/<id>/log/search should search the log store '
+     'with a bounded amount of context')
+
+    # Given that the client searches for an error with too much context
+    request.args.get.side_effect = lambda key, default=None, type=None: {
+        'q': 'Error',
+        'context': 500,
+    }.get(key, default)
+
+    # And that the log store finds it
+    store = get_log_store.return_value
+    store.search.return_value = [{'line': 3}]
+    store.get_metadata.return_value = {'lines': 7}
+
+    # When I call search_build_log
+    response = search_build_log(id='someid')
+
+    # Then it searched with the maximum context and results
+    get_log_store.assert_called_once_with('someid')
+    store.search.assert_called_once_with('Error', 20, 100)
+
+    # And the response has the matches
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with({
+        'query': 'Error',
+        'matches': [{'line': 3}],
+        'total_lines': 7,
+    })
+
+
+@patch('carpentry.api.resources.stream_with_context')
+@patch('carpentry.api.resources.Response')
+@patch('carpentry.api.resources.request')
+@patch('carpentry.api.resources.get_log_store')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+def test_download_compressed_build_log(TokenAuthority, core_request, get_log_store, request, Response, stream_with_context):
+    ('GET /api/build/<id>/log.txt should send the compressed chunks '
+     'as they are to clients that accept gzip')
+
+    # Given a client that accepts gzip
+    request.headers = {'Accept-Encoding': 'gzip, deflate'}
+
+    # And a compressed log
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 1024, 'eof': True, 'encoding': 'gzip', 'ansi_state': ''}
+    store.get_file_path.return_value = None
+
+    # When I call download_build_log
+    response = download_build_log(id='someid')
+
+    # Then it streams the gzip members without decoding them
+    store.iter_chunks.assert_called_once_with(decode=False)
+    stream_with_context.assert_called_once_with(
+        store.iter_chunks.return_value)
+
+    # And the response is gzip encoded
+    response.should.equal(Response.return_value)
+    Response.assert_called_once_with(
+        stream_with_context.return_value, headers={
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Vary': 'Accept-Encoding',
+            'Content-Encoding': 'gzip',
+        })
+
+
 @patch('carpentry.api.resources.uuid')
 @patch('carpentry.api.resources.generate_ssh_key_pair')
 @patch('carpentry.api.core.ensure_json_request')
@@ -301,14 +631,10 @@ def test_clear_builds(json_response, models, TokenAuthority, request):
     ('DELETE /api/builder/:id/builds should delete all the '
      'builds that are linked to the given builder')
 
-    class Build:
-        def __init__(self, x):
-            self.commit = str(x)[0] * 4
-
-    # Given that Build.objects.get returns a mocked build
+    # Given that Builder.objects.get returns a builder with 10 builds
     builder = models.Builder.objects.get.return_value
-    builder.clear_builds.return_value = [
-        Build(x) for x in range(10)]
+    builder.count_builds.return_value = 10
+    builder.clear_builds.return_value = 10
 
     # When I call clear_builds
     response = clear_builds(id='someid')
@@ -329,6 +655,11 @@ def test_clear_builds(json_response, models, TokenAuthority, request):
         {'total': 10}
     )
 
+    # And the builder is ready again
+    builder.status.should.equal('ready')
+    builder.save.assert_called_once_with()
+    builder.write_summary.assert_called_once_with(fields=['status'])
+
 
 @patch('carpentry.api.core.request')
 @patch('carpentry.api.core.TokenAuthority')
@@ -338,9 +669,10 @@ def test_clear_builds_empty(json_response, models, TokenAuthority, request):
     ('DELETE /api/builder/:id/builds should return '
      '0 when')
 
-    # Given that Build.objects.get returns a mocked build
+    # Given that Builder.objects.get returns a builder without builds
     builder = models.Builder.objects.get.return_value
-    builder.clear_builds.return_value = []
+    builder.count_builds.return_value = 0
+    builder.clear_builds.return_value = 0
 
     # When I call clear_builds
     response = clear_builds(id='someid')
@@ -362,6 +694,101 @@ def test_clear_builds_empty(json_response, models, TokenAuthority, request):
     )
 
 
+@patch('carpentry.api.resources.BackgroundJob')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_clear_builds_in_background(json_response, models, TokenAuthority, request, BackgroundJob):
+    ('DELETE /api/builder/:id/builds should delete the builds in a '
+     'background job when there are too many of them')
+
+    # Given a builder with 5000 builds
+    builder = models.Builder.objects.get.return_value
+    builder.count_builds.return_value = 5000
+    job = BackgroundJob.return_value.start.return_value
+    job.to_dictionary.return_value = {'id': 'job-1'}
+
+    # When I call clear_builds
+    response = clear_builds(id='someid')
+
+    # Then a job was started
+    kind, total, target = BackgroundJob.call_args[0]
+    kind.should.equal('clear_builds')
+    total.should.equal(5000)
+
+    # And nothing was deleted yet
+    builder.clear_builds.called.should.be.false
+
+    # And the response points to the job
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with({
+        'total': 5000,
+        'job': {'id': 'job-1'},
+    }, status=202)
+
+    # When the job runs
+    builder.clear_builds.return_value = 5000
+    progress = Mock(name='progress')
+    target(progress)
+
+    # Then it cleared the builds reporting the progress
+    builder.clear_builds.assert_called_once_with(progress)
+    builder.status.should.equal('ready')
+
+
+@patch('carpentry.api.resources.get_job')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.json_response')
+def test_get_background_job(json_response, TokenAuthority, request, get_job):
+    ('GET /api/jobs/<id> should return the progress of the job')
+
+    get_job.return_value = {'id': 'job-1', 'done': 500, 'total': 5000}
+
+    # When I call get_background_job
+    response = get_background_job(id='job-1')
+
+    # Then it returns the progress
+    get_job.assert_called_once_with('job-1')
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with(
+        {'id': 'job-1', 'done': 500, 'total': 5000})
+
+    # And 404 for unknown jobs
+    get_job.return_value = None
+    get_background_job(id='job-2')
+    json_response.assert_called_with({'error': 'job not found'}, status=404)
+
+
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.models')
+@patch('carpentry.api.resources.json_response')
+def test_get_build_metrics(json_response, models, TokenAuthority, request):
+    ('GET /api/build/<id>/metrics should return the transitions of the '
+     'build and the metrics calculated from them')
+    transitions = [{'status': 'scheduled', 'timestamp': 100}]
+    models.get_build_transitions.return_value = transitions
+
+    # When I call get_build_metrics
+    response = get_build_metrics(id='build-1')
+
+    # Then it returns the metrics
+    models.get_build_transitions.assert_called_once_with('build-1')
+    models.get_build_metrics.assert_called_once_with(transitions)
+    response.should.equal(json_response.return_value)
+    json_response.assert_called_once_with({
+        'transitions': transitions,
+        'metrics': models.get_build_metrics.return_value,
+    })
+
+    # And 404 for builds without transitions
+    models.get_build_transitions.return_value = []
+    get_build_metrics(id='build-2')
+    json_response.assert_called_with({'error': 'build not found'}, status=404)
+
+
 @patch('carpentry.api.core.ensure_json_request')
 @patch('carpentry.api.core.request')
 @patch('carpentry.api.core.TokenAuthority')
@@ -392,28 +819,47 @@ def test_edit_builder(json_response, models, TokenAuthority, request, ensure_jso
     json_response.assert_called_once_with({'say': 'whaaaaat'})
 
 
+@patch('carpentry.api.resources.request')
 @patch('carpentry.api.core.request')
 @patch('carpentry.api.core.TokenAuthority')
 @patch('carpentry.api.resources.models')
 @patch('carpentry.api.resources.json_response')
-def test_list_builders(json_response, models, TokenAuthority, request):
-    ('GET /api/builder/<id> should list the builders')
+def test_list_builders(json_response, models, TokenAuthority, core_request, request):
+    ('GET /api/builders should list the builders with '
+     'the summary of their last build')
 
     builder1 = Mock(name='builder1')
     builder1.to_dictionary.return_value = {'build': 1}
     builder2 = Mock(name='builder2')
     builder2.to_dictionary.return_value = {'build': 2}
 
-    # Given that Build.objects.put returns a mocked build
-    models.Builder.objects.all.return_value = [
+    # Given that the client does not ask for a page
+    request.args.get.side_effect = lambda key, default=None, type=None: default
+
+    # And that there are 2 builders
+    models.get_builder_summaries_page.return_value = ([
         builder1,
         builder2,
-    ]
+    ], None)
 
-    # When I call retrieve_builder
+    # And that only the first has builds
+    models.get_last_build_summaries.return_value = [{'id': 'b1'}, None]
+
+    # When I call list_builders
     response = list_builders()
 
-    # Then the response should be json
+    # Then the first page of builders was read as compact records
+    models.get_builder_summaries_page.assert_called_once_with(100, None)
+
+    # And the summaries were fetched at once
+    models.get_last_build_summaries.assert_called_once_with(
+        [builder1.id, builder2.id])
+
+    # And each builder was serialized with its summary
+    builder1.to_dictionary.assert_called_once_with({'id': 'b1'})
+    builder2.to_dictionary.assert_called_once_with(None)
+
+    # And the response should be json
     response.should.equal(json_response.return_value)
     json_response.assert_called_once_with([
         {
@@ -494,6 +940,7 @@ def test_get_conf(json_response, models, TokenAuthority, request, uuid_mock, ens
         'full_server_url': 'http://localhost:5000',
         'git_executable_path': '/usr/bin/git',
         'hostname': 'localhost',
+        'log_storage': 'redis',
         'port': 5000,
         'redis_db': 0,
         'redis_host': 'localhost',
@@ -543,15 +990,20 @@ def test_create_build_generating_ssh_keys(json_response, models, TokenAuthority,
 @patch('carpentry.api.resources.models')
 @patch('carpentry.api.resources.json_response')
 def test_get_user(json_response, models, TokenAuthority, request):
-    ('POST /api/build should generate ssh keys')
+    ('GET /api/user should refresh the github metadata of the stored user')
     user = TokenAuthority.return_value.get_user.return_value
-    user.get_github_metadata.return_value = {
+    record = models.User.objects.get.return_value
+    record.get_github_metadata.return_value = {
         'le': 'user'
     }
 
-    # When i call create_build
+    # When i call get_user
     response = get_user()
 
+    # then the stored record was loaded rather than the cached one
+    models.User.objects.get.assert_called_once_with(id=user.id)
+    user.get_github_metadata.called.should.be.false
+
     # then the response should be json
     response.should.equal(json_response.return_value)
     json_response.assert_called_once_with({
@@ -770,8 +1222,10 @@ def test_remove_image(json_response, models, TokenAuthority, request, get_docker
 @patch('carpentry.api.resources.models')
 @patch('carpentry.api.resources.json_response')
 def test_get_github_repos(json_response, models, TokenAuthority, request):
-    ('POST /api/build should generate ssh keys')
+    ('GET /api/github/repos should sync the repos when they were '
+     'never synced')
     user = TokenAuthority.return_value.get_user.return_value
+    user.get_cached_github_repositories.return_value = (None, None)
     user.retrieve_and_cache_github_repositories.return_value = {
         'le': 'repositories'
     }
@@ -784,3 +1238,33 @@ def test_get_github_repos(json_response, models, TokenAuthority, request):
     json_response.assert_called_once_with({
         'le': 'repositories'
     })
+
+
+@patch('carpentry.api.resources.time')
+@patch('carpentry.api.core.request')
+@patch('carpentry.api.core.TokenAuthority')
+@patch('carpentry.api.resources.json_response')
+def test_get_github_repos_cached(json_response, TokenAuthority, request, time):
+    ('GET /api/github/repos should serve the cached repos right away and '
+     'refresh them in the background when they are old')
+    user = TokenAuthority.return_value.get_user.return_value
+    user.get_cached_github_repositories.return_value = (['repo'], 1000)
+
+    # Given that the repos were synced a minute ago
+    time.time.return_value = 1060
+
+    # When I call get_github_repos
+    get_github_repos()
+
+    # Then the cached repos were returned
+    json_response.assert_called_once_with(['repo'])
+    user.refresh_github_repositories_in_background.called.should.be.false
+    user.retrieve_and_cache_github_repositories.called.should.be.false
+
+    # When they were synced an hour ago
+    time.time.return_value = 4600
+    get_github_repos()
+
+    # Then they were refreshed in the background
+    user.refresh_github_repositories_in_background.assert_called_once_with()
+    json_response.assert_called_with(['repo'])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import patch
+from carpentry.db import POOL
+from carpentry.db import get_connection_pool
+from carpentry.db import redis_pipeline
+
+
+@patch.dict(POOL, clear=True)
+@patch('carpentry.db.conf')
+@patch('carpentry.db.os')
+@patch('carpentry.db.BlockingConnectionPool')
+def test_get_connection_pool(BlockingConnectionPool, os, conf):
+    ('carpentry.db.get_connection_pool should share a bounded pool '
+     'per process')
+    os.getpid.return_value = 100
+    conf.redis_max_connections = 10
+
+    # When the pool is retrieved twice in the same process
+    pool = get_connection_pool()
+    get_connection_pool().should.equal(pool)
+
+    # Then it was created once, bounded and configured from conf
+    BlockingConnectionPool.assert_called_once_with(
+        host=conf.redis_host,
+        port=conf.redis_port,
+        db=conf.redis_db,
+        max_connections=10,
+        timeout=conf.redis_pool_timeout_in_seconds,
+    )
+
+    # When the process is forked
+    os.getpid.return_value = 101
+    get_connection_pool()
+
+    # Then the child gets a pool of its own
+    BlockingConnectionPool.call_count.should.equal(2)
+
+
+@patch('carpentry.db.get_connection')
+def test_redis_pipeline(get_connection):
+    ('carpentry.db.redis_pipeline should execute the pipeline when '
+     'the block succeeds')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # When a block succeeds
+    with redis_pipeline() as pipe:
+        pipe.set('key', 'value')
+
+    # Then the commands were sent in a single pipeline
+    get_connection.return_value.pipeline.assert_called_once_with(
+        transaction=False)
+    pipeline.set.assert_called_once_with('key', 'value')
+    pipeline.execute.assert_called_once_with()
+
+
+@patch('carpentry.db.get_connection')
+def test_redis_pipeline_error(get_connection):
+    ('carpentry.db.redis_pipeline should not execute the pipeline when '
+     'the block fails')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    def write():
+        with redis_pipeline(transaction=True) as pipe:
+            pipe.set('key', 'value')
+            raise ValueError('boom')
+
+    # When a block fails
+    write.when.called_with().should.throw(ValueError, 'boom')
+
+    # Then nothing was executed
+    pipeline.execute.called.should.be.false
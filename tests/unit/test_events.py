@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+import json
+from mock import Mock, patch, call
+from carpentry.events import get_build_channel
+from carpentry.events import parse_build_channel
+from carpentry.events import publish_build_event
+from carpentry.events import BuildEventsHub
+
+
+def test_build_channel():
+    ('get_build_channel() and parse_build_channel() should be symmetric')
+
+    channel = get_build_channel('build-1')
+    channel.should.equal('carpentry:build:build-1:events')
+    parse_build_channel(channel).should.equal('build-1')
+
+
+@patch('carpentry.events.get_connection')
+def test_publish_build_event(get_connection):
+    ('publish_build_event() should publish a json to the build channel')
+    connection = get_connection.return_value
+
+    # When I publish a status event
+    publish_build_event('build-1', 'status', {'status': 'running'})
+
+    # Then it was published to the channel of the build
+    connection.publish.call_count.should.equal(1)
+    channel, message = connection.publish.call_args[0]
+    channel.should.equal('carpentry:build:build-1:events')
+    json.loads(message).should.equal({
+        'event': 'status',
+        'build_id': 'build-1',
+        'status': 'running',
+    })
+
+
+def test_publish_build_event_invalid():
+    ('publish_build_event() should refuse unknown events')
+
+    publish_build_event.when.called_with(
+        'build-1', 'boom', {}
+    ).should.have.raised(ValueError, 'invalid build event: boom')
+
+
+@patch('carpentry.events.get_connection')
+@patch('carpentry.events.BuildEventsHub.ensure_running')
+def test_hub_subscribes_once_per_build(ensure_running, get_connection):
+    ('BuildEventsHub should keep a single redis subscription per build')
+    pubsub = get_connection.return_value.pubsub.return_value
+    first, second = Mock(name='first'), Mock(name='second')
+
+    # Given a hub with two listeners of the same build
+    hub = BuildEventsHub()
+    hub.watch('build-1', first, timeout=0)
+    hub.watch('build-1', second, timeout=0)
+
+    # When the reader syncs the subscriptions
+    hub.sync_subscriptions()
+
+    # Then it subscribed only once
+    pubsub.subscribe.assert_called_once_with(
+        'carpentry:build:build-1:events')
+
+    # When it relays a message
+    hub.relay({
+        'type': 'message',
+        'channel': 'carpentry:build:build-1:events',
+        'data': '{"event": "status", "status": "failed"}',
+    })
+
+    # Then both listeners got the event
+    first.assert_called_once_with({'event': 'status', 'status': 'failed'})
+    second.assert_called_once_with({'event': 'status', 'status': 'failed'})
+
+    # When both stop listening
+    hub.unwatch('build-1', first)
+    hub.sync_subscriptions()
+    pubsub.unsubscribe.called.should.be.false
+    hub.unwatch('build-1', second)
+    hub.sync_subscriptions()
+
+    # Then it unsubscribes
+    pubsub.unsubscribe.assert_called_once_with(
+        'carpentry:build:build-1:events')
+
+
+@patch('carpentry.events.time')
+@patch('carpentry.events.get_connection')
+def test_hub_reconnects_with_backoff(get_connection, time):
+    ('BuildEventsHub should wait longer and longer before reconnecting '
+     'while redis is down')
+    pubsub = get_connection.return_value.pubsub.return_value
+    listener = Mock(name='listener')
+
+    # Given a hub with a listener
+    hub = BuildEventsHub()
+    hub.listeners['build-1'] = [listener]
+
+    # And that redis fails twice before a message arrives, after
+    # which the listener goes away
+    calls = []
+
+    def get_message(timeout):
+        calls.append(timeout)
+        if len(calls) <= 2:
+            raise Exception('down')
+
+        if len(calls) == 3:
+            return {
+                'type': 'message',
+                'channel': 'carpentry:build:build-1:events',
+                'data': '{"event": "status", "status": "failed"}',
+            }
+
+        hub.listeners.clear()
+
+    pubsub.get_message.side_effect = get_message
+
+    # When the reader runs
+    hub.relay_forever()
+
+    # Then it waited a little longer after each failure
+    time.sleep.call_args_list.should.equal([call(1), call(2)])
+
+    # And subscribed again after reconnecting
+    pubsub.subscribe.call_count.should.equal(3)
+
+    # And closed the connection once nobody was listening
+    pubsub.unsubscribe.assert_called_once_with(
+        'carpentry:build:build-1:events')
+    pubsub.close.call_count.should.equal(3)
+
+    # And the message was relayed
+    listener.assert_called_once_with({'event': 'status', 'status': 'failed'})
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import patch
+from carpentry import github
+
+
+@patch.dict(github.SESSION, clear=True)
+@patch('carpentry.github.os')
+@patch('carpentry.github.create_session')
+def test_get_session(create_session, os):
+    ('github.get_session() should share a session per process')
+    os.getpid.return_value = 100
+
+    # When the session is retrieved twice in the same process
+    session = github.get_session()
+    github.get_session().should.equal(session)
+
+    # Then it was created once
+    create_session.assert_called_once_with()
+
+    # When the process is forked
+    os.getpid.return_value = 101
+    github.get_session()
+
+    # Then the child gets a session of its own
+    create_session.call_count.should.equal(2)
+
+
+def test_retry_abuse_rate_limit():
+    ('GithubRetry should retry 403 responses only when they say when '
+     'to try again')
+    retries = github.GithubRetry(total=3, status_forcelist=github.RETRY_STATUSES)
+
+    # When github answers 403 with a Retry-After header
+    retries.is_retry('GET', 403, has_retry_after=True).should.be.true
+
+    # And without it
+    retries.is_retry('GET', 403, has_retry_after=False).should.be.false
+
+
+@patch('carpentry.github.conf')
+@patch('carpentry.github.HTTPAdapter')
+@patch('carpentry.github.GithubRetry')
+def test_create_session(Retry, HTTPAdapter, conf):
+    ('github.create_session() should mount a bounded pool that retries '
+     'server errors and rate limits')
+    conf.github_max_retries = 3
+    conf.github_pool_size = 10
+
+    # When a session is created
+    session = github.create_session()
+
+    # Then it retries with backoff
+    Retry.assert_called_once_with(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+
+    # And keeps a bounded pool of connections
+    HTTPAdapter.assert_called_once_with(
+        pool_connections=1,
+        pool_maxsize=10,
+        max_retries=Retry.return_value,
+    )
+    session.get_adapter('https://api.github.com').should.equal(
+        HTTPAdapter.return_value)
+
+
+@patch('carpentry.github.conf')
+@patch('carpentry.github.get_session')
+def test_request_timeout(get_session, conf):
+    ('github requests should time out by default')
+    conf.github_timeout_in_seconds = 10
+
+    # When a request is made without a timeout
+    response = github.get('https://api.github.com/user', headers={})
+
+    # Then it was given the default timeout
+    response.should.equal(get_session.return_value.request.return_value)
+    get_session.return_value.request.assert_called_once_with(
+        'GET', 'https://api.github.com/user', headers={}, timeout=10)
+
+    # When a timeout is given
+    github.delete('https://api.github.com/user', timeout=1)
+
+    # Then it is kept
+    get_session.return_value.request.assert_called_with(
+        'DELETE', 'https://api.github.com/user', timeout=1)
+
+
+@patch('carpentry.github.conf')
+@patch('carpentry.github.get')
+@patch('carpentry.github.get_connection')
+def test_get_cached_stores_etag(get_connection, get, conf):
+    ('github.get_cached() should keep responses that have an etag')
+    connection = get_connection.return_value
+    pipeline = connection.pipeline.return_value
+    conf.github_cache_ttl_in_seconds = 60
+    connection.hgetall.return_value = {}
+    response = get.return_value
+    response.status_code = 200
+    response.headers = {'ETag': '"abc"', 'Content-Type': 'application/json'}
+    response.content = b'[]'
+
+    # When a url is requested for the first time
+    result = github.get_cached('https://api.github.com/user/repos',
+                               headers={'Authorization': 'token t'})
+
+    # Then it was requested without a condition
+    get.assert_called_once_with('https://api.github.com/user/repos',
+                                headers={'Authorization': 'token t'})
+    result.should.equal(response)
+
+    # And the response was cached with its etag
+    key = github.get_cache_key('https://api.github.com/user/repos',
+                               {'Authorization': 'token t'})
+    pipeline.hmset.assert_called_once_with(key, {
+        'ETag': '"abc"',
+        'Content-Type': 'application/json',
+        'body': b'[]',
+    })
+    pipeline.expire.assert_called_once_with(key, 60)
+
+
+@patch('carpentry.github.conf')
+@patch('carpentry.github.get')
+@patch('carpentry.github.get_connection')
+def test_get_cached_not_modified(get_connection, get, conf):
+    ('github.get_cached() should answer a 304 with the cached response')
+    connection = get_connection.return_value
+    conf.github_cache_ttl_in_seconds = 60
+    connection.hgetall.return_value = {
+        'ETag': '"abc"',
+        'Link': '<https://api.github.com/user/repos?page=2>; rel="next"',
+        'body': b'[{"name": "carpentry"}]',
+    }
+    get.return_value.status_code = 304
+
+    # When a cached url is requested
+    result = github.get_cached('https://api.github.com/user/repos',
+                               headers={'Authorization': 'token t'})
+
+    # Then its etag was sent
+    get.assert_called_once_with('https://api.github.com/user/repos', headers={
+        'Authorization': 'token t',
+        'If-None-Match': '"abc"',
+    })
+
+    # And the cached response was returned
+    result.status_code.should.equal(200)
+    result.json().should.equal([{'name': 'carpentry'}])
+    result.headers['Link'].should.equal(
+        '<https://api.github.com/user/repos?page=2>; rel="next"')
+
+    # And kept for longer
+    key = github.get_cache_key('https://api.github.com/user/repos',
+                               {'Authorization': 'token t'})
+    connection.expire.assert_called_once_with(key, 60)
+
+
+def test_get_cache_key():
+    ('github.get_cache_key() should not share responses between users')
+
+    url = 'https://api.github.com/user'
+    github.get_cache_key(url, {'Authorization': 'token a'}).should_not.equal(
+        github.get_cache_key(url, {'Authorization': 'token b'}))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import Mock, patch
+from carpentry.jobs import BackgroundJob
+from carpentry.jobs import get_job
+
+
+@patch('carpentry.jobs.time')
+@patch('carpentry.jobs.get_connection')
+def test_background_job(get_connection, time):
+    ('BackgroundJob should run the target in a thread and keep its '
+     'progress in redis')
+    connection = get_connection.return_value
+    pipeline = connection.pipeline.return_value
+    time.time.return_value = 1000
+
+    # Given a job whose target processes 2 items
+    target = Mock(name='target', side_effect=lambda progress: progress(2))
+    job = BackgroundJob('clear_builds', 2, target)
+
+    # When it starts and finishes
+    job.start().thread.join()
+
+    # Then its progress was created with an expiration
+    key = 'carpentry:jobs:{0}'.format(job.id)
+    pipeline.hmset.assert_called_once_with(key, {
+        'id': job.id,
+        'kind': 'clear_builds',
+        'status': 'running',
+        'total': 2,
+        'done': 0,
+        'started_at': 1000,
+    })
+    pipeline.expire.assert_called_once_with(key, 24 * 60 * 60)
+
+    # And the target reported its progress
+    connection.hincrby.assert_called_once_with(key, 'done', 2)
+
+    # And the job succeeded
+    connection.hmset.assert_called_once_with(key, {
+        'status': 'succeeded',
+        'finished_at': 1000,
+    })
+
+
+@patch('carpentry.jobs.time')
+@patch('carpentry.jobs.get_connection')
+def test_background_job_failure(get_connection, time):
+    ('BackgroundJob should record the error when the target fails')
+    connection = get_connection.return_value
+    time.time.return_value = 1000
+
+    # Given a job whose target fails
+    target = Mock(name='target', side_effect=RuntimeError('boom'))
+    job = BackgroundJob('clear_builds', 2, target)
+
+    # When it runs
+    job.run()
+
+    # Then the job failed with the error
+    connection.hmset.assert_called_once_with(job.key, {
+        'status': 'failed',
+        'finished_at': 1000,
+        'error': 'RuntimeError: boom',
+    })
+
+
+@patch('carpentry.jobs.get_connection')
+def test_get_job(get_connection):
+    ('get_job() should return the progress of a job')
+    connection = get_connection.return_value
+
+    # Given a running job in redis
+    connection.hgetall.return_value = {
+        'id': 'job-1',
+        'status': 'running',
+        'total': '5000',
+        'done': '500',
+        'started_at': '1000.5',
+    }
+
+    # When I get it
+    result = get_job('job-1')
+
+    # Then its numbers were decoded
+    connection.hgetall.assert_called_once_with('carpentry:jobs:job-1')
+    result.should.equal({
+        'id': 'job-1',
+        'status': 'running',
+        'total': 5000,
+        'done': 500,
+        'started_at': 1000.5,
+        'finished_at': None,
+    })
+
+    # And missing jobs are None
+    connection.hgetall.return_value = {}
+    get_job('job-2').should.be.none
@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+from functools import wraps
+from mock import Mock, patch, call
+from carpentry.logs import BuildLogWriter
+from carpentry.logs import RedisLogStore
+from carpentry.logs import FileSystemLogStore
+from carpentry.logs import get_log_store
+from carpentry.logs import spill_log_store
+from carpentry.logs import delete_many_log_stores
+from carpentry.logs import find_line_starts
+from carpentry.logs import get_log_writer
+from carpentry.logs import close_log_writers
+from carpentry.logs import split_utf8_boundary
+from carpentry.logs import gzip_compress
+from carpentry.logs import WRITERS
+
+
+def with_logs_dir(test):
+    @wraps(test)
+    def wrapper(*args):
+        path = tempfile.mkdtemp()
+        try:
+            with patch('carpentry.logs.conf') as conf:
+                conf.logs_node.join.side_effect = lambda name: os.path.join(
+                    path, name)
+                return test(*(args + (path, )))
+        finally:
+            shutil.rmtree(path)
+
+    return wrapper
+
+
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+@patch('carpentry.logs.time')
+def test_log_writer_buffers_until_flush_size(time, get_log_store, get_connection, publish_build_event):
+    ('BuildLogWriter.write() should buffer the output until '
+     'reaching the flush size')
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 0, 'eof': False, 'ansi_state': None,
+        'lines': 0}
+    store.write.return_value = 8
+
+    # Given that the clock never moves
+    time.time.return_value = 1000
+
+    # And a log writer with a flush size of 8 bytes
+    build = Mock(name='build')
+    writer = BuildLogWriter(build, flush_size=8, flush_interval=60)
+
+    # When I write 4 bytes
+    writer.write('abcd')
+
+    # Then nothing was sent to redis yet
+    store.write.called.should.be.false
+
+    # When I write another 4 bytes
+    writer.write('efgh')
+
+    # Then the whole buffer was written in a single pipeline
+    store.write.assert_called_once_with(0, 'abcdefgh', pipeline=pipeline)
+
+    # And its html was cached in the same pipeline
+    store.write_html.assert_called_once_with(
+        0, 8, 'abcdefgh', '', pipeline=pipeline)
+
+    # And so was the count of lines
+    store.write_line_index.assert_called_once_with(0, [], pipeline=pipeline)
+
+    # And the new bytes were published in the same pipeline
+    publish_build_event.assert_called_once_with(build.id, 'log', {
+        'stream': 'stdout',
+        'offset': 0,
+        'next_offset': 8,
+        'data': 'abcdefgh',
+        'html': 'abcdefgh',
+        'state': '',
+    }, pipeline)
+    pipeline.execute.assert_called_once_with()
+
+    # And the buffer is empty
+    writer.buffer.should.be.empty
+    writer.buffered_bytes.should.equal(0)
+
+    # And the writer knows the next offset
+    writer.offset.should.equal(8)
+
+
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+@patch('carpentry.logs.time')
+def test_log_writer_counts_encoded_bytes(time, get_log_store, get_connection, publish_build_event):
+    ('BuildLogWriter.write() should count the flush size in utf-8 '
+     'bytes rather than characters')
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 0, 'eof': False, 'ansi_state': None,
+        'lines': 0}
+
+    # Given that the clock never moves
+    time.time.return_value = 1000
+
+    # And a log writer with a flush size of 8 bytes
+    writer = BuildLogWriter(Mock(name='build'), flush_size=8, flush_interval=60)
+
+    # When I write 3 characters that take 6 bytes
+    writer.write('\xe7\xe3\xe9')
+
+    # Then they were buffered as 6 bytes
+    writer.buffered_bytes.should.equal(6)
+    store.write.called.should.be.false
+
+    # When I write another 2 of them
+    writer.write('\xf5\xfa')
+
+    # Then the 10 bytes were flushed
+    store.write.assert_called_once_with(
+        0, b'\xc3\xa7\xc3\xa3\xc3\xa9\xc3\xb5\xc3\xba', pipeline=pipeline)
+
+
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+@patch('carpentry.logs.time')
+def test_log_writer_flushes_after_interval(time, get_log_store, get_connection, publish_build_event):
+    ('BuildLogWriter.write() should flush once the flush '
+     'interval went by')
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 10, 'eof': False, 'ansi_state': '',
+        'lines': 0}
+
+    # Given a clock that moves forward at every call
+    time.time.side_effect = [1000, 1000.1, 1001, 1001]
+
+    # And a log writer with a huge flush size
+    build = Mock(name='build')
+    writer = BuildLogWriter(build, flush_size=1024, flush_interval=0.25)
+
+    # When I write twice
+    writer.write('first ')
+    writer.write('second')
+
+    # Then it flushed after the interval
+    store.write.assert_called_once_with(
+        10, 'first second', pipeline=pipeline)
+
+
+@patch('carpentry.logs.get_log_store')
+def test_log_writer_flush_empty(get_log_store):
+    ('BuildLogWriter.flush() should not touch redis when the buffer is empty')
+    store = get_log_store.return_value
+
+    build = Mock(name='build')
+    writer = BuildLogWriter(build)
+
+    writer.flush().should.equal(0)
+    store.write.called.should.be.false
+
+
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+def test_close_log_writers(get_log_store, get_connection, publish_build_event):
+    ('close_log_writers() should flush, close and forget the '
+     'writers of a build')
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 0, 'eof': False, 'ansi_state': None,
+        'lines': 0}
+
+    # Given a build with a writer that has buffered data
+    build = Mock(name='build', id='build-1')
+    writer = get_log_writer(build)
+    writer.write('buffered')
+
+    # When I close the writers of that build
+    close_log_writers(build, eof=True)
+
+    # Then the data was flushed
+    store.write.assert_called_once_with(0, 'buffered', pipeline=pipeline)
+
+    # And the log stores were closed
+    store.close.assert_has_calls([call(), call()])
+
+    # And the writer was forgotten
+    WRITERS.should_not.have.key(('build-1', 'stdout'))
+
+
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+def test_log_writer_holds_back_partial_escape(get_log_store, get_connection, publish_build_event):
+    ('BuildLogWriter.flush() should render the output carrying the '
+     'ansi state and keep an escape sequence cut in half in the buffer')
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 40, 'eof': False, 'ansi_state': '1',
+        'lines': 2}
+    store.write.return_value = 45
+
+    # Given a writer of a log that ended in bold
+    build = Mock(name='build')
+    writer = BuildLogWriter(build, flush_size=1024, flush_interval=60)
+
+    # When I flush a red text followed by half of an escape sequence
+    writer.write('\x1b[31mfail\x1b[')
+    writer.flush()
+
+    # Then only the complete text was written
+    store.write.assert_called_once_with(
+        40, '\x1b[31mfail', pipeline=pipeline)
+
+    # And it was rendered with the previous state
+    store.write_html.assert_called_once_with(
+        40, 45, '<span class="ansi1 ansi31">fail</span>', '1;31',
+        pipeline=pipeline)
+
+    # And the rest of the escape sequence is still buffered
+    writer.buffer.should.equal(['\x1b['])
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_write_across_chunks(get_connection):
+    ('RedisLogStore.write() should split the data at chunk boundaries')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # Given a log store with chunks of 4 bytes
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    # When I write 7 bytes at the offset 2
+    result = store.write(2, 'abcdefg')
+
+    # Then it returns the new size
+    result.should.equal(9)
+
+    # And each piece was appended to its chunk
+    pipeline.append.assert_has_calls([
+        call('carpentry:logs:build-1:stdout:chunk:0', b'ab'),
+        call('carpentry:logs:build-1:stdout:chunk:1', b'cdef'),
+        call('carpentry:logs:build-1:stdout:chunk:2', b'g'),
+    ])
+
+    # And the size was stored in the same pipeline
+    pipeline.hset.assert_called_once_with(
+        'carpentry:logs:build-1:stdout', 'size', 9)
+    pipeline.execute.assert_called_once_with()
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_read_from_offset(get_connection):
+    ('RedisLogStore.read() should only fetch the chunks after the offset')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {'size': '9', 'eof': '1'}
+    pipeline = connection.pipeline.return_value
+    pipeline.execute.return_value = [b'f', b'g']
+
+    # Given a log store with chunks of 4 bytes
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    # When I read from the offset 7
+    result = store.read(7)
+
+    # Then it returns the bytes, next offset and eof
+    result.should.equal((b'fg', 9, True))
+
+    # And only the last two chunks were fetched
+    pipeline.getrange.assert_has_calls([
+        call('carpentry:logs:build-1:stdout:chunk:1', 3, 3),
+        call('carpentry:logs:build-1:stdout:chunk:2', 0, 0),
+    ])
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_read_nothing_new(get_connection):
+    ('RedisLogStore.read() should not fetch chunks when there are no new bytes')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {'size': '9'}
+
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    store.read(9).should.equal((b'', 9, False))
+    connection.pipeline.called.should.be.false
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_read_html_from_cache(get_connection):
+    ('RedisLogStore.read_html() should use the cached html and only '
+     'render the bytes after it')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {'size': '13', 'eof': '1'}
+    pipeline = connection.pipeline.return_value
+    pipeline.execute.side_effect = [
+        # the html index and the encoding
+        [{'0': '4:32', '1': '6:1;32'}, None],
+        [b'<span class="ansi32">abcd</span>', b'ef'],
+        [b'gh', b'\x1b[0m', b'i'],
+    ]
+
+    # Given a log store with chunks of 4 bytes
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    # When I read it as html from the beginning
+    result = store.read_html()
+
+    # Then it returns the cached html followed by the rendered bytes
+    result.should.equal((
+        '<span class="ansi32">abcd</span>ef'
+        '<span class="ansi1 ansi32">gh</span>i',
+        13, True, '',
+    ))
+
+    # And it fetched the cached html of every chunk
+    pipeline.get.assert_has_calls([
+        call('carpentry:logs:build-1:stdout:html:0'),
+        call('carpentry:logs:build-1:stdout:html:1'),
+    ])
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_compress(get_connection):
+    ('RedisLogStore.compress() should store every chunk of a complete '
+     'log as a gzip member and then switch its encoding')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {'size': '6', 'eof': '1'}
+    pipeline = connection.pipeline.return_value
+    pipeline.execute.side_effect = [
+        # chunk 0, html 0, chunk 1 and html 1
+        [b'abcd', b'<b>abcd</b>', b'ef', None],
+        [],
+        [],
+    ]
+
+    # Given a complete log store with chunks of 4 bytes
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    # When I compress it
+    store.compress().should.be.true
+
+    # Then every chunk was stored compressed
+    pipeline.set.assert_has_calls([
+        call('carpentry:logs:build-1:stdout:chunk:0.gz',
+             gzip_compress(b'abcd')),
+        call('carpentry:logs:build-1:stdout:html:0.gz',
+             gzip_compress(b'<b>abcd</b>')),
+        call('carpentry:logs:build-1:stdout:chunk:1.gz',
+             gzip_compress(b'ef')),
+    ])
+
+    # And the encoding was switched in the same transaction that
+    # removed the uncompressed chunks
+    pipeline.hset.assert_called_once_with(
+        'carpentry:logs:build-1:stdout', 'encoding', 'gzip')
+    pipeline.delete.assert_called_once_with(
+        'carpentry:logs:build-1:stdout:chunk:0',
+        'carpentry:logs:build-1:stdout:html:0',
+        'carpentry:logs:build-1:stdout:chunk:1',
+    )
+    connection.pipeline.assert_called_with(transaction=True)
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_compress_incomplete(get_connection):
+    ('RedisLogStore.compress() should not touch logs still being written')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {'size': '6'}
+
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    store.compress().should.be.false
+    connection.pipeline.called.should.be.false
+
+
+@patch('carpentry.logs.get_connection')
+def test_log_store_read_compressed(get_connection):
+    ('RedisLogStore.read() should decompress the chunks transparently')
+    connection = get_connection.return_value
+    connection.hgetall.return_value = {
+        'size': '6', 'eof': '1', 'encoding': 'gzip'}
+    pipeline = connection.pipeline.return_value
+    pipeline.execute.return_value = [
+        gzip_compress(b'abcd'),
+        gzip_compress(b'ef'),
+    ]
+
+    # Given a compressed log store with chunks of 4 bytes
+    store = RedisLogStore('build-1', chunk_size=4)
+
+    # When I read from the offset 2
+    result = store.read(2)
+
+    # Then it returns the decompressed bytes
+    result.should.equal((b'cdef', 6, True))
+
+    # And it fetched the compressed chunks
+    pipeline.get.assert_has_calls([
+        call('carpentry:logs:build-1:stdout:chunk:0.gz'),
+        call('carpentry:logs:build-1:stdout:chunk:1.gz'),
+    ])
+
+
+def test_split_utf8_boundary():
+    ('split_utf8_boundary() should hold back a multi-byte character '
+     'that was cut in half')
+
+    data = 'ação'.encode('utf-8')
+
+    split_utf8_boundary(data).should.equal((data, b''))
+    split_utf8_boundary(data[:-2]).should.equal((data[:-3], data[-3:-2]))
+    split_utf8_boundary(b'abc').should.equal((b'abc', b''))
+
+
+@with_logs_dir
+def test_filesystem_log_store_write_and_read(path):
+    ('FileSystemLogStore should append to a file under the logs directory')
+
+    # Given a log store in the filesystem
+    store = FileSystemLogStore('build-1')
+
+    # When I write twice and close it
+    store.write(0, 'hello ').should.equal(6)
+    store.write(6, 'world').should.equal(11)
+    store.close()
+
+    # Then the bytes are in the log file of the build
+    with open(os.path.join(path, 'build-1', 'stdout.log'), 'rb') as fd:
+        fd.read().should.equal(b'hello world')
+
+    # And it reads from any offset
+    store.read(6).should.equal((b'world', 11, True))
+    store.read(0, 5).should.equal((b'hello', 5, False))
+
+
+@with_logs_dir
+def test_spill_log_store(path):
+    ('spill_log_store() should move a complete log and its html to '
+     'the filesystem')
+
+    # Given a complete log in redis
+    source = Mock(name='redis store', build_id='build-1', stream='stdout',
+                  chunk_size=4)
+    source.get_metadata.return_value = {
+        'size': 6, 'eof': True, 'ansi_state': '32', 'encoding': 'gzip',
+        'lines': 0}
+    source.get_line_index.return_value = [0]
+    source.get_markers.return_value = [
+        {'label': 'tests', 'line': 1, 'offset': 0}]
+    source.iter_chunks.return_value = [b'abcd', b'ef']
+    source.iter_html_chunks.return_value = [
+        (0, b'<span class="ansi32">abcd</span>', '4:32'),
+        (1, b'<span class="ansi32">ef</span>', '6:32'),
+    ]
+
+    # When I spill it
+    store = spill_log_store(source)
+
+    # Then it was removed from redis
+    source.delete.assert_called_once_with()
+
+    # And the log store of the build is now in the filesystem
+    get_log_store('build-1').should.be.a(FileSystemLogStore)
+    store.get_metadata().should.equal({
+        'size': 6, 'eof': True, 'ansi_state': '32', 'encoding': None,
+        'lines': 0})
+    store.read(0).should.equal((b'abcdef', 6, True))
+
+    # And its markers were kept
+    store.get_markers().should.equal([
+        {'label': 'tests', 'line': 1, 'offset': 0}])
+
+    # And its html cache was kept
+    store.read_html().should.equal((
+        '<span class="ansi32">abcd</span><span class="ansi32">ef</span>',
+        6, True, '32'))
+
+
+def test_spill_incomplete_log_store():
+    ('spill_log_store() should leave logs still being written in redis')
+    source = Mock(name='redis store')
+    source.get_metadata.return_value = {
+        'size': 6, 'eof': False, 'ansi_state': '', 'encoding': None}
+
+    spill_log_store(source).should.be.none
+    source.delete.called.should.be.false
+
+
+def test_find_line_starts():
+    ('find_line_starts() should count the lines and return the offsets '
+     'where every n-th line starts')
+
+    # Given a log with 2 lines so far
+    # When 4 lines are written at the offset 100 with an interval of 3
+    result = find_line_starts(b'a\nb\nc\nd\n', 100, 2, interval=3)
+
+    # Then the log has 6 lines and the 4th and 7th lines start at
+    # the offsets 102 and 108
+    result.should.equal((6, [102, 108]))
+
+    # And nothing is indexed when no interval is crossed
+    find_line_starts(b'a\n', 0, 0, interval=3).should.equal((1, []))
+
+
+@with_logs_dir
+@patch('carpentry.logs.LINE_INDEX_INTERVAL', 2)
+def test_log_store_read_lines(path):
+    ('LogStore.read_lines() should seek to the closest indexed line')
+
+    # Given a log with 5 lines and every 2nd line indexed
+    store = FileSystemLogStore('build-1')
+    store.write(0, b'one\ntwo\nthree\nfour\nfive')
+    store.write_line_index(4, [8, 19])
+    store.close()
+
+    # When I read the lines 3 and 4
+    result = store.read_lines(3, 4)
+
+    # Then it returns their bytes and offsets
+    result.should.equal((b'three\nfour\n', 8, 19))
+
+    # And the last line has no newline
+    store.read_lines(5, 10).should.equal((b'five', 19, 23))
+
+
+@with_logs_dir
+def test_log_store_search(path):
+    ('LogStore.search() should return the matching lines with context '
+     'and without escape sequences')
+
+    # Given a log with a traceback
+    store = FileSystemLogStore('build-1')
+    store.write(0, (
+        'running tests\n'
+        'Traceback (most recent call last):\n'
+        '\x1b[31mValueError: boom\x1b[0m\n'
+        'done\n'
+    ))
+    store.close()
+
+    # When I search for the error
+    matches = store.search('ValueError', context=1)
+
+    # Then it returns the line and its surroundings
+    matches.should.equal([{
+        'line': 3,
+        'offset': 49,
+        'text': 'ValueError: boom',
+        'before': ['Traceback (most recent call last):'],
+        'after': ['done'],
+    }])
+
+
+@patch('carpentry.logs.get_log_store')
+def test_log_writer_mark(get_log_store):
+    ('BuildLogWriter.mark() should record the line and offset where a '
+     'section starts')
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 120, 'eof': False, 'ansi_state': '', 'lines': 7}
+
+    # Given a writer with nothing buffered
+    writer = BuildLogWriter(Mock(name='build'))
+
+    # When I mark a section
+    writer.mark('running tests')
+
+    # Then the marker points to the next line
+    store.add_marker.assert_called_once_with({
+        'label': 'running tests',
+        'line': 8,
+        'offset': 120,
+    })
+
+
+@patch('carpentry.logs.get_log_store')
+def test_log_writer_decompresses_finished_log(get_log_store):
+    ('BuildLogWriter should decompress a log that was already '
+     'compressed before appending to it')
+    store = get_log_store.return_value
+    store.get_metadata.return_value = {
+        'size': 120, 'eof': True, 'ansi_state': '', 'lines': 7,
+        'encoding': 'gzip'}
+
+    # Given a writer of a compressed log
+    writer = BuildLogWriter(Mock(name='build'))
+
+    # When I mark a section
+    writer.mark('after the build')
+
+    # Then the log was decompressed first
+    store.decompress.assert_called_once_with()
+
+
+@with_logs_dir
+@patch('carpentry.logs.LOG_STREAMS', ['stdout'])
+@patch('carpentry.logs.get_connection')
+def test_delete_many_log_stores(path, get_connection):
+    ('delete_many_log_stores() should delete the logs of many builds '
+     'in two round trips')
+    pipeline = get_connection.return_value.pipeline.return_value
+    pipeline.execute.side_effect = [[None, '10'], []]
+
+    # Given that the second build has a log in the filesystem
+    store = FileSystemLogStore('build-2')
+    store.write(0, 'finished')
+    store.close()
+
+    # When I delete the logs of both builds
+    delete_many_log_stores(['build-1', 'build-2'])
+
+    # Then the sizes were read at once
+    pipeline.hget.call_args_list.should.equal([
+        call('carpentry:logs:build-1:stdout', 'size'),
+        call('carpentry:logs:build-2:stdout', 'size'),
+    ])
+
+    # And every key of both logs was deleted
+    pipeline.delete.call_count.should.equal(2)
+    pipeline.delete.call_args_list[1][0].should.contain(
+        'carpentry:logs:build-2:stdout:chunk:0')
+
+    # And so was the log in the filesystem
+    os.path.exists(os.path.join(path, 'build-2')).should.be.false
@@ -7,6 +7,10 @@ import json
 from datetime import datetime
 from mock import patch
 from carpentry.models import Build, Builder
+from carpentry.models import BUILD_STATUS_RANKS
+from carpentry.models import get_build_metrics
+from carpentry.models import get_legacy_log_size
+from carpentry.models import transition_build_status
 
 
 STUB_BUILDER = Builder(
@@ -54,8 +58,8 @@ def test_build_github_repo_info():
 
 
 @patch('carpentry.models.Build.save')
-@patch('carpentry.models.requests')
-def test_build_set_github_status(requests, save):
+@patch('carpentry.models.github')
+def test_build_set_github_status(github, save):
     ('Build.github_repo_info returns a valid url')
     b = Build(
         id=UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'),
@@ -70,7 +74,7 @@ def test_build_set_github_status(requests, save):
         'some description',
     )
 
-    requests.post.assert_called_once_with(
+    github.post.assert_called_once_with(
         'https://api.github.com/repos/gabrielfalcao/lettuce/statuses/commit1',
         headers={'Authorization': 'token fake-token'},
         data=json.dumps({
@@ -112,6 +116,8 @@ def test_build_to_dictionary():
             'id_rsa_public': u'',
             'json_instructions': u'',
             'name': u'Device Management [unit tests]',
+            'retention_max_age_in_days': 0,
+            'retention_max_builds': 0,
             'shell_script': 'make test',
             'status': u''
         },
@@ -174,26 +180,39 @@ def test_builder_property(Builder):
     b.builder.should.equal(STUB_BUILDER)
 
 
-@patch('carpentry.models.Build.append_to_bytestream')
-def test_append_to_stdout(append_to_bytestream):
-    ("Build.append_to_stdout() appends the forced unicode string and")
+@patch('carpentry.logs.publish_build_event')
+@patch('carpentry.logs.get_connection')
+@patch('carpentry.logs.get_log_store')
+def test_append_to_stdout(get_log_store, get_connection, publish_build_event):
+    ("Build.append_to_stdout() appends the forced unicode string "
+     "to the log store")
+    pipeline = get_connection.return_value.pipeline.return_value
+    store = get_log_store.return_value
+    store.get_size.return_value = 0
 
-    # Given an instance of build that has some stdout string already
+    # Given an instance of build
     b = Build(
-        stdout='[beginning]',
         git_uri='git@github.com:gabrielfalcao/lettuce.git'
     )
 
     # When I call append_to_stdout
     b.append_to_stdout('end')
 
-    # And Build.append_to_bytestream was called
-    append_to_bytestream.assert_called_once_with('stdout', 'end')
+    # And flush the buffered logs
+    b.flush_logs()
 
+    # Then the output was written at the end of the log store
+    store.write.assert_called_once_with(0, 'end', pipeline=pipeline)
 
+
+@patch('carpentry.models.transition_build_status')
+@patch('carpentry.models.close_log_writers')
+@patch('carpentry.models.publish_build_event')
 @patch('carpentry.models.Build.save')
-def test_set_status_notoken(save_build):
+def test_set_status_notoken(save_build, publish_build_event, close_log_writers,
+                            transition_build_status):
     ('Build.set_status should just change the build status and save it')
+    transition_build_status.return_value = (True, 'failed')
 
     # Given a build instance
     b = Build()
@@ -201,33 +220,52 @@ def test_set_status_notoken(save_build):
     # When I call set_status
     b.set_status('failed')
 
-    # Then save_build should have been called
+    # Then the status was changed atomically
+    transition_build_status.assert_called_once_with(b, 'failed')
+
+    # And save_build should have been called
     save_build.assert_called_once_with()
 
     # And the status should have been set
     b.status.should.equal('failed')
+    b.get_changed_fields().should_not.contain('status')
 
+    # And since the build finished its logs were closed
+    close_log_writers.assert_called_once_with(b, eof=True)
+
+    # And the status change was published
+    publish_build_event.assert_called_once_with(b.id, 'status', {
+        'status': 'failed',
+        'css_status': 'danger',
+    })
 
+
+@patch('carpentry.models.transition_build_status')
+@patch('carpentry.models.flush_log_writers')
+@patch('carpentry.models.publish_build_event')
 @patch('carpentry.models.Builder.get')
 @patch('carpentry.models.Build.set_github_status')
 @patch('carpentry.models.Build.save')
 def test_set_status_github(save_build,
                            set_github_status,
-                           get_builder):
+                           get_builder,
+                           publish_build_event,
+                           flush_log_writers,
+                           transition_build_status):
     ('Build.set_status should also set the github status')
-    parent_builder = get_builder.return_value
+    transition_build_status.return_value = (True, 'checking')
 
     # Given a build instance
     b = Build()
 
-    # When I call set_status with an unknown status
-    b.set_status('unknown', 'oops', 'test-token')
+    # When I call set_status with a status unknown to github
+    b.set_status('checking', 'oops', 'test-token')
 
     # Then save_build should have been called
     save_build.assert_called_once_with()
 
     # And the status should have been set
-    b.status.should.equal('unknown')
+    b.status.should.equal('checking')
 
     # And set_github_status should have been called
     set_github_status.assert_called_once_with(
@@ -237,11 +275,148 @@ def test_set_status_github(save_build,
     )
 
 
+@patch('carpentry.models.transition_build_status')
+@patch('carpentry.models.close_log_writers')
+@patch('carpentry.models.publish_build_event')
+@patch('carpentry.models.Build.save')
+def test_set_status_already_reached(save_build, publish_build_event,
+                                    close_log_writers,
+                                    transition_build_status):
+    ('Build.set_status should not go back to a previous status')
+    transition_build_status.return_value = (False, 'succeeded')
+
+    # Given a build instance
+    b = Build(code=1)
+
+    # When a late worker reports a failure of a build that succeeded
+    b.set_status('failed')
+
+    # Then the build keeps the status it has in redis
+    b.status.should.equal('succeeded')
+
+    # And the other changes were still saved
+    save_build.assert_called_once_with()
+
+    # And nothing was published
+    publish_build_event.called.should.be.false
+
+
+def test_build_status_ranks():
+    ('BUILD_STATUS_RANKS should order the statuses of a build with '
+     'both finished statuses at the end')
+
+    BUILD_STATUS_RANKS['scheduled'].should.be.lower_than(
+        BUILD_STATUS_RANKS['retrieving'])
+    BUILD_STATUS_RANKS['running'].should.be.lower_than(
+        BUILD_STATUS_RANKS['failed'])
+    BUILD_STATUS_RANKS['failed'].should.equal(
+        BUILD_STATUS_RANKS['succeeded'])
+
+
+@patch('carpentry.models.get_connection')
+def test_transition_build_status(get_connection):
+    ('transition_build_status() should move the build and its builder '
+     'in a single script')
+    script = get_connection.return_value.register_script.return_value
+    script.return_value = [1, b'succeeded']
+
+    # Given a build of a builder
+    b = Build(id=UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'),
+              builder=STUB_BUILDER)
+
+    # When it moves to succeeded
+    result = transition_build_status(b, 'succeeded', now=1000.5)
+
+    # Then it moved
+    result.should.equal((True, 'succeeded'))
+
+    # And the script got the keys of the build and its builder
+    keys = script.call_args[1]['keys']
+    build_id = '4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'
+    builder_id = '4b1d90f0-96c2-40cd-9c21-35eee1f243d3'
+    keys[0].should.equal('carpentry:build:{0}:transitions'.format(build_id))
+    keys[2].should.equal('carpentry:build:{0}:summary'.format(build_id))
+    keys[4].should.equal('carpentry:builder:{0}:summary'.format(builder_id))
+    keys[5].should.equal('carpentry:builder:{0}:last-build'.format(builder_id))
+    keys[6].should.equal(
+        'carpentry:builder:{0}:last-succeeded'.format(builder_id))
+    keys[7].should.equal('carpentry:builds:status:succeeded')
+    keys.should.have.length_of(15)
+
+    # And the timestamped transition
+    args = script.call_args[1]['args']
+    args[1].should.equal('succeeded')
+    json.loads(args[2]).should.equal(
+        {'status': 'succeeded', 'timestamp': 1000.5})
+    args[5:].should.equal([build_id, '1', '1'])
+
+
+def test_transition_build_status_invalid():
+    ('transition_build_status() should refuse unknown statuses')
+
+    transition_build_status.when.called_with(Build(), 'unknown').should.throw(
+        ValueError, 'invalid build status: unknown')
+
+
+def test_get_build_metrics():
+    ('get_build_metrics() should measure the time spent in each status')
+    transitions = [
+        {'status': 'scheduled', 'timestamp': 100},
+        {'status': 'retrieving', 'timestamp': 130},
+        {'status': 'running', 'timestamp': 140},
+        {'status': 'failed', 'timestamp': 200},
+    ]
+
+    # When the metrics of a finished build are calculated
+    metrics = get_build_metrics(transitions, now=1000)
+
+    # Then the finish is the end of the build
+    metrics.should.equal({
+        'durations': {'scheduled': 30, 'retrieving': 10, 'running': 60},
+        'queue_time': 30,
+        'total_time': 100,
+        'finished': True,
+    })
+
+    # When the build is still running
+    metrics = get_build_metrics(transitions[:3], now=150)
+
+    # Then it counts until now
+    metrics['durations']['running'].should.equal(10)
+    metrics['total_time'].should.equal(50)
+    metrics['finished'].should.be.false
+
+
+@patch('carpentry.models.get_connection')
+def test_get_legacy_log_size(get_connection):
+    ('get_legacy_log_size() should return the size of the stdout field '
+     'without loading the build')
+    pipeline = get_connection.return_value.pipeline.return_value
+    build = Build(id='b1d')
+
+    # Given a build that kept its output in the stdout field
+    pipeline.execute.return_value = [True, 42]
+
+    # When I get the size of its legacy log
+    get_legacy_log_size('b1d').should.equal(42)
+
+    # Then only the length of the field was requested
+    pipeline.exists.assert_called_once_with(build._calculate_hash_key())
+    pipeline.strlen.assert_called_once_with(
+        build._calculate_key_for_field('stdout'))
+
+    # And a build that does not exist has no size at all
+    pipeline.execute.return_value = [False, 0]
+    get_legacy_log_size('b1d').should.be.none
+
+
+@patch('carpentry.models.redis_pipeline')
+@patch('carpentry.models.ActiveRecord.save')
 @patch('carpentry.models.Builder.save')
 @patch('carpentry.models.Builder.get')
-def test_build_save(get_builder, base_save):
-    ('Build.save should set the status of the '
-     'parent builder as well')
+def test_build_save(get_builder, builder_save, base_save, redis_pipeline):
+    ('Build.save should leave the status of the parent builder to '
+     'the status transitions')
     parent_builder = Builder(
         id=UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'),
         name=u'Device Management [unit tests]',
@@ -253,13 +428,48 @@ def test_build_save(get_builder, base_save):
 
     # Given a build instance
     b = Build(
-        status='success',
+        status='succeeded',
         builder=parent_builder
     )
     b.save()
 
-    parent_builder.status.should.equal('success')
-    parent_builder.save.assert_called_once_with()
+    # Then the build was written
+    base_save.assert_called_once_with()
+
+    # And the builder was left alone
+    parent_builder.status.should.equal('ready')
+    builder_save.called.should.be.false
+
+
+@patch('carpentry.models.Build.write_fields')
+@patch('carpentry.models.Builder.save')
+@patch('carpentry.models.Builder.get')
+def test_build_save_without_status_change(get_builder, builder_save, write_fields):
+    ('Build.save should leave the parent builder alone when '
+     'the status did not change')
+    parent_builder = Builder(
+        id=UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'),
+        status='running',
+    )
+    get_builder.return_value = parent_builder
+
+    # Given a build loaded from redis
+    with patch.object(Build.objects, 'manager') as manager:
+        manager.get.return_value = Build(
+            status='running',
+            builder=parent_builder
+        )
+        b = Build.objects.get(id='b1d')
+
+    # When its docker status changes and it is saved
+    b.docker_status = '{}'
+    b.save()
+
+    # Then only the docker status was written
+    write_fields.assert_called_once_with(set(['docker_status']))
+
+    # And the builder was not saved
+    builder_save.called.should.be.false
 
 
 def test_build_to_dictionary_bad_docker_status():
@@ -304,8 +514,9 @@ def test_build_to_dictionary_bad_docker_status():
     })
 
 
+@patch('carpentry.models.publish_build_event')
 @patch('carpentry.models.Build.save')
-def test_register_docker_status_json_ok(save_build):
+def test_register_docker_status_json_ok(save_build, publish_build_event):
     ('Build.register_docker_status sets the docker_status and saves when receiving a valid json')
     brid = UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3')
 
@@ -320,6 +531,9 @@ def test_register_docker_status_json_ok(save_build):
     b.register_docker_status('{"foo":"bar"}')
     b.docker_status.should.equal('{"foo":"bar"}')
     save_build.assert_called_once_with()
+    publish_build_event.assert_called_once_with(b.id, 'docker_status', {
+        'docker_status': {'foo': 'bar'},
+    })
 
 
 @patch('carpentry.models.Build.append_to_stdout')
@@ -342,3 +556,40 @@ def test_register_docker_status_json_failing(save_build, append_to_stdout):
 
     append_to_stdout.assert_called_once_with('amor')
     save_build.called.should.be.false
+
+
+def test_build_to_dictionary_summary():
+    ('Build.to_dictionary(view="summary") returns only the summary fields')
+
+    b = Build(
+        id=UUID('4b1d90f0-aaaa-40cd-9c21-35eee1f243d3'),
+        builder=STUB_BUILDER,
+        git_uri='git@github.com:gabrielfalcao/lettuce.git',
+        github_webhook_data='{"huge": "payload"}',
+        commit='commit1',
+        status='failed',
+        code=1,
+        date_created=datetime(2015, 9, 1),
+    )
+
+    b.to_dictionary(view='summary').should.equal({
+        'id': '4b1d90f0-aaaa-40cd-9c21-35eee1f243d3',
+        'status': 'failed',
+        'branch': u'',
+        'commit': 'commit1',
+        'commit_message': u'',
+        'author_name': u'',
+        'author_email': u'',
+        'author_gravatar_url': 'https://s.gravatar.com/avatar/d41d8cd98f00b204e9800998ecf8427e',
+        'code': 1,
+        'css_status': 'danger',
+        'date_created': '2015-09-01 00:00:00',
+        'date_finished': '',
+    })
+
+
+def test_build_to_dictionary_invalid_view():
+    ('Build.to_dictionary() refuses unknown views')
+
+    Build().to_dictionary.when.called_with(view='full').should.throw(
+        ValueError, 'invalid build view: full')
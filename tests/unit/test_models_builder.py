@@ -2,10 +2,18 @@
 # -*- coding: utf-8 -*-
 #
 import uuid
-from mock import patch, Mock
+from mock import patch, Mock, call
 from datetime import datetime, date, time
 
 from carpentry.models import Builder
+from carpentry.models import get_builds_by_ids
+from carpentry.models import index_build
+from carpentry.models import delete_builds
+from carpentry.models import unindex_builder
+from carpentry.models import decode_build_summary
+from carpentry.models import get_last_build_summaries
+from carpentry.models import get_builder_summaries
+from carpentry.models import BuilderSummary
 
 test_uuid = uuid.UUID('a1ea566e-5608-4670-a215-60bc34311c65')
 
@@ -38,8 +46,8 @@ def test_builder_get_fallback_access_token(User):
     )
 
 
-@patch('carpentry.models.requests')
-def test_builder_delete_single_github_hook(requests):
+@patch('carpentry.models.github')
+def test_builder_delete_single_github_hook(github):
     ('Builder.delete_single_github_hook returns the token '
      'from the user who created the builder')
 
@@ -54,8 +62,8 @@ def test_builder_delete_single_github_hook(requests):
         'fake-token'
     )
 
-    # Then requests.delete should have been called with the right url
-    requests.delete.assert_called_once_with(
+    # Then github.delete should have been called with the right url
+    github.delete.assert_called_once_with(
         'https://api.github.com/repos/owner/project/hooks/hook-id',
         headers={
             'Authorization': 'token fake-token'
@@ -63,14 +71,14 @@ def test_builder_delete_single_github_hook(requests):
     )
 
     # And it should have returned the response
-    result.should.equal(requests.delete.return_value)
+    result.should.equal(github.delete.return_value)
 
 
-@patch('carpentry.models.requests')
-def test_builder_list_github_hooks_ok(requests):
+@patch('carpentry.models.github')
+def test_builder_list_github_hooks_ok(github):
     ('Builder.list_github_hooks returns the json response')
 
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.json.return_value = [
         {
             'id': 11,
@@ -94,8 +102,8 @@ def test_builder_list_github_hooks_ok(requests):
     # When I call list_github_hooks
     result = builder.list_github_hooks('fake-token')
 
-    # Then requests.delete should have been called with the right url
-    requests.get.assert_called_once_with(
+    # Then github.delete should have been called with the right url
+    github.get_cached.assert_called_once_with(
         'https://api.github.com/repos/owner/project/hooks',
         headers={
             'Authorization': 'token fake-token'
@@ -119,11 +127,11 @@ def test_builder_list_github_hooks_ok(requests):
     ])
 
 
-@patch('carpentry.models.requests')
-def test_builder_list_github_hooks_failed(requests):
+@patch('carpentry.models.github')
+def test_builder_list_github_hooks_failed(github):
     ('Builder.list_github_hooks returns an empty list when failed')
 
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.json.side_effect = ValueError('foo')
 
     # Given an instance of builder with a valid github uri
@@ -134,8 +142,8 @@ def test_builder_list_github_hooks_failed(requests):
     # When I call list_github_hooks
     result = builder.list_github_hooks('fake-token')
 
-    # Then requests.delete should have been called with the right url
-    requests.get.assert_called_once_with(
+    # Then github.delete should have been called with the right url
+    github.get_cached.assert_called_once_with(
         'https://api.github.com/repos/owner/project/hooks',
         headers={
             'Authorization': 'token fake-token'
@@ -236,6 +244,8 @@ def test_builder_to_dictionary(
             'status': 'running'
         },
         'name': 'The Awesome Pr0JName',
+        'retention_max_age_in_days': 0,
+        'retention_max_builds': 0,
         'slug': 'theawesomepr0jname',
         'status': 'success',
         'json_instructions': '',
@@ -265,12 +275,12 @@ def test_set_github_hook_cached():
 
 
 @patch('carpentry.models.Builder.save')
-@patch('carpentry.models.requests')
-def test_set_github_hook(requests, save):
+@patch('carpentry.models.github')
+def test_set_github_hook(github, save):
     ('Builder.set_github_hook returns the cached values '
      'from the github_hook_data field')
 
-    response = requests.post.return_value
+    response = github.post.return_value
     response.json.return_value = {'github': 'yay'}
     b1 = Builder(
         git_uri='git@github.com:gabrielfalcao/go-horse.git'
@@ -281,11 +291,12 @@ def test_set_github_hook(requests, save):
     save.assert_called_once_with()
 
 
+@patch('carpentry.models.set_last_build')
 @patch('carpentry.models.uuid')
 @patch('carpentry.models.datetime')
 @patch('carpentry.models.get_pipeline')
 @patch('carpentry.models.Build')
-def test_builder_trigger(Build, get_pipeline, datetime_mock, uuid_mock):
+def test_builder_trigger(Build, get_pipeline, datetime_mock, uuid_mock, set_last_build):
     ('Builder.trigger creates build and pushes it to '
      'the build pipeline')
 
@@ -330,6 +341,8 @@ def test_builder_trigger(Build, get_pipeline, datetime_mock, uuid_mock):
         'json_instructions': u'',
         'shell_script': u'',
         'git_clone_timeout_in_seconds': 0,
+        'retention_max_age_in_days': 0,
+        'retention_max_builds': 0,
         'slug': 'awesomeproject1',
         'git_uri': 'git@github.com:gabrielfalcao/go-horse.git',
         'github_hook_url': 'http://localhost:5000/api/hooks/',
@@ -340,56 +353,124 @@ def test_builder_trigger(Build, get_pipeline, datetime_mock, uuid_mock):
         'id': ''
     })
 
+    # And the build became the last build of the builder
+    set_last_build.assert_called_once_with(builder1.id, build1.id)
 
-@patch('carpentry.models.Build')
-def test_clear_builds(Build):
-    ('Builder.clear_builds returns deletes the existing builds')
+    # And it was scheduled
+    build1.set_status.assert_called_once_with('scheduled')
 
-    build1 = Mock(name='build1')
-    build2 = Mock(name='build2')
-    Build.objects.filter.return_value = [
-        build1,
-        build2,
-    ]
+
+@patch('carpentry.models.set_last_build')
+@patch('carpentry.models.delete_builds')
+@patch('carpentry.models.get_builder_build_ids')
+def test_clear_builds(get_builder_build_ids, delete_builds, set_last_build):
+    ('Builder.clear_builds deletes the existing builds in bulk')
+
+    get_builder_build_ids.return_value = ['build-1', 'build-2']
+    delete_builds.return_value = 2
+    progress = Mock(name='progress')
 
     builder = Builder(
         id=uuid.UUID('4b1d90f0-96c2-40cd-9c21-35eee1f243d3'),
     )
-    result = builder.clear_builds()
+    result = builder.clear_builds(progress)
+
+    result.should.equal(2)
+    delete_builds.assert_called_once_with(
+        builder.id, ['build-1', 'build-2'], progress)
+    set_last_build.assert_called_once_with(builder.id, None)
+
+
+@patch('carpentry.models.BULK_DELETE_BATCH_SIZE', 2)
+@patch('carpentry.models.Build.get_redis_keys')
+@patch('carpentry.models.delete_many_log_stores')
+@patch('carpentry.models.get_connection')
+def test_delete_builds(get_connection, delete_many_log_stores, get_redis_keys):
+    ('delete_builds() deletes the builds in pipelined batches')
+    pipeline = get_connection.return_value.pipeline.return_value
+    get_redis_keys.return_value = ['record-key']
+    progress = Mock(name='progress')
+
+    # Given that the last build that succeeded is one of them
+    get_connection.return_value.mget.return_value = ['b3', 'b9']
+
+    # When I delete 3 builds in batches of 2
+    result = delete_builds('builder-1', ['b1', 'b2', 'b3'], progress)
+
+    # Then it returns how many were deleted
+    result.should.equal(3)
 
-    build1.delete.assert_called_once_with()
-    build2.delete.assert_called_once_with()
+    # And the logs were deleted a batch at a time
+    delete_many_log_stores.call_args_list.should.equal([
+        call(['b1', 'b2']),
+        call(['b3']),
+    ])
+
+    # And so were the records and their summaries
+    pipeline.delete.assert_any_call(
+        'carpentry:build:b3:summary', 'record-key')
+
+    # And the pointer to the last build that succeeded
+    pipeline.delete.assert_any_call('carpentry:builder:builder-1:last-succeeded')
+    pipeline.delete.call_args_list.should_not.contain(
+        call('carpentry:builder:builder-1:last-failed'))
+
+    # And the index entries
+    pipeline.zrem.call_args_list.should.equal([
+        call('carpentry:builder:builder-1:builds', 'b1', 'b2'),
+        call('carpentry:builder:builder-1:builds', 'b3'),
+    ])
+    pipeline.execute.call_count.should.equal(2)
+
+    # And the progress was reported per batch
+    progress.call_args_list.should.equal([call(2), call(1)])
 
-    result.should.equal([build1, build2])
-    Build.objects.filter.assert_called_once_with(
-        builder=builder
+
+@patch('carpentry.models.redis_pipeline')
+def test_unindex_builder(redis_pipeline):
+    ('unindex_builder() removes the builder from the indexes along with '
+     'the pointers to its last builds')
+    pipeline = redis_pipeline.return_value.__enter__.return_value
+
+    # When I unindex a builder
+    unindex_builder('builder-1')
+
+    # Then it was removed from the list of builders
+    pipeline.zrem.assert_called_once_with('carpentry:builders', 'builder-1')
+
+    # And its summary and last builds are gone
+    pipeline.delete.assert_called_once_with(
+        'carpentry:builder:builder-1:last-build',
+        'carpentry:builder:builder-1:summary',
+        'carpentry:builder:builder-1:last-succeeded',
+        'carpentry:builder:builder-1:last-failed',
     )
 
 
+@patch('carpentry.models.get_builder_build_ids')
 @patch('carpentry.models.Build')
-def test_get_last_build(Build):
-    ('Builder.get_last_build returns the last build')
+def test_get_last_build(Build, get_builder_build_ids):
+    ('Builder.get_last_build returns the latest build from the index')
 
-    build1 = Mock(name='build1')
-    build2 = Mock(name='build2')
-    Build.objects.filter.return_value = [
-        build1,
-        build2,
-    ]
+    get_builder_build_ids.return_value = ['build-2']
 
     builder = Builder(
         id=uuid.UUID('4b1d90f0-96c2-40cd-9c21-35eee1f243d3'),
     )
     result = builder.get_last_build()
 
-    result.should.equal(build1)
+    result.should.equal(Build.objects.get.return_value)
+    get_builder_build_ids.assert_called_once_with(
+        uuid.UUID('4b1d90f0-96c2-40cd-9c21-35eee1f243d3'), 0, 0)
+    Build.objects.get.assert_called_once_with(id='build-2')
 
 
+@patch('carpentry.models.get_builder_build_ids')
 @patch('carpentry.models.Build')
-def test_get_last_build_not_found(Build):
+def test_get_last_build_not_found(Build, get_builder_build_ids):
     ('Builder.get_last_build returns none if there are no builds')
 
-    Build.objects.filter.return_value = []
+    get_builder_build_ids.return_value = []
 
     builder = Builder(
         id=uuid.UUID('4b1d90f0-96c2-40cd-9c21-35eee1f243d3'),
@@ -398,5 +479,303 @@ def test_get_last_build_not_found(Build):
 
     result.should.be.none
 
+
+@patch('carpentry.models.Build')
+def test_get_builds_skips_deleted_builds(Build):
+    ('get_builds_by_ids() returns the builds in the given order '
+     'skipping the ones that no longer exist')
+
+    build1 = Mock(name='build1')
+    Build.objects.get.side_effect = [None, build1]
+
+    get_builds_by_ids(['gone', 'build-1']).should.equal([build1])
+
+
+@patch('carpentry.models.get_connection')
+def test_index_build(get_connection):
+    ('index_build() adds the build to the sorted set of its builder '
+     'and moves it to the set of its status')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # When I index a running build
+    index_build('build-1', 'builder-1', datetime(2015, 9, 1), 'running')
+
+    # Then it was scored by its creation date
+    pipeline.execute_command.assert_called_once_with(
+        'ZADD', 'carpentry:builder:builder-1:builds', 1441065600, 'build-1')
+
+    # And added to the running builds
+    pipeline.sadd.assert_called_once_with(
+        'carpentry:builds:status:running', 'build-1')
+
+    # And removed from the other statuses
+    pipeline.srem.call_count.should.equal(7)
+    pipeline.execute.assert_called_once_with()
+
 # end of builder tests
 #######################
+
+
+def test_decode_build_summary():
+    ('decode_build_summary() returns the summary of a build as sent '
+     'to the clients')
+
+    decode_build_summary({
+        'id': 'build-1',
+        'status': 'failed',
+        'author_email': 'foo@bar.com',
+        'code': '2',
+    }).should.equal({
+        'id': u'build-1',
+        'status': u'failed',
+        'branch': '',
+        'commit': '',
+        'commit_message': '',
+        'author_name': '',
+        'author_email': u'foo@bar.com',
+        'code': 2,
+        'date_created': '',
+        'date_finished': '',
+        'css_status': 'danger',
+        'author_gravatar_url': 'https://s.gravatar.com/avatar/f3ada405ce890b6f8204094deb12d8a8',
+    })
+
+    decode_build_summary({}).should.be.none
+
+
+@patch('carpentry.models.get_connection')
+def test_get_last_build_summaries(get_connection):
+    ('get_last_build_summaries() reads the last build pointers and then '
+     'their summaries in one pipeline each')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # Given that only the first builder has builds
+    pipeline.execute.side_effect = [
+        ['build-1', None],
+        [{'id': 'build-1', 'status': 'succeeded', 'code': '0'}],
+    ]
+
+    # When I get the summaries of both builders
+    result = get_last_build_summaries(['builder-1', 'builder-2'])
+
+    # Then it read the pointers and the existing summary
+    pipeline.get.call_args_list.should.equal([
+        call('carpentry:builder:builder-1:last-build'),
+        call('carpentry:builder:builder-2:last-build'),
+    ])
+    pipeline.hgetall.assert_called_once_with(
+        'carpentry:build:build-1:summary')
+
+    # And returned a summary per builder
+    result.should.equal([{
+        'id': u'build-1',
+        'status': u'succeeded',
+        'branch': '',
+        'commit': '',
+        'commit_message': '',
+        'author_name': '',
+        'author_email': '',
+        'code': 0,
+        'date_created': '',
+        'date_finished': '',
+        'css_status': 'success',
+        'author_gravatar_url': 'https://s.gravatar.com/avatar/d41d8cd98f00b204e9800998ecf8427e',
+    }, None])
+
+
+@patch('carpentry.models.get_connection')
+def test_get_expired_build_ids(get_connection):
+    ('Builder.get_expired_build_ids returns the oldest finished builds '
+     'past the retention settings, except the protected ones')
+    connection = get_connection.return_value
+    pipeline = connection.pipeline.return_value
+
+    # Given a builder that keeps 3 builds
+    builder = Builder(id='builder-1', retention_max_builds=3)
+
+    # And that it has 7 builds, "b1" being the last failure
+    pipeline.execute.side_effect = [
+        [7, 0, 'b7', 'b7', 'b1'],
+        # b1 failed, b2 is still running, b3 and b4 succeeded
+        [False, True, False, False, True, False, True, False],
+        # b5 succeeded and b6 failed
+        [True, False, False, True],
+    ]
+    connection.zrange.side_effect = [
+        ['b1', 'b2', 'b3', 'b4'],
+        ['b5', 'b6'],
+    ]
+
+    # When I get its expired builds
+    result = builder.get_expired_build_ids(100, now=1000)
+
+    # Then it looked at the 4 oldest ones and then at the next 2 in
+    # place of the ones that are kept
+    connection.zrange.call_args_list.should.equal([
+        call('carpentry:builder:builder-1:builds', 0, 3),
+        call('carpentry:builder:builder-1:builds', 4, 5),
+    ])
+
+    # And only the finished and unprotected are expired
+    result.should.equal(['b3', 'b4', 'b5', 'b6'])
+
+
+@patch('carpentry.models.get_connection')
+def test_get_expired_build_ids_after_unfinished(get_connection):
+    ('Builder.get_expired_build_ids scans past the oldest builds when '
+     'they did not finish')
+    connection = get_connection.return_value
+    pipeline = connection.pipeline.return_value
+
+    # Given a builder that keeps 2 builds
+    builder = Builder(id='builder-1', retention_max_builds=2)
+
+    # And that it has 6 builds, the 2 oldest stuck in "running"
+    pipeline.execute.side_effect = [
+        [6, 0, 'b6', 'b6', 'b5'],
+        [False, False, False, False],
+        [True, False, False, True],
+    ]
+    connection.zrange.side_effect = [
+        ['b1', 'b2'],
+        ['b3', 'b4'],
+    ]
+
+    # When I get a batch of 2 expired builds
+    result = builder.get_expired_build_ids(2, now=1000)
+
+    # Then it skipped the unfinished ones
+    connection.zrange.call_args_list.should.equal([
+        call('carpentry:builder:builder-1:builds', 0, 1),
+        call('carpentry:builder:builder-1:builds', 2, 3),
+    ])
+    result.should.equal(['b3', 'b4'])
+
+
+@patch('carpentry.models.get_connection')
+def test_get_expired_build_ids_by_age(get_connection):
+    ('Builder.get_expired_build_ids returns the builds older than the '
+     'maximum age in batches')
+    connection = get_connection.return_value
+    pipeline = connection.pipeline.return_value
+
+    # Given a builder that keeps builds for a day
+    builder = Builder(id='builder-1', retention_max_age_in_days=1)
+
+    # And that 300 of its builds are older than that
+    pipeline.execute.side_effect = [
+        [500, 300, 'b500', 'b499', 'b498'],
+        [True, False, True, False],
+    ]
+    connection.zrange.return_value = ['b1', 'b2']
+
+    # When I get a batch of 2 expired builds
+    result = builder.get_expired_build_ids(2, now=100000)
+
+    # Then it counted the builds before the cutoff
+    pipeline.zcount.assert_called_once_with(
+        'carpentry:builder:builder-1:builds', '-inf', '(13600.0')
+
+    # And returned the 2 oldest
+    connection.zrange.assert_called_once_with(
+        'carpentry:builder:builder-1:builds', 0, 1)
+    result.should.equal(['b1', 'b2'])
+
+
+def test_get_expired_build_ids_without_retention():
+    ('Builder.get_expired_build_ids keeps everything by default')
+
+    Builder(id='builder-1').get_expired_build_ids(100).should.equal([])
+
+
+def test_builder_summary():
+    ('BuilderSummary should decode a summary hash into a read-only '
+     'record serialized like Builder.to_list_dictionary')
+
+    # Given the summary hash of a builder
+    record = BuilderSummary.from_hash({
+        'id': b'a1ea566e-5608-4670-a215-60bc34311c65',
+        'name': b'Awesome Project',
+        'status': b'running',
+        'creator': b'',
+        'build_timeout_in_seconds': b'300',
+    })
+
+    # Then the fields were decoded
+    record.name.should.equal(u'Awesome Project')
+    record.build_timeout_in_seconds.should.equal(300)
+    record.git_clone_timeout_in_seconds.should.equal(0)
+    record.creator.should.be.none
+
+    # And it can not be changed
+    setattr.when.called_with(record, 'name', 'foo').should.throw(
+        AttributeError, 'BuilderSummary is read-only')
+
+    # And it is serialized with its last build
+    result = record.to_dictionary({'id': 'build-1'})
+    result['slug'].should.equal('awesomeproject')
+    result['css_status'].should.equal('warning')
+    result['last_build'].should.equal({'id': 'build-1'})
+    result['github_hook_url'].should.equal(
+        'http://localhost:5000/api/hooks/a1ea566e-5608-4670-a215-60bc34311c65')
+    result.should_not.have.key('id_rsa_private')
+
+    # And missing hashes have no record
+    BuilderSummary.from_hash({}).should.be.none
+
+
+@patch('carpentry.models.Builder.write_fields')
+@patch('carpentry.models.get_connection')
+def test_builder_save_writes_changed_summary_fields(get_connection,
+                                                   write_fields):
+    ('Builder.save should only write the summary fields that changed '
+     'and leave the status to the status transitions')
+    connection = get_connection.return_value
+
+    # Given a builder loaded from redis
+    with patch.object(Builder.objects, 'manager') as manager:
+        manager.get.return_value = Builder(
+            id='builder-1', name='old name', status='ready')
+        builder = Builder.objects.get(id='builder-1')
+
+    # When its name changes along with a stale status and it is saved
+    builder.name = 'new name'
+    builder.status = 'running'
+    builder.save()
+
+    # Then both fields were written in its hash
+    write_fields.assert_called_once_with(set(['name', 'status']))
+
+    # And only the name was written in its summary
+    connection.hmset.assert_called_once_with(
+        'carpentry:builder:builder-1:summary', {'name': 'new name'})
+
+
+@patch('carpentry.models.Builder.objects')
+@patch('carpentry.models.get_connection')
+def test_get_builder_summaries(get_connection, objects):
+    ('get_builder_summaries() reads the summaries of the builders in '
+     'a single pipeline')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # Given that the second builder has no summary yet
+    pipeline.execute.return_value = [{'id': 'builder-1'}, {}, {}]
+    builder2 = Mock(name='builder-2')
+    builder2.write_summary.return_value = {'id': 'builder-2'}
+    objects.get.side_effect = [builder2, None]
+
+    # When I get the summaries of 3 builders
+    result = get_builder_summaries(['builder-1', 'builder-2', 'builder-3'])
+
+    # Then they were read at once
+    pipeline.hgetall.call_args_list.should.equal([
+        call('carpentry:builder:builder-1:summary'),
+        call('carpentry:builder:builder-2:summary'),
+        call('carpentry:builder:builder-3:summary'),
+    ])
+
+    # And the missing summary was written from the builder
+    builder2.write_summary.assert_called_once_with()
+
+    # And the builders that no longer exist were skipped
+    [record.id for record in result].should.equal(['builder-1', 'builder-2'])
@@ -10,11 +10,13 @@ from carpentry.models import slugify
 from carpentry.models import model_to_dictionary
 from carpentry.models import GithubOrganization
 from carpentry.models import CarpentryBaseActiveRecord
+from carpentry.models import get_page_of_ids
+from carpentry.models import get_uuid_timestamp
 from carpentry.workers import RunBuilder
 
 
-@patch('carpentry.models.JSONRedisBackend')
-def test_get_pipeline(JSONRedisBackend):
+@patch('carpentry.models.CarpentryRedisBackend')
+def test_get_pipeline(CarpentryRedisBackend):
     ('carpentry.models.get_pipeline should return an instance of the RunBuilder pipeline')
 
     get_pipeline().should.be.a(RunBuilder)
@@ -90,3 +92,111 @@ def test_serialize_model_to_dictionary():
         'response_data': '',
         'url': ''
     })
+
+
+@patch('carpentry.models.CarpentryBaseActiveRecord.write_fields')
+@patch('carpentry.models.ActiveRecord.save')
+def test_save_writes_only_changed_fields(base_save, write_fields):
+    ('CarpentryBaseActiveRecord.save() should write the whole record once '
+     'and then only the fields that changed')
+
+    # Given a github organization
+    org = GithubOrganization(
+        id=uuid.UUID('a1ea566e-5608-4670-a215-60bc34311c65'),
+        login='chucknorris',
+    )
+
+    # When I save it for the first time
+    org.save()
+
+    # Then the whole record was written
+    base_save.assert_called_once_with()
+
+    # When I change a field, assign the same value to another and save
+    org.url = 'https://api.github.com/orgs/chucknorris'
+    org.login = 'chucknorris'
+    org.save()
+
+    # Then only the changed field was written
+    base_save.call_count.should.equal(1)
+    write_fields.assert_called_once_with(set(['url']))
+
+    # When I save it again without changes
+    org.save()
+
+    # Then nothing was written
+    base_save.call_count.should.equal(1)
+    write_fields.call_count.should.equal(1)
+
+
+@patch('carpentry.models.CarpentryBaseActiveRecord.write_fields')
+@patch('carpentry.models.ActiveRecord.save')
+def test_loaded_records_write_only_changed_fields(base_save, write_fields):
+    ('records loaded through objects should only write the fields that '
+     'changed the first time they are saved')
+
+    # Given a github organization as repocket loads it
+    with patch.object(GithubOrganization.objects, 'manager') as manager:
+        manager.get.return_value = GithubOrganization(
+            id=uuid.UUID('a1ea566e-5608-4670-a215-60bc34311c65'),
+            login='chucknorris',
+        )
+        org = GithubOrganization.objects.get(id='a1ea566e')
+
+    # When I change a field and save it
+    org.url = 'https://api.github.com/orgs/chucknorris'
+    org.save()
+
+    # Then only the changed field was written
+    base_save.called.should.be.false
+    write_fields.assert_called_once_with(set(['url']))
+
+
+@patch('carpentry.models.get_connection')
+def test_get_page_of_ids_first_page(get_connection):
+    ('get_page_of_ids() should return the first members and the cursor '
+     'of the last one when there are more')
+    connection = get_connection.return_value
+    connection.zrevrange.return_value = [
+        ('c', 3.0), ('b', 2.0), ('a', 1.0)]
+
+    # When I get the first page of 2 members
+    result = get_page_of_ids('some-key', 2)
+
+    # Then it asked for one extra member
+    connection.zrevrange.assert_called_once_with(
+        'some-key', 0, 2, withscores=True)
+
+    # And the cursor points to the last member of the page
+    result.should.equal((['c', 'b'], '2.0:b'))
+
+
+@patch('carpentry.models.get_connection')
+def test_get_page_of_ids_after_cursor(get_connection):
+    ('get_page_of_ids() should skip the members up to the cursor, '
+     'including the ones with the same score')
+    connection = get_connection.return_value
+    connection.zcount.return_value = 2
+    connection.zrevrangebyscore.return_value = [
+        ('y', 2.0), ('x', 2.0), ('a', 1.0)]
+
+    # When I get the page after the member "y" with the score 2
+    result = get_page_of_ids('some-key', 2, '2.0:y')
+
+    # Then it read by score from the cursor
+    connection.zrevrangebyscore.assert_called_once_with(
+        'some-key', 2.0, '-inf', start=0, num=5, withscores=True)
+
+    # And the last page starts after the cursor
+    result.should.equal((['x', 'a'], None))
+
+
+def test_get_uuid_timestamp():
+    ('get_uuid_timestamp() returns the creation time of uuid1 values')
+
+    get_uuid_timestamp(
+        uuid.UUID('4b1d90f0-96c2-11e5-9c21-35eee1f243d3'),
+    ).should.equal(1448819693.2718832)
+
+    get_uuid_timestamp(
+        uuid.UUID('4b1d90f0-96c2-40cd-9c21-35eee1f243d3')).should.equal(0)
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 #
 import uuid
+import hashlib
 from mock import patch, Mock
 from carpentry.models import User
+from carpentry.models import index_user
+from carpentry.models import get_last_page_number
 
 test_uuid = uuid.UUID('a1ea566e-5608-4670-a215-60bc34311c65')
 
@@ -23,11 +26,11 @@ def test_user_get_github_metadata_cached():
 
 
 @patch('carpentry.models.User.save')
-@patch('carpentry.models.requests')
-def test_user_get_github_metadata(requests, save):
+@patch('carpentry.models.github')
+def test_user_get_github_metadata(github, save):
     ('User.get_github_metadata should retrieve from api and save')
 
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.text = '{"foo": "bar"}'
     response.json.return_value = {"foo": "bar"}
     response.status_code = 200
@@ -71,15 +74,18 @@ def test_user_to_dictionary(get_github_metadata):
     })
 
 
+@patch('carpentry.models.get_connection')
+@patch('carpentry.models.forget_principal')
 @patch('carpentry.models.User.save')
 @patch('carpentry.models.uuid')
-def test_user_reset_token(uuid_mock, save_user):
+def test_user_reset_token(uuid_mock, save_user, forget_principal,
+                          get_connection):
     ('User.reset_token() should set the carpentry_token '
      'to a new uuid4()')
 
     uuid_mock.uuid4.return_value = test_uuid
 
-    u = User(name='Chuck')
+    u = User(name='Chuck', carpentry_token='old-token')
 
     u.reset_token()
 
@@ -87,19 +93,167 @@ def test_user_reset_token(uuid_mock, save_user):
 
     save_user.assert_called_once_with()
 
+    # And the old token is no longer cached
+    forget_principal.assert_called_once_with('old-token')
+
+    # And no longer points to the user
+    get_connection.return_value.delete.assert_called_once_with(
+        'carpentry:users:by-token:c9c310094a36fff7a05766efc0faf396c55c3ff9')
 
-@patch('carpentry.models.User.objects')
-def test_from_carpentry_token(user_objects):
-    ('User.from_carpentry_token() should set the '
-     'carpentry_token to a new uuid4()')
 
-    user1 = Mock(name='user1')
+@patch('carpentry.models.get_connection')
+@patch('carpentry.models.User.objects')
+def test_from_carpentry_token(user_objects, get_connection):
+    ('User.from_carpentry_token() should find the user through '
+     'the token index')
 
-    user_objects.filter.return_value = [user1]
+    user1 = Mock(name='user1', carpentry_token=test_uuid)
+    get_connection.return_value.get.return_value = 'user-1'
+    user_objects.get.return_value = user1
 
     u = User.from_carpentry_token(test_uuid)
 
     u.should.equal(user1)
+    get_connection.return_value.get.assert_called_once_with(
+        'carpentry:users:by-token:{0}'.format(
+            hashlib.sha1(str(test_uuid)).hexdigest()))
+    user_objects.get.assert_called_once_with(id='user-1')
+
+
+@patch('carpentry.models.get_connection')
+@patch('carpentry.models.User.objects')
+def test_from_carpentry_token_stale_index(user_objects, get_connection):
+    ('User.from_carpentry_token() should ignore index entries of '
+     'tokens that the user no longer has')
+
+    get_connection.return_value.get.return_value = 'user-1'
+    user_objects.get.return_value = Mock(
+        name='user1', carpentry_token=uuid.uuid4())
+
+    User.from_carpentry_token(test_uuid).should.be.none
+
+
+@patch('carpentry.models.get_connection')
+@patch('carpentry.models.User.objects')
+def test_from_github_access_token(user_objects, get_connection):
+    ('User.from_github_access_token() should find the user through '
+     'the github token index')
+
+    user1 = Mock(name='user1', github_access_token='gh-token')
+    get_connection.return_value.get.return_value = 'user-1'
+    user_objects.get.return_value = user1
+
+    User.from_github_access_token('gh-token').should.equal(user1)
+    get_connection.return_value.get.assert_called_once_with(
+        'carpentry:users:by-github-token:{0}'.format(
+            hashlib.sha1('gh-token').hexdigest()))
+
+
+@patch('carpentry.models.get_connection')
+def test_index_user(get_connection):
+    ('index_user() should point both tokens of the user to its id')
+    pipeline = get_connection.return_value.pipeline.return_value
+
+    # Given a user
+    user = User(id=test_uuid, carpentry_token=test_uuid,
+                github_access_token='gh-token')
+
+    # When it is indexed
+    index_user(user)
+
+    # Then both tokens point to it
+    pipeline.set.assert_any_call(
+        'carpentry:users:by-token:{0}'.format(
+            hashlib.sha1(str(test_uuid)).hexdigest()), str(test_uuid))
+    pipeline.set.assert_any_call(
+        'carpentry:users:by-github-token:{0}'.format(
+            hashlib.sha1('gh-token').hexdigest()), str(test_uuid))
+    pipeline.execute.assert_called_once_with()
+
+
+@patch('carpentry.models.cache_principal')
+@patch('carpentry.models.get_principal')
+@patch('carpentry.models.User.from_carpentry_token')
+def test_from_cached_token_miss(from_carpentry_token, get_principal,
+                                cache_principal):
+    ('User.from_cached_token() should find the user by its token and '
+     'cache its principal when it was not cached')
+    get_principal.return_value = None
+    user = from_carpentry_token.return_value
+    user.to_principal.return_value = {'organization_names': ['cnry']}
+
+    # When I get the user of a token that was not cached
+    result = User.from_cached_token('token-1')
+
+    # Then the user was found by its token
+    result.should.equal(user)
+    from_carpentry_token.assert_called_once_with('token-1')
+
+    # And its principal was cached
+    cache_principal.assert_called_once_with(
+        'token-1', {'organization_names': ['cnry']})
+
+
+@patch('carpentry.models.forget_principal')
+@patch('carpentry.models.index_user')
+@patch('carpentry.models.User.write_fields')
+@patch('carpentry.models.ActiveRecord.save')
+def test_save_user_from_principal(base_save, write_fields, index_user,
+                                  forget_principal):
+    ('a User rebuilt from the principal cache should only write the '
+     'fields changed since and forget the cached principal')
+
+    # Given a user rebuilt from its cached principal
+    user = User.from_principal({
+        'user': {
+            'id': str(test_uuid),
+            'carpentry_token': str(test_uuid),
+            'name': 'Chuck',
+            'github_metadata': {'login': 'chuck'},
+        },
+        'organization_names': ['cnry'],
+    })
+
+    # When its github metadata changes and it is saved
+    user.github_metadata = {'login': 'norris'}
+    user.save()
+
+    # Then only the metadata was written
+    base_save.called.should.be.false
+    write_fields.assert_called_once_with(set(['github_metadata']))
+
+    # And the cached principal is no longer used
+    forget_principal.assert_called_once_with(test_uuid)
+
+
+@patch('carpentry.models.github')
+@patch('carpentry.models.get_principal')
+@patch('carpentry.models.User.from_carpentry_token')
+def test_from_cached_token_hit(from_carpentry_token, get_principal, github):
+    ('User.from_cached_token() should build the user from its cached '
+     'principal without asking redis or github for anything else')
+    get_principal.return_value = {
+        'user': {
+            'id': str(test_uuid),
+            'name': 'Chuck',
+            'carpentry_token': str(test_uuid),
+            'github_access_token': 'gh-token',
+        },
+        'organization_names': [],
+    }
+
+    # When I get the user of a cached token
+    user = User.from_cached_token('token-1')
+
+    # Then it came from the cache
+    user.id.should.equal(test_uuid)
+    user.name.should.equal('Chuck')
+    user.github_access_token.should.equal('gh-token')
+    from_carpentry_token.called.should.be.false
+
+    # And its organizations do not require a request
+    user.organization_names.should.equal([])
+    github.get_cached.called.should.be.false
 
 
 @patch('carpentry.models.User.objects')
@@ -113,14 +267,15 @@ def test_from_carpentry_token_no_token(user_objects):
 
 
 @patch('carpentry.models.User.prepare_github_request_headers')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_organization_repos(
-        requests,
+        github,
         prepare_github_request_headers):
     ('User.retrieve_organization_repos() should return '
      'a list of repos')
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 200
+    response.links = {}
     response.json.return_value = [
         'the', 'response',
     ]
@@ -134,8 +289,8 @@ def test_retrieve_organization_repos(
     result = u.retrieve_organization_repos('sure')
 
     result.should.equal(['the', 'response'])
-    requests.get.assert_called_once_with(
-        'https://api.github.com/orgs/sure/repos',
+    github.get_cached.assert_called_once_with(
+        'https://api.github.com/orgs/sure/repos?per_page=100&page=1',
         headers={
             'has_headers': True
         }
@@ -143,12 +298,12 @@ def test_retrieve_organization_repos(
 
 
 @patch('carpentry.models.User.prepare_github_request_headers')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_organization_repos_failed(
-        requests,
+        github,
         prepare_github_request_headers):
     ('User.retrieve_organization_repos() should and empty list when failed')
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 400
 
     prepare_github_request_headers.return_value = {
@@ -163,14 +318,15 @@ def test_retrieve_organization_repos_failed(
 
 
 @patch('carpentry.models.User.prepare_github_request_headers')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_user_repos(
-        requests,
+        github,
         prepare_github_request_headers):
     ('User.retrieve_user_repos() should return '
      'a list of repos')
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 200
+    response.links = {}
     response.json.return_value = [
         'the', 'response',
     ]
@@ -184,8 +340,8 @@ def test_retrieve_user_repos(
     result = u.retrieve_user_repos()
 
     result.should.equal(['the', 'response'])
-    requests.get.assert_called_once_with(
-        'https://api.github.com/user/repos',
+    github.get_cached.assert_called_once_with(
+        'https://api.github.com/user/repos?per_page=100&page=1',
         headers={
             'has_headers': True
         }
@@ -193,12 +349,12 @@ def test_retrieve_user_repos(
 
 
 @patch('carpentry.models.User.prepare_github_request_headers')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_user_repos_failed(
-        requests,
+        github,
         prepare_github_request_headers):
     ('User.retrieve_user_repos() should and empty list when failed')
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 400
 
     prepare_github_request_headers.return_value = {
@@ -212,31 +368,47 @@ def test_retrieve_user_repos_failed(
     result.should.be.empty
 
 
+@patch('carpentry.models.conf')
+@patch('carpentry.models.get_connection')
 @patch('carpentry.models.GithubRepository')
-@patch('carpentry.models.User.retrieve_user_repos')
-@patch('carpentry.models.User.retrieve_organization_repos')
+@patch('carpentry.models.User.retrieve_github_listings')
 def test_retrieve_and_cache_github_repositories(
-        retrieve_organization_repos,
-        retrieve_user_repos,
-        GithubRepository):
+        retrieve_github_listings,
+        GithubRepository,
+        get_connection,
+        conf):
     ('User.retrieve_and_cache_github_repositories() should '
-     '')
-    retrieve_organization_repos.return_value = [
+     'fetch the repos of the organizations and the user and cache them')
+    conf.allowed_github_organizations = ['cnry']
+    pipeline = get_connection.return_value.pipeline.return_value
+    pipeline.execute.return_value = [None, True]
+    retrieve_github_listings.return_value = [
         {
             'owner': 'cnry',
             'name': 'bng1',
-        }
-    ]
-    retrieve_user_repos.return_value = [
+        },
         {
             'owner': 'gabrielfalcao',
             'name': 'carpentry',
-        }
+        },
     ]
-    u = User()
+    u = User(id=test_uuid)
 
     result = u.retrieve_and_cache_github_repositories()
 
+    retrieve_github_listings.assert_called_once_with([
+        'https://api.github.com/orgs/cnry/repos',
+        'https://api.github.com/user/repos',
+    ])
+
+    # And the result was cached
+    pipeline.hget.assert_called_once_with(
+        'carpentry:users:{0}:github-repos'.format(test_uuid), 'repos')
+
+    # And stored since it changed
+    GithubRepository.store_many_from_list.assert_called_once_with(
+        retrieve_github_listings.return_value)
+
     result.should.equal([
         {
             'owner': 'cnry',
@@ -249,11 +421,112 @@ def test_retrieve_and_cache_github_repositories(
     ])
 
 
+@patch('carpentry.models.conf')
+@patch('carpentry.models.User.retrieve_github_page')
+def test_retrieve_github_listings(retrieve_github_page, conf):
+    ('User.retrieve_github_listings() should follow the pages of every '
+     'listing and keep them in order')
+    conf.github_sync_concurrency = 2
+    pages = {
+        ('orgs', 1): (['o1'], 3),
+        ('orgs', 2): (['o2'], 3),
+        ('orgs', 3): (['o3'], 3),
+        ('user', 1): (['u1'], 1),
+    }
+    retrieve_github_page.side_effect = lambda url, page=1: pages[(url, page)]
+
+    # When I retrieve 2 listings where the first one has 3 pages
+    result = User().retrieve_github_listings(['orgs', 'user'])
+
+    # Then every page was fetched once
+    retrieve_github_page.call_count.should.equal(4)
+
+    # And the items came in order
+    result.should.equal(['o1', 'o2', 'o3', 'u1'])
+
+
+def test_get_last_page_number():
+    ('get_last_page_number() should read the last page from the Link header')
+    response = Mock(name='response')
+    response.links = {
+        'next': {'url': 'https://api.github.com/user/repos?per_page=100&page=2'},
+        'last': {'url': 'https://api.github.com/user/repos?per_page=100&page=7'},
+    }
+    get_last_page_number(response, 1).should.equal(7)
+
+    # And the last page has no link to itself
+    response.links = {}
+    get_last_page_number(response, 7).should.equal(7)
+
+
+@patch('carpentry.models.conf')
+@patch('carpentry.models.BackgroundJob')
+@patch('carpentry.models.get_connection')
+def test_refresh_github_repositories_in_background(get_connection,
+                                                   BackgroundJob, conf):
+    ('User.refresh_github_repositories_in_background() should start a '
+     'single sync at a time')
+    conf.github_repos_refresh_interval_in_seconds = 300
+    connection = get_connection.return_value
+    connection.set.return_value = True
+    u = User(id=test_uuid)
+
+    # When a refresh is requested
+    job = u.refresh_github_repositories_in_background()
+
+    # Then a job was started
+    job.should.equal(BackgroundJob.return_value.start.return_value)
+    connection.set.assert_called_once_with(
+        'carpentry:users:{0}:github-repos:refresh'.format(test_uuid),
+        b'1', nx=True, ex=300)
+
+    # When another one is requested while it runs
+    connection.set.return_value = None
+
+    # Then nothing else is started
+    u.refresh_github_repositories_in_background().should.be.none
+    BackgroundJob.call_count.should.equal(1)
+
+
+@patch('carpentry.models.conf')
+@patch('carpentry.models.BackgroundJob')
+@patch('carpentry.models.get_connection')
+@patch('carpentry.models.User.retrieve_and_cache_github_repositories')
+def test_refresh_github_repositories_failed(retrieve_and_cache, get_connection,
+                                            BackgroundJob, conf):
+    ('User.refresh_github_repositories_in_background() should not start '
+     'another sync right after one failed')
+    conf.github_repos_refresh_interval_in_seconds = 300
+    connection = get_connection.return_value
+    u = User(id=test_uuid)
+
+    # Given a background sync
+    u.refresh_github_repositories_in_background()
+    name, total, refresh = BackgroundJob.call_args[0]
+    progress = Mock(name='progress')
+
+    # When github fails
+    retrieve_and_cache.side_effect = IOError('github is down')
+    refresh.when.called_with(progress).should.have.raised(IOError)
+
+    # Then the lock is kept until it expires
+    connection.delete.called.should.be.false
+
+    # When it succeeds
+    retrieve_and_cache.side_effect = None
+    refresh(progress)
+
+    # Then the lock is released
+    connection.delete.assert_called_once_with(
+        'carpentry:users:{0}:github-repos:refresh'.format(test_uuid))
+    progress.assert_called_once_with(1)
+
+
 @patch('carpentry.models.User.save')
 @patch('carpentry.models.User.get_github_metadata')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_github_organizations(
-        requests,
+        github,
         get_github_metadata,
         save_user):
     ('User.retrieve_github_organizations() should return '
@@ -262,7 +535,7 @@ def test_retrieve_github_organizations(
     get_github_metadata.return_value = {
 
     }
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 200
     response.json.return_value = [
         'the', 'response',
@@ -275,7 +548,7 @@ def test_retrieve_github_organizations(
     result = u.retrieve_github_organizations()
 
     result.should.equal(['the', 'response'])
-    requests.get.assert_called_once_with(
+    github.get_cached.assert_called_once_with(
         'https://api.github.com/user/orgs',
         headers={
             'Authorization': 'token thetoken'
@@ -287,9 +560,9 @@ def test_retrieve_github_organizations(
 
 @patch('carpentry.models.User.save')
 @patch('carpentry.models.User.get_github_metadata')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_retrieve_github_organizations_cached(
-        requests,
+        github,
         get_github_metadata,
         save_user):
     ('User.retrieve_github_organizations() should return '
@@ -298,7 +571,7 @@ def test_retrieve_github_organizations_cached(
     get_github_metadata.return_value = {
         'organizations': ['cnry']
     }
-    response = requests.get.return_value
+    response = github.get_cached.return_value
     response.status_code = 200
     response.json.return_value = [
         'the', 'response',
@@ -312,9 +585,9 @@ def test_retrieve_github_organizations_cached(
 
 
 @patch('carpentry.models.User.retrieve_github_organizations')
-@patch('carpentry.models.requests')
+@patch('carpentry.models.github')
 def test_organization_names(
-        requests,
+        github,
         retrieve_github_organizations):
     ('User.organization_names returns a list of all github organizations')
     retrieve_github_organizations.return_value = [
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import patch
+from carpentry.principals import get_principal
+from carpentry.principals import cache_principal
+from carpentry.principals import forget_principal
+
+TOKEN_KEY = 'carpentry:principals:2ff8ce7b15424e80f5d5dcd568c370d816dfeff3'
+
+
+@patch('carpentry.principals.conf')
+@patch('carpentry.principals.get_connection')
+def test_cache_principal(get_connection, conf):
+    ('cache_principal() should keep the principal under a digest of the '
+     'token until it expires')
+    connection = get_connection.return_value
+    conf.principal_cache_ttl_in_seconds = 300
+
+    # When I cache a principal
+    cache_principal('token-1', {'organization_names': ['cnry']})
+
+    # Then it was stored with an expiration
+    connection.set.assert_called_once_with(
+        TOKEN_KEY, '{"organization_names": ["cnry"]}', ex=300)
+
+
+@patch('carpentry.principals.get_connection')
+def test_get_principal(get_connection):
+    ('get_principal() should return the cached principal or None')
+    connection = get_connection.return_value
+    connection.get.return_value = b'{"organization_names": ["cnry"]}'
+
+    get_principal('token-1').should.equal({'organization_names': ['cnry']})
+    connection.get.assert_called_once_with(TOKEN_KEY)
+
+    connection.get.return_value = None
+    get_principal('token-1').should.be.none
+
+
+@patch('carpentry.principals.get_connection')
+def test_forget_principal(get_connection):
+    ('forget_principal() should remove the principal of the token')
+    connection = get_connection.return_value
+
+    forget_principal('token-1')
+    connection.delete.assert_called_once_with(TOKEN_KEY)
+
+    # And does nothing for users without a token
+    forget_principal(None)
+    connection.delete.call_count.should.equal(1)
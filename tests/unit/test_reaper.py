@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import Mock, patch, call
+from carpentry.reaper import BuildReaper
+
+
+@patch('carpentry.reaper.delete_builds')
+@patch('carpentry.reaper.get_builders_page')
+def test_reaper_deletes_expired_builds_in_batches(get_builders_page, delete_builds):
+    ('BuildReaper.reap() should delete the expired builds of every '
+     'builder a batch at a time')
+
+    # Given 2 pages of builders, the first one with 3 expired builds
+    builder1 = Mock(name='builder1', id='builder-1')
+    builder1.get_expired_build_ids.side_effect = [['b1', 'b2'], ['b3'], []]
+    builder2 = Mock(name='builder2', id='builder-2')
+    builder2.get_expired_build_ids.return_value = []
+    get_builders_page.side_effect = [
+        ([builder1], 'cursor-1'),
+        ([builder2], None),
+    ]
+    delete_builds.side_effect = lambda builder_id, build_ids: len(build_ids)
+
+    # When the reaper runs with batches of 2
+    reaper = BuildReaper(interval=60, batch_size=2, pause=0)
+    result = reaper.reap()
+
+    # Then it went through both pages
+    get_builders_page.call_args_list.should.equal([
+        call(100, None),
+        call(100, 'cursor-1'),
+    ])
+
+    # And deleted the expired builds in batches
+    delete_builds.call_args_list.should.equal([
+        call('builder-1', ['b1', 'b2']),
+        call('builder-1', ['b3']),
+    ])
+    builder1.get_expired_build_ids.assert_called_with(2)
+    result.should.equal(3)
+
+
+@patch('carpentry.reaper.get_connection')
+def test_reaper_acquire(get_connection):
+    ('BuildReaper.acquire() should let a single process reap per interval')
+    connection = get_connection.return_value
+
+    # When the reaper tries to acquire the lock
+    reaper = BuildReaper(interval=600)
+    result = reaper.acquire()
+
+    # Then it was set only if nobody else holds it
+    result.should.equal(connection.set.return_value)
+    connection.set.assert_called_once_with(
+        'carpentry:reaper:lock', reaper.id, nx=True, ex=540)
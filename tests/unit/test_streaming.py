@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+import json
+from mock import Mock, patch
+from carpentry.streaming import format_server_sent_event
+from carpentry.streaming import BuildEventStream
+
+
+def parse_events(messages):
+    events = []
+    for message in messages:
+        fields = dict(line.split(': ', 1) for line in message.strip().splitlines())
+        events.append((fields['id'], fields['event'], json.loads(fields['data'])))
+
+    return events
+
+
+def test_format_server_sent_event():
+    ('format_server_sent_event() should return an event in the text/event-stream format')
+
+    format_server_sent_event('status', {'status': 'running'}, 42).should.equal(
+        'id: 42\n'
+        'event: status\n'
+        'data: {"status": "running"}\n\n'
+    )
+
+
+@patch('carpentry.streaming.hub')
+def test_stream_finished_build(hub):
+    ('BuildEventStream should send the remaining log, the status '
+     'and stop when the build is finished')
+
+    # Given a finished build
+    build = Mock(name='build', status='succeeded', docker_status='')
+    store = build.get_log_store.return_value
+    store.read_html.side_effect = [
+        ('<span class="ansi1">the output</span>', 20, True, '1'),
+        ('', 20, True, '1'),
+    ]
+
+    # When I iterate over its events from the offset 10
+    stream = BuildEventStream(build, offset=10)
+    events = parse_events(stream)
+
+    # Then it sent the log, the status and the eof
+    events.should.equal([
+        ('20:1', 'log', {
+            'offset': 10,
+            'next_offset': 20,
+            'html': '<span class="ansi1">the output</span>',
+            'state': '1',
+        }),
+        ('20:1', 'status', {'status': 'succeeded', 'css_status': 'success'}),
+        ('20:1', 'eof', {'next_offset': 20}),
+    ])
+
+    # And it rendered from the given offset
+    store.read_html.assert_any_call(10, 512 * 1024, '')
+
+    # And it stopped listening to the build events
+    hub.watch.assert_called_once_with(build.id, stream.listener)
+    hub.unwatch.assert_called_once_with(build.id, stream.listener)
+
+
+@patch('carpentry.streaming.hub')
+def test_stream_running_build(hub):
+    ('BuildEventStream should relay the events published while the build runs')
+
+    # Given a running build with nothing new in its log
+    build = Mock(name='build', status='running', docker_status='')
+    store = build.get_log_store.return_value
+    store.stream = 'stdout'
+    store.read_html.side_effect = [
+        ('', 5, False, ''),
+        ('', 8, True, ''),
+    ]
+
+    # And that the workers publish a log event and then finish the build
+    stream = BuildEventStream(build, offset=5)
+    stream.queue.put({
+        'event': 'log', 'stream': 'stdout',
+        'offset': 5, 'next_offset': 8, 'data': 'new',
+        'html': 'new', 'state': '',
+    })
+    stream.queue.put({'event': 'status', 'status': 'failed'})
+
+    # When I iterate over its events
+    events = parse_events(stream)
+
+    # Then it relayed the new bytes and the status change
+    events.should.equal([
+        ('5', 'status', {'status': 'running', 'css_status': 'warning'}),
+        ('8', 'log', {
+            'offset': 5, 'next_offset': 8, 'html': 'new', 'state': '',
+        }),
+        ('8', 'status', {'status': 'failed', 'css_status': 'danger'}),
+        ('8', 'eof', {'next_offset': 8}),
+    ])
+
+
+@patch('carpentry.streaming.hub')
+def test_stream_log_spilled_when_finished(hub):
+    ('BuildEventStream should read the rest of the log from wherever '
+     'it was moved to when the build finishes')
+
+    # Given a running build whose log is in redis
+    build = Mock(name='build', status='running', docker_status='')
+    redis_store = Mock(name='redis_store', stream='stdout')
+    redis_store.read_html.side_effect = [
+        ('', 5, False, ''),
+        # the keys were deleted once the log was spilled
+        ('', 0, False, ''),
+    ]
+
+    # And that the log is moved to the filesystem as the build finishes
+    filesystem_store = Mock(name='filesystem_store', stream='stdout')
+    filesystem_store.read_html.side_effect = [
+        ('done', 9, True, ''),
+        ('', 9, True, ''),
+    ]
+    build.get_log_store.side_effect = [
+        redis_store, redis_store, redis_store,
+        filesystem_store, filesystem_store,
+    ]
+
+    stream = BuildEventStream(build, offset=5)
+    stream.queue.put({'event': 'status', 'status': 'succeeded'})
+
+    # When I iterate over its events
+    events = parse_events(stream)
+
+    # Then the end of the log came from the filesystem
+    events.should.equal([
+        ('5', 'status', {'status': 'running', 'css_status': 'warning'}),
+        ('5', 'status', {'status': 'succeeded', 'css_status': 'success'}),
+        ('9', 'log', {
+            'offset': 5, 'next_offset': 9, 'html': 'done', 'state': '',
+        }),
+        ('9', 'eof', {'next_offset': 9}),
+    ])
+
+
+@patch('carpentry.streaming.hub')
+def test_stream_legacy_build(hub):
+    ('BuildEventStream should send the stdout field of finished builds '
+     'created before the chunked log storage and stop')
+
+    # Given a finished build that has its output only in the stdout field
+    build = Mock(name='build', status='failed', docker_status='',
+                 stdout='\x1b[1mlegacy\x1b[0m output')
+    store = build.get_log_store.return_value
+    store.read_html.return_value = ('', 0, False, '')
+    store.get_metadata.return_value = {'size': 0, 'eof': False}
+
+    # When I iterate over its events
+    stream = BuildEventStream(build)
+    events = parse_events(stream)
+
+    # Then it sent the whole output as a single log event, the status and the eof
+    events.should.equal([
+        ('21', 'log', {
+            'offset': 0,
+            'next_offset': 21,
+            'html': '<span class="ansi1">legacy</span> output',
+            'state': '',
+        }),
+        ('21', 'status', {'status': 'failed', 'css_status': 'danger'}),
+        ('21', 'eof', {'next_offset': 21}),
+    ])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+from __future__ import unicode_literals
+from mock import Mock, patch
+from carpentry.websockets import BuildRoomRelay
+from carpentry.websockets import subscribe_to_build
+from carpentry.websockets import unsubscribe_from_build
+
+
+def test_room_relay_listens_once_per_build():
+    ('BuildRoomRelay should register a single hub listener per '
+     'build regardless of how many browsers are watching it')
+    hub = Mock(name='hub')
+    socket_io = Mock(name='socket_io')
+
+    # Given a relay
+    relay = BuildRoomRelay(hub)
+
+    # When two browsers watch the same build
+    relay.watch(socket_io, 'build-1', 'sid-1')
+    relay.watch(socket_io, 'build-1', 'sid-2')
+
+    # Then it registered only one listener
+    hub.watch.call_count.should.equal(1)
+    build_id, listener = hub.watch.call_args[0]
+    build_id.should.equal('build-1')
+
+    # And the listener emits to the room of the build
+    listener({'event': 'status'})
+    socket_io.emit.assert_called_once_with(
+        'build:event', {'event': 'status'}, room='build:build-1')
+
+    # When one of them stops watching
+    relay.unwatch('build-1', 'sid-1')
+
+    # Then the listener is kept
+    hub.unwatch.called.should.be.false
+
+    # When the last one stops watching
+    relay.unwatch('build-1', 'sid-2')
+
+    # Then the listener is removed
+    hub.unwatch.assert_called_once_with('build-1', listener)
+
+
+def test_room_relay_counts_each_session_once():
+    ('BuildRoomRelay should stop listening when a session that '
+     'subscribed twice disconnects')
+    hub = Mock(name='hub')
+    socket_io = Mock(name='socket_io')
+    relay = BuildRoomRelay(hub)
+
+    # Given a browser that subscribed twice to the same build
+    relay.watch(socket_io, 'build-1', 'sid-1')
+    relay.watch(socket_io, 'build-1', 'sid-1')
+    listener = hub.watch.call_args[0][1]
+
+    # When it disconnects
+    relay.unwatch_all('sid-1')
+
+    # Then the listener is removed
+    hub.unwatch.assert_called_once_with('build-1', listener)
+    relay.watchers.should.equal({})
+
+
+@patch('carpentry.websockets.get_websocket_user')
+@patch('carpentry.websockets.relay')
+@patch('carpentry.websockets.join_room')
+@patch('carpentry.websockets.current_app')
+@patch('carpentry.websockets.request')
+def test_subscribe_to_build(request, current_app, join_room, relay,
+                            get_websocket_user):
+    ('subscribe_to_build() should join the room of the build and '
+     'watch it under the gevent-socketio session id')
+
+    # Given a socket of an authenticated user
+    request.namespace.socket.sessid = 'sid-1'
+    socket_io = current_app.extensions.__getitem__.return_value
+
+    # When it subscribes to a build
+    subscribe_to_build({'build_id': 'build-1'})
+
+    # Then it joined the room of the build
+    join_room.assert_called_once_with('build:build-1')
+
+    # And the relay watches the build for that session
+    current_app.extensions.__getitem__.assert_called_once_with('socketio')
+    relay.watch.assert_called_once_with(socket_io, 'build-1', 'sid-1')
+
+
+@patch('carpentry.websockets.relay')
+@patch('carpentry.websockets.leave_room')
+@patch('carpentry.websockets.request')
+def test_unsubscribe_from_build(request, leave_room, relay):
+    ('unsubscribe_from_build() should only leave the rooms the '
+     'socket is in')
+
+    # Given a socket that is only in the room of a build
+    request.namespace.socket.sessid = 'sid-1'
+    request.namespace.rooms = set(['build:build-1'])
+
+    # When it unsubscribes from another build
+    unsubscribe_from_build({'build_id': 'build-2'})
+
+    # Then nothing happened
+    leave_room.called.should.be.false
+    relay.unwatch.called.should.be.false
+
+    # When it unsubscribes from its build
+    unsubscribe_from_build({'build_id': 'build-1'})
+
+    # Then it left the room and the relay stopped watching for that session
+    leave_room.assert_called_once_with('build:build-1')
+    relay.unwatch.assert_called_once_with('build-1', 'sid-1')
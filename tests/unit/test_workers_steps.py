@@ -11,6 +11,7 @@ from carpentry.workers.steps import run_command
 from carpentry.workers.steps import nice_current_time
 from carpentry.workers.steps import extract_container_name
 from carpentry.workers.steps import stream_output
+from carpentry.workers.steps import kill_process_group
 from carpentry.workers.steps import get_build_from_instructions
 from carpentry.workers.steps import set_build_status
 from carpentry.workers.steps import CarpentryPipelineStep
@@ -45,7 +46,8 @@ def test_run_command(Popen):
         },
         cwd='/chdir/sandbox',
         stderr=STDOUT,
-        stdout=PIPE
+        stdout=PIPE,
+        preexec_fn=original_os.setsid,
     )
 
 
@@ -75,85 +77,80 @@ def test_run_command_exception(Popen, logging):
     )
 
 
+@patch('carpentry.workers.steps.kill_process_group')
+@patch('carpentry.workers.steps.select')
 @patch('carpentry.workers.steps.time')
-def test_stream_output_stops_on_timeout(time):
-    ("stream_output should stop the loop after timing out")
+def test_stream_output_stops_on_timeout(time, select, kill_process_group):
+    ("stream_output should time out even when the process "
+     "does not print anything")
 
     # Given a timeout of 30 seconds
     timeout = 30
-    # And that time.time() returns a timed out value after called for
-    # the 4th time
+    # And that time.time() reaches the timeout on the 4th call
     time.time.side_effect = [
         1000,
         1001,
         1016,
-        1050
+        1050,
+        1050,
     ]
+    # And that the process never prints anything
+    select.select.return_value = ([], [], [])
+
     # And that I have a mock of step, build and of process
     step = Mock(name='step')
     build = Mock(name='build')
     process = Mock(name='process')
 
-    # And that process.stdout.readline returns a chunk of 512 bytes of
-    # string
-    process.stdout.readline.side_effect = [
-        'aaaa' * 128, 'bbbb' * 64, 'cccc' * 32, 'dddd' * 32]
-
     # When I call stream_output
     result = stream_output(
         step,
         process,
         build,
-        stdout_chunk_size=512,
         timeout_in_seconds=timeout
     )
 
-    # Then the result should be the string
-    result.should.equal(
-        (
-            ('aaaa' * 128) + ('bbbb' * 64),
-            420
-        )
-    )
-    build.append_to_stdout.assert_has_calls([
-        call(u'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'),
-        call(u'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb'),
-        call(u'\nBuild timed out by 50 seconds')
-    ])
-    build.save.assert_has_calls([
-        call(),
-        call(),
+    # Then it returns the timeout exit code
+    result.should.equal(('', 420))
+
+    # And it waited for output until the deadline
+    select.select.assert_has_calls([
+        call([process.stdout.fileno.return_value], [], [], 0.25),
+        call([process.stdout.fileno.return_value], [], [], 0.25),
     ])
 
-    # And since the build timed out, it terminates the process
-    process.terminate.assert_called_once_with()
+    # And the timeout was written to the build output
+    build.append_to_stdout.assert_called_once_with(
+        '\nBuild timed out by 50 seconds')
+    build.flush_logs.call_count.should.equal(3)
+
+    # And since the build timed out, it kills the process group
+    kill_process_group.assert_called_once_with(process)
 
 
+@patch('carpentry.workers.steps.os')
+@patch('carpentry.workers.steps.select')
 @patch('carpentry.workers.steps.time')
-def test_stream_output_stops_when_no_more_output_is_returned(time):
-    ("stream_output should wait for the process and save the "
-     "exit code after it stops producing output")
+def test_stream_output_stops_when_no_more_output_is_returned(time, select, os):
+    ("stream_output should read chunks until the end of the output "
+     "and return the exit code of the process")
+
+    # Given a clock that never moves
+    time.time.return_value = 1000
+
+    # And that the output of the process is always ready to be read
+    select.select.side_effect = lambda r, w, x, timeout: (r, w, x)
 
-    # Given that time.time() returns a timed out value after called for
-    # the 3rd time
-    time.time.side_effect = [
-        1000,
-        1001,
-        1016,
-        1050
-    ]
     # And that I have a mock of step, build and of process
     step = Mock(name='step')
     build = Mock(name='build')
-    build.stdout = ""
-    build.stderr = ""
     process = Mock(name='process')
 
     # And that process.wait returns status code 0
     process.wait.return_value = 0
 
-    # And that process.stdout.readline returns an empty string on the 2nd call
-    process.stdout.readline.side_effect = [b'the output', b'']
+    # And that the output has a multi-byte character split in two chunks
+    os.read.side_effect = [b'the output \xc3', b'\xa7', b'']
 
     # When I call stream_output
     result = stream_output(
@@ -164,16 +161,95 @@ def test_stream_output_stops_when_no_more_output_is_returned(time):
     )
 
     # Then the result should be the string
-    result.should.equal(('the output', 0))
+    result.should.equal(('the output \xe7', 0))
+
+    # And it read fixed-size chunks
+    os.read.assert_has_calls([
+        call(process.stdout.fileno.return_value, 4096),
+    ])
 
     # And the build should have had its stdout updated
-    build.append_to_stdout.assert_called_once_with('the output')
+    build.append_to_stdout.assert_has_calls([
+        call('the output '),
+        call('\xe7'),
+    ])
+
+    # And the buffered logs should have been flushed
+    build.flush_logs.assert_called_once_with()
+
 
-    # And the build should have been saved
-    build.save.assert_has_calls([
-        call(),
+@patch('carpentry.workers.steps.OUTPUT_TAIL_SIZE', 8)
+@patch('carpentry.workers.steps.os')
+@patch('carpentry.workers.steps.select')
+@patch('carpentry.workers.steps.time')
+def test_stream_output_returns_only_the_tail(time, select, os):
+    ("stream_output should stream everything to the build log "
+     "but only return the tail of the output")
+    time.time.return_value = 1000
+    select.select.side_effect = lambda r, w, x, timeout: (r, w, x)
+    os.read.side_effect = [b'first ', b'second ', b'third', b'']
+
+    build = Mock(name='build')
+    process = Mock(name='process')
+
+    # When I call stream_output
+    tail, exit_code = stream_output(Mock(name='step'), process, build)
+
+    # Then every chunk went to the build log
+    build.append_to_stdout.assert_has_calls([
+        call('first '),
+        call('second '),
+        call('third'),
     ])
 
+    # And only the last 8 characters were returned
+    tail.should.equal('nd third')
+    exit_code.should.equal(process.wait.return_value)
+
+
+def test_stream_output_times_out_after_the_output_is_closed():
+    ("stream_output should time out and kill a process that closed "
+     "its output but keeps running")
+
+    # Given a process that stops writing to its output and sleeps
+    process = run_command('echo started; exec >/dev/null; sleep 60')
+    build = Mock(name='build')
+
+    # When I call stream_output with a timeout of 1 second
+    tail, exit_code = stream_output(
+        Mock(name='step'), process, build, timeout_in_seconds=1)
+
+    # Then it returned the output and the timeout exit code
+    tail.should.equal('started\n')
+    exit_code.should.equal(420)
+
+    # And the process was killed
+    process.poll().should_not.be.none
+
+
+@patch('carpentry.workers.steps.os')
+@patch('carpentry.workers.steps.time')
+def test_kill_process_group(time, os):
+    ("kill_process_group should send SIGKILL to the process group "
+     "when SIGTERM is not enough")
+
+    # Given a process that ignores SIGTERM
+    process = Mock(name='process', pid=1234)
+    process.poll.return_value = None
+    time.time.side_effect = [1000, 1001, 1006]
+
+    # When I kill its process group
+    result = kill_process_group(process, timeout_before_sigkill=5)
+
+    # Then it sent SIGTERM and then SIGKILL to the group
+    os.killpg.assert_has_calls([
+        call(1234, 15),
+        call(1234, 9),
+    ])
+
+    # And it returns the exit code
+    result.should.equal(process.wait.return_value)
+
 
 @patch('carpentry.workers.steps.Build')
 def test_get_build_from_instructions(Build):
@@ -529,8 +605,8 @@ def test_response_did_succeed_ok():
 
 
 @patch('carpentry.workers.steps.json')
-@patch('carpentry.workers.steps.requests')
-def test_push_keys_into_api_and_get_response(requests, json):
+@patch('carpentry.workers.steps.github')
+def test_push_keys_into_api_and_get_response(github, json):
     ('PushKeyToGithub#push_keys_into_api_and_get_response()')
 
     # Given an instance of
@@ -545,11 +621,11 @@ def test_push_keys_into_api_and_get_response(requests, json):
         'psssstsecret',
     )
 
-    # Then it should return a response from requests
-    result.should.equal(requests.post.return_value)
+    # Then it should return the response from github
+    result.should.equal(github.post.return_value)
 
-    # And requests.post should have been called appropriately
-    requests.post.assert_called_once_with(
+    # And github.post should have been called appropriately
+    github.post.assert_called_once_with(
         'https://api.github.com/repos/gabrielfalcao/go-horse/keys',
         headers={
             'Authorization': u'token psssstsecret'